@@ -0,0 +1,202 @@
+"""
+booth_data.db connection and schema
+The crawler and the form-data pipeline both write here, so the table
+definitions and connection settings live in one place
+
+demand_metrics is a materialized view of master_matching: triggers record
+which (avatar, item) pairs changed, and refresh_demand_metrics recomputes only
+those pairs and bumps the version in demand_metrics_meta
+"""
+
+import math
+import sqlite3
+import time
+from pathlib import Path
+
+DB_PATH = Path("booth_data.db")
+
+MASTER_ITEM_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS master_item (
+        shop TEXT,
+        item TEXT,
+        avatar INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (shop, item)
+    )
+'''
+
+MASTER_MATCHING_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS master_matching (
+        avatar TEXT,
+        item TEXT,
+        userid TEXT,
+        price INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (avatar, item, userid)
+    )
+'''
+
+MASTER_MATCHING_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_master_matching_avatar ON master_matching(avatar)',
+    'CREATE INDEX IF NOT EXISTS idx_master_matching_item ON master_matching(item)',
+]
+
+
+_MARK_DIRTY = (
+    'INSERT INTO demand_metrics_dirty SELECT {row}.avatar, {row}.item '
+    'WHERE NOT EXISTS (SELECT 1 FROM demand_metrics_dirty '
+    'WHERE avatar = {row}.avatar AND item = {row}.item)'
+)
+
+DEMAND_METRICS_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS demand_metrics (
+        avatar_id TEXT,
+        item_id TEXT,
+        request_count INTEGER,
+        unique_users INTEGER,
+        median_price REAL,
+        mean_price REAL,
+        min_price REAL,
+        max_price REAL,
+        price_std REAL,
+        potential_sales REAL,
+        PRIMARY KEY (avatar_id, item_id)
+    )
+    ''',
+    # Top-N by potential_sales (ties by key) is a plain index scan
+    '''
+    CREATE INDEX IF NOT EXISTS idx_demand_metrics_potential_sales
+    ON demand_metrics(potential_sales DESC, avatar_id, item_id)
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS demand_metrics_dirty (
+        avatar TEXT,
+        item TEXT,
+        PRIMARY KEY (avatar, item)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS demand_metrics_meta (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL,
+        refreshed_at REAL NOT NULL,
+        row_count INTEGER NOT NULL
+    )
+    ''',
+    # An outer ON CONFLICT (the upsert) overrides OR IGNORE inside a trigger,
+    # so duplicates are skipped with NOT EXISTS instead
+    f'''
+    CREATE TRIGGER IF NOT EXISTS master_matching_dirty_insert
+    AFTER INSERT ON master_matching BEGIN
+        {_MARK_DIRTY.format(row='NEW')};
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS master_matching_dirty_update
+    AFTER UPDATE ON master_matching BEGIN
+        {_MARK_DIRTY.format(row='OLD')};
+        {_MARK_DIRTY.format(row='NEW')};
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS master_matching_dirty_delete
+    AFTER DELETE ON master_matching BEGIN
+        {_MARK_DIRTY.format(row='OLD')};
+    END
+    ''',
+]
+
+# One window pass over each changed pair, ordered by price, keeping the row at
+# the lower middle: lead() supplies the upper middle for an even count. The
+# variance is n*sum(p^2) - sum(p)^2 over n(n-1), exact while it fits in int64.
+# unique_users counts users with an ID (missing IDs are stored as '')
+REFRESH_DEMAND_METRICS_SQL = [
+    '''
+    DELETE FROM demand_metrics
+    WHERE (avatar_id, item_id) IN (SELECT avatar, item FROM demand_metrics_dirty)
+    ''',
+    '''
+    INSERT INTO demand_metrics
+    SELECT avatar, item, n, users, median, total * 1.0 / n, low, high,
+           CASE WHEN n > 1
+                THEN sqrt(max(0, (n * squares - total * total) * 1.0 / (n * (n - 1)))) END,
+           n * median
+    FROM (
+        SELECT avatar, item, n, users, total, squares, low, high, rn,
+               CASE WHEN n % 2 = 1 THEN price ELSE (price + upper) / 2.0 END AS median
+        FROM (
+            SELECT m.avatar, m.item, m.price,
+                   ROW_NUMBER() OVER w AS rn,
+                   COUNT(*) OVER w AS n,
+                   SUM(m.userid <> '') OVER w AS users,
+                   SUM(m.price) OVER w AS total,
+                   SUM(m.price * m.price) OVER w AS squares,
+                   MIN(m.price) OVER w AS low,
+                   MAX(m.price) OVER w AS high,
+                   LEAD(m.price) OVER w AS upper
+            FROM demand_metrics_dirty d
+            JOIN master_matching m ON m.avatar = d.avatar AND m.item = d.item
+            WINDOW w AS (PARTITION BY m.avatar, m.item ORDER BY m.price
+                         ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+        )
+        WHERE rn = (n + 1) / 2
+    )
+    ''',
+    'DELETE FROM demand_metrics_dirty',
+]
+
+
+def refresh_demand_metrics(conn: sqlite3.Connection) -> int:
+    """
+    変更された組み合わせだけ demand_metrics を再計算し、バージョンを上げる
+    呼び出し側のトランザクション内で実行する。新しいバージョンを返す
+    """
+    for statement in REFRESH_DEMAND_METRICS_SQL:
+        conn.execute(statement)
+    conn.execute(
+        '''
+        INSERT INTO demand_metrics_meta (id, version, refreshed_at, row_count)
+        VALUES (1, 1, ?, (SELECT COUNT(*) FROM demand_metrics))
+        ON CONFLICT (id) DO UPDATE SET
+            version = version + 1,
+            refreshed_at = excluded.refreshed_at,
+            row_count = excluded.row_count
+        ''',
+        (time.time(),)
+    )
+    return conn.execute('SELECT version FROM demand_metrics_meta').fetchone()[0]
+
+
+def connect(db_path: Path = DB_PATH, check_same_thread: bool = True) -> sqlite3.Connection:
+    """
+    WALモードで接続し、テーブルがなければ作成する
+    WALでは読み込みが書き込みを待たない (synchronous=NORMAL では電源断時に
+    直前のコミットが失われることはあるが、データベースは壊れない)
+    """
+    conn = sqlite3.connect(db_path, check_same_thread=check_same_thread)
+    # Not every SQLite build has the math functions
+    conn.create_function('sqrt', 1, math.sqrt, deterministic=True)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    with conn:
+        conn.execute(MASTER_ITEM_SCHEMA)
+        conn.execute(MASTER_MATCHING_SCHEMA)
+        for statement in MASTER_MATCHING_INDEXES:
+            conn.execute(statement)
+
+        # First connection after an upgrade: materialize the existing rows
+        materialized = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'demand_metrics_meta'"
+        ).fetchone()
+        for statement in DEMAND_METRICS_SCHEMA:
+            conn.execute(statement)
+        if not materialized:
+            conn.execute(
+                'INSERT INTO demand_metrics_dirty '
+                'SELECT DISTINCT avatar, item FROM master_matching'
+            )
+            refresh_demand_metrics(conn)
+    return conn
@@ -0,0 +1,288 @@
+"""
+Out-of-core run of the processing pipeline for very large response sets
+The raw rows are read in bounded chunks (Sheets pages or raw CSV/parquet
+files) and every chunk is parsed and cleaned in a worker process. The parent
+upserts each processed chunk into master_matching and folds the chunk's
+DemandState into the running state, so peak memory is set by the chunk size,
+the number of chunks in flight and the number of distinct pairs, not by the
+number of rows. The merged state finalizes to the same demand metrics as the
+in-memory path
+"""
+
+import argparse
+import hashlib
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+from column_mappings import FORM_COLUMNS
+from column_schema import (DASHBOARD_SCHEMA, PROCESSED_SCHEMA, approximate_schema, conform_table,
+                           typed_frame)
+from config_handler import load_config
+from demand_aggregates import DemandState
+from demand_sketches import SketchParams, SketchState, sketch_params_from_config
+from fingerprints import TableHasher
+from process import DataProcessor, compact_snapshots
+from sheets_client import DEFAULT_PAGE_ROWS, ColumnarRows, SheetsClient, SheetsError
+
+DEFAULT_CHUNK_ROWS = 200_000
+# Chunk states are merged in groups of this many
+MERGE_FANIN = 8
+
+STATE_COLUMNS = ['avatar_item_id', 'item_item_id', 'twitter_id', 'desired_price']
+
+ChunkState = Union[DemandState, SketchState]
+
+
+def sheet_chunks(client: SheetsClient, spreadsheet_id: str, chunk_rows: int,
+                 digest=None) -> Iterator[pa.Table]:
+    """
+    シートを DEFAULT_PAGE_ROWS 行ずつ取得し、chunk_rows 行ずつの Arrow テーブル
+    (シートの列名) として返す。digest は download_spreadsheet と同じページで更新する
+    """
+    rows = None
+    for start, values in client.iter_pages(spreadsheet_id, 1, DEFAULT_PAGE_ROWS, digest):
+        if rows is None:
+            if not values:
+                return
+            headers = values[0]
+            rows = ColumnarRows(headers)
+            values = values[1:]
+        while values:
+            needed = chunk_rows - rows.num_rows
+            rows.append(values[:needed])
+            values = values[needed:]
+            if rows.num_rows == chunk_rows:
+                yield rows.to_table()
+                rows = ColumnarRows(headers)
+    if rows is not None and rows.num_rows:
+        yield rows.to_table()
+
+
+def _csv_batches(path: Path) -> Iterator[pa.RecordBatch]:
+    """生データの CSV をブロックごとに読む (read_snapshot_file と同じくすべて文字列)"""
+    names = pacsv.open_csv(path).schema.names
+    convert_options = pacsv.ConvertOptions(
+        column_types={name: pa.string() for name in names}, strings_can_be_null=True
+    )
+    yield from pacsv.open_csv(path, convert_options=convert_options)
+
+
+def _rebatch(batches: Iterable[pa.RecordBatch], chunk_rows: int) -> Iterator[pa.Table]:
+    """レコードバッチを chunk_rows 行ずつのテーブルにまとめ直す"""
+    pending: List[pa.RecordBatch] = []
+    pending_rows = 0
+    for batch in batches:
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        while pending_rows >= chunk_rows:
+            table = pa.Table.from_batches(pending)
+            yield table.slice(0, chunk_rows)
+            rest = table.slice(chunk_rows)
+            pending, pending_rows = rest.to_batches(), rest.num_rows
+    if pending_rows:
+        yield pa.Table.from_batches(pending)
+
+
+def file_chunks(paths: Iterable[Path], chunk_rows: int) -> Iterator[pa.Table]:
+    """生データのファイル (CSV / parquet) を順に chunk_rows 行ずつ返す"""
+    for path in map(Path, paths):
+        if path.suffix == '.parquet':
+            batches = pq.ParquetFile(path).iter_batches(batch_size=chunk_rows)
+        else:
+            batches = _csv_batches(path)
+        yield from _rebatch(batches, chunk_rows)
+
+
+def _mapped(chunks: Iterable[pa.Table], csv_path: Optional[Path] = None) -> Iterator[pa.Table]:
+    """
+    チャンクの列名をフォームの列名に対応付ける
+    csv_path があれば対応付ける前の行を順に書き込み、最後まで読めたら保存する
+    """
+    if csv_path is None:
+        for chunk in chunks:
+            yield chunk.rename_columns([FORM_COLUMNS.get(h, h) for h in chunk.column_names])
+        return
+
+    tmp_path = csv_path.with_name(f".{csv_path.name}.tmp")
+    with open(tmp_path, 'wb') as sink:
+        for i, chunk in enumerate(chunks):
+            pacsv.write_csv(chunk, sink, pacsv.WriteOptions(include_header=i == 0))
+            yield chunk.rename_columns([FORM_COLUMNS.get(h, h) for h in chunk.column_names])
+    tmp_path.replace(csv_path)
+    print(f"Raw data saved to: {csv_path}")
+
+
+def process_chunk(engine: str, chunk: pa.Table,
+                  sketch_params: Optional[SketchParams] = None) -> Tuple[int, pa.Table, ChunkState]:
+    """
+    ワーカー: 生データのチャンク (列名は対応付け済み) を処理し、
+    (読んだ行数, 処理済みの行, チャンクの DemandState) を返す
+    sketch_params があれば DemandState の代わりに SketchState を返す (近似モード)
+    """
+    rows = chunk if engine == 'arrow' else chunk.to_pandas()
+    processed = DataProcessor.process_rows(rows, verbose=False)
+    if isinstance(processed, pd.DataFrame):
+        processed = conform_table(pa.Table.from_pandas(processed, preserve_index=False), PROCESSED_SCHEMA)
+    rows = typed_frame(processed.select(STATE_COLUMNS))
+    if sketch_params is not None:
+        state = SketchState.from_frame(rows, sketch_params)
+    else:
+        state = DemandState.from_frame(rows)
+    return chunk.num_rows, processed, state
+
+
+class ChunkedPipeline:
+    """
+    DataProcessor のチャンク単位の実行
+    - 生データのチャンクをワーカープロセスで処理 (workers=0 はこのプロセスで処理)
+    - 処理済みの行は読んだ順に master_matching に upsert し、フィンガープリントに加える
+    - チャンクごとの DemandState をまとめて需要メトリクスを公開する
+      (近似モードでは SketchState: 親プロセスのメモリはユーザー数ではなく組み合わせの数で決まる)
+    """
+
+    def __init__(self, processor: DataProcessor, chunk_rows: int = DEFAULT_CHUNK_ROWS,
+                 workers: Optional[int] = None):
+        self.processor = processor
+        self.chunk_rows = chunk_rows
+        self.workers = os.cpu_count() if workers is None else workers
+
+    def _results(self, chunks: Iterable[pa.Table]) -> Iterator[Tuple[int, pa.Table, ChunkState]]:
+        """チャンクの処理結果を読んだ順に返す (処理中のチャンクはワーカー数の2倍まで)"""
+        engine = self.processor.engine
+        sketch_params = self.processor.sketch_params
+        if self.workers == 0:
+            for chunk in chunks:
+                yield process_chunk(engine, chunk, sketch_params)
+            return
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(process_chunk, engine, chunk, sketch_params))
+                if len(pending) >= 2 * self.workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def run(self, chunks: Iterable[pa.Table]) -> bool:
+        """
+        列名を対応付けた生データのチャンクを処理して需要メトリクスを公開する
+        処理済みの行が前回公開した実行と同じ場合は公開しない
+        """
+        processor = self.processor
+        hasher = TableHasher(PROCESSED_SCHEMA)
+        sketch_params = processor.sketch_params
+        state_type = DemandState if sketch_params is None else SketchState
+        states: List[ChunkState] = []
+        read_rows = processed_rows = chunk_count = 0
+        started = time.perf_counter()
+        processor.matching_store.begin_full_run()
+
+        for read, processed, state in self._results(chunks):
+            hasher.update(processed)
+            # demand_metrics is refreshed by the prune once all chunks are in
+            processor.matching_store.upsert(processed, refresh=False, full_run=True)
+            states.append(state)
+            if len(states) >= MERGE_FANIN:
+                states = [state_type.merge_all(states)]
+            chunk_count += 1
+            read_rows += read
+            processed_rows += processed.num_rows
+            print(f"Chunk {chunk_count}: {read_rows} rows read, {processed_rows} processed")
+
+        if not processed_rows:
+            print("No data to process")
+            return False
+        removed = processor.matching_store.prune()
+        elapsed = time.perf_counter() - started
+        print(f"\nProcessed {read_rows} rows in {chunk_count} chunks with {self.workers or 1} "
+              f"worker(s): {elapsed:.1f}s ({read_rows / elapsed:.0f} rows/s)")
+        print(f"Upserted {processed_rows} rows into master_matching ({processor.matching_store.db_path}), "
+              f"removed {removed} rows no longer in the source")
+
+        processor.fingerprints.record('processed', hasher.hexdigest())
+        if processor.fingerprints.unchanged('processed'):
+            print("Processed data unchanged; skipping dashboard data")
+            return True
+
+        demand_metrics = state_type.merge_all(states).to_metrics()
+        demand_metrics = demand_metrics.sort_values('potential_sales', ascending=False)
+        if processor.engine == 'arrow':
+            # Published as a table, like the in-memory arrow engine
+            schema = DASHBOARD_SCHEMA if sketch_params is None else approximate_schema(sketch_params.quantile_columns)
+            demand_metrics = conform_table(
+                pa.Table.from_pandas(demand_metrics, preserve_index=False), schema
+            )
+        processor.publish_demand_metrics(demand_metrics)
+        return True
+
+    def run_sheet(self, spreadsheet_id: str, api_key: str) -> bool:
+        """スプレッドシートをページごとに取得しながら処理する (生データは CSV に保存)"""
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        csv_path = self.processor.raw_dir / f"raw_data_{timestamp}.csv"
+        digest = hashlib.sha256()
+        print("Downloading spreadsheet in chunks using Google Sheets API...")
+        try:
+            with SheetsClient(api_key) as client:
+                chunks = sheet_chunks(client, spreadsheet_id, self.chunk_rows, digest)
+                if not self.run(_mapped(chunks, csv_path)):
+                    return False
+        except SheetsError as e:
+            print(f"Failed to download spreadsheet: {str(e)}")
+            return False
+        self.processor.fingerprints.record('raw', digest.hexdigest())
+        return True
+
+    def run_files(self, paths: List[Path]) -> bool:
+        """保存済みの生データ (CSV / parquet) を処理する"""
+        return self.run(_mapped(file_chunks(paths, self.chunk_rows)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chunked pipeline for very large response sets")
+    parser.add_argument('files', nargs='*', type=Path,
+                        help="生データの CSV / parquet (省略時はスプレッドシートから取得)")
+    parser.add_argument('--chunk-rows', type=int, help="1チャンクの行数")
+    parser.add_argument('--workers', type=int, help="ワーカープロセス数 (0: このプロセスで処理)")
+    args = parser.parse_args()
+
+    # config.json の "streaming" で chunk_rows と workers の既定値を指定できる
+    config = load_config()
+    streaming_config = config.get('streaming', {})
+    processor = DataProcessor(engine=config.get('engine', 'pandas'),
+                              sketch_params=sketch_params_from_config(config))
+    if config.get('force', False):
+        processor.fingerprints.clear()
+    pipeline = ChunkedPipeline(
+        processor,
+        chunk_rows=args.chunk_rows or streaming_config.get('chunk_rows', DEFAULT_CHUNK_ROWS),
+        workers=args.workers if args.workers is not None else streaming_config.get('workers'),
+    )
+
+    if args.files:
+        completed = pipeline.run_files(args.files)
+    elif config.get('api_key') == 'YOUR-API-KEY':
+        print("Please update the API key in config.json")
+        return
+    else:
+        completed = pipeline.run_sheet(config.get('spreadsheet_id'), config.get('api_key'))
+    if not completed:
+        return
+
+    processor.fingerprints.commit()
+    print("\nAll processing steps completed successfully!")
+    compact_snapshots(processor, config)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Typed schemas for the processed rows and the demand metrics
+PROCESSED_SCHEMA and DASHBOARD_SCHEMA give every column of PROCESSED_COLUMNS
+and DASHBOARD_COLUMNS an explicit Arrow type: integer item IDs,
+dictionary-encoded repeated strings and narrow numeric types. Rows are
+conformed as soon as they are processed, metrics before they are published,
+and the parquet files are written with zstd
+"""
+
+from typing import Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from column_mappings import DASHBOARD_COLUMNS, PROCESSED_COLUMNS
+
+# Repeated strings (URLs, users, shops): int32 codes into one dictionary
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+PROCESSED_TYPES = {
+    'timestamp': pa.float64(),
+    'avatar_url': CATEGORY,
+    'item_url': CATEGORY,
+    'twitter_id': CATEGORY,
+    'desired_price': pa.int32(),
+    'hitaiou_worker_name': CATEGORY,
+    'avatar_shop_id': CATEGORY,
+    'avatar_item_id': pa.int64(),
+    'item_shop_id': CATEGORY,
+    'item_item_id': pa.int64(),
+    'is_avatar': pa.int8(),
+}
+
+# Pair IDs stay text here: the API and the demand_metrics table serve them as strings
+DASHBOARD_TYPES = {
+    'avatar_id': pa.string(),
+    'item_id': pa.string(),
+    'request_count': pa.int32(),
+    'unique_users': pa.int32(),
+    'median_price': pa.float64(),
+    'mean_price': pa.float64(),
+    'min_price': pa.float64(),
+    'max_price': pa.float64(),
+    'price_std': pa.float64(),
+    'potential_sales': pa.float64(),
+}
+
+# Approximate mode (demand_sketches): error bounds next to the estimated metrics
+APPROXIMATE_TYPES = {
+    'unique_users_error': pa.int32(),
+    'median_price_error': pa.float64(),
+    'potential_sales_error': pa.float64(),
+}
+
+# These get 0 where the value is missing or out of range
+NOT_NULL_COLUMNS = {'desired_price', 'is_avatar', 'request_count', 'unique_users'}
+
+
+def _schema(columns: list, types: dict) -> pa.Schema:
+    return pa.schema([
+        pa.field(column, types[column], nullable=column not in NOT_NULL_COLUMNS)
+        for column in columns
+    ])
+
+
+PROCESSED_SCHEMA = _schema(PROCESSED_COLUMNS, PROCESSED_TYPES)
+DASHBOARD_SCHEMA = _schema(DASHBOARD_COLUMNS, DASHBOARD_TYPES)
+
+
+def approximate_schema(quantile_columns: list) -> pa.Schema:
+    """
+    近似モードの需要メトリクス: DASHBOARD_SCHEMA の後に誤差の列と、
+    追加の分位点ごとに推定値とその誤差 (<列名>_error) の列
+    """
+    types = {**DASHBOARD_TYPES, **APPROXIMATE_TYPES}
+    columns = DASHBOARD_COLUMNS + list(APPROXIMATE_TYPES)
+    for column in quantile_columns:
+        types[column] = types[f"{column}_error"] = pa.float64()
+        columns += [column, f"{column}_error"]
+    return _schema(columns, types)
+
+
+PARQUET_COMPRESSION = 'zstd'
+
+# int64 has 19 digits, not all of which fit
+MAX_INT64_DIGITS = 18
+
+Rows = Union[pd.DataFrame, pa.Table]
+
+
+def _cast_column(column: pa.ChunkedArray, field: pa.Field) -> pa.ChunkedArray:
+    """
+    列を field の型に変換 (整数に収まらない値は null、null を許さない列は 0)
+    型に収まらずに置き換えた値があれば件数を表示する
+    """
+    target = field.type
+    missing = column.null_count
+    if pa.types.is_dictionary(target):
+        if not pa.types.is_dictionary(column.type):
+            column = pc.dictionary_encode(column.cast(target.value_type))
+        column = column.cast(target)
+    elif pa.types.is_integer(target):
+        if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+            too_long = pc.greater(pc.utf8_length(column), MAX_INT64_DIGITS)
+            column = pc.if_else(too_long, None, column).cast(pa.int64())
+        elif pa.types.is_boolean(column.type):
+            column = column.cast(pa.int8())
+        info = np.iinfo(target.to_pandas_dtype())
+        in_range = pc.and_(pc.greater_equal(column, info.min), pc.less_equal(column, info.max))
+        column = pc.if_else(in_range, column, None).cast(target, safe=False)
+        coerced = column.null_count - missing
+        if coerced:
+            replacement = 'null' if field.nullable else '0'
+            print(f"Warning: {coerced} {field.name} values do not fit {target}; set to {replacement}")
+    else:
+        column = column.cast(target)
+    if not field.nullable:
+        column = pc.fill_null(column, 0)
+    return column
+
+
+def conform_table(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """スキーマの列だけをその順序と型で返す (ない列は null)"""
+    missing = pa.chunked_array([pa.nulls(table.num_rows)])
+    columns = [
+        _cast_column(table[field.name] if field.name in table.column_names else missing, field)
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def typed_frame(table: pa.Table) -> pd.DataFrame:
+    """
+    型付きのテーブルを DataFrame に変換
+    辞書型は category、null を含みうる int64 (ID) は Int64 になる
+    """
+    return table.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+
+
+def conform_frame(df: pd.DataFrame, schema: pa.Schema) -> pd.DataFrame:
+    """conform_table の DataFrame 版"""
+    return typed_frame(conform_table(pa.Table.from_pandas(df, preserve_index=False), schema))
+
+
+def conform_rows(data: Rows, schema: pa.Schema) -> Rows:
+    """DataFrame / Arrow テーブルをそのままの形式でスキーマに合わせる"""
+    if isinstance(data, pa.Table):
+        return conform_table(data, schema)
+    return conform_frame(data, schema)
+
+
+def bytes_per_row(data: Rows) -> float:
+    """メモリ上の1行あたりのバイト数 (DataFrame は Python オブジェクトの分も含む)"""
+    if len(data) == 0:
+        return 0.0
+    if isinstance(data, pa.Table):
+        return data.nbytes / data.num_rows
+    return data.memory_usage(index=False, deep=True).sum() / len(data)
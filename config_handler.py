@@ -1,6 +1,7 @@
 import json
 from pathlib import Path
 
+
 def load_config(config_path: str = 'config.json') -> dict:
     """Load configuration from JSON file"""
     try:
@@ -19,4 +20,13 @@ def load_config(config_path: str = 'config.json') -> dict:
         return default_config
     except json.JSONDecodeError:
         print(f"Error: {config_path} is not a valid JSON file")
-        raise
\ No newline at end of file
+        raise
+
+
+def read_config(config_path: str = 'config.json') -> dict:
+    """Read configuration without creating a default file (empty if missing)"""
+    try:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
@@ -0,0 +1,109 @@
+"""
+Crawl frontier state
+Known item IDs come from master_item in booth_data.db, and pages whose items
+have been written are appended to a checkpoint file so an interrupted crawl
+resumes where it stopped
+"""
+
+import json
+import sqlite3
+from pathlib import Path
+from typing import List, Optional, Set
+
+from booth_db import DB_PATH
+from snapshot_manifest import atomic_write_bytes
+
+DEFAULT_CHECKPOINT_PATH = Path("data/state/crawl_checkpoint.jsonl")
+
+
+def load_known_items(db_path: Path = DB_PATH) -> Set[str]:
+    """master_item に登録済みの商品ID (テーブルがなければ空)"""
+    if not Path(db_path).exists():
+        return set()
+    conn = sqlite3.connect(db_path)
+    try:
+        return {str(row[0]) for row in conn.execute('SELECT item FROM master_item')}
+    except sqlite3.OperationalError:
+        return set()
+    finally:
+        conn.close()
+
+
+class CrawlCheckpoint:
+    """
+    追記型のチェックポイント (JSON Lines)
+    1行目がクロールの設定、以降は書き込み済みのページと最終ページ
+    書き込み途中で中断された行は読み込み時に無視する
+    """
+
+    def __init__(self, path: Path = DEFAULT_CHECKPOINT_PATH):
+        self.path = Path(path)
+        self.pages: Set[int] = set()
+        self.last_page: Optional[int] = None
+        self._file = None
+
+    def open(self, settings: dict) -> bool:
+        """
+        同じ設定のチェックポイントがあれば読み込んで再開する
+        再開した場合は True
+        """
+        records = self._load(settings)
+        resumed = records is not None
+        if not resumed:
+            self.pages = set()
+            self.last_page = None
+            records = [{'settings': settings}]
+
+        # Rewrite the valid records so a torn last line is not appended to.
+        # The rewrite goes through a temp file, so an interruption here leaves
+        # the previous checkpoint in place
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        atomic_write_bytes(self.path, data.encode('utf-8'))
+        self._file = open(self.path, 'a', encoding='utf-8')
+        return resumed
+
+    def _load(self, settings: dict) -> Optional[List[dict]]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.read().split('\n')
+        except FileNotFoundError:
+            return None
+
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+        if not records or records[0].get('settings') != settings:
+            return None
+
+        for record in records[1:]:
+            if 'page' in record:
+                self.pages.add(record['page'])
+            elif 'last_page' in record:
+                self.last_page = record['last_page']
+        return records
+
+    def _append(self, record: dict) -> None:
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def add_page(self, page: int) -> None:
+        self.pages.add(page)
+        self._append({'page': page})
+
+    def set_last_page(self, page: int) -> None:
+        self.last_page = page
+        self._append({'last_page': page})
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def clear(self) -> None:
+        """クロールが完了したらチェックポイントを削除"""
+        self.close()
+        self.path.unlink(missing_ok=True)
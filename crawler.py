@@ -0,0 +1,171 @@
+"""
+Asynchronous crawl engine
+asyncio schedules requests under a per-host token bucket, and one pooled
+keep-alive requests.Session performs them on worker threads, so the politeness
+rate is held without sleeping between serial requests
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from http_cache import CachedResponse, ResponseCache
+from http_retry import RETRY_STATUSES, retry_delay
+
+# Per-host politeness: 0.5 requests/s matches the former sleep(2) between pages
+DEFAULT_RATE = 0.5
+DEFAULT_BURST = 1
+DEFAULT_CONCURRENCY = 4
+# (connect, read) seconds
+DEFAULT_TIMEOUT = (5.0, 30.0)
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+
+
+class TokenBucket:
+    """rate 件/秒、最大 burst 件まで連続で許可するトークンバケット"""
+
+    def __init__(self, rate: float, burst: int = DEFAULT_BURST):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """トークンが1つ貯まるまで待つ (待機は到着順)"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class CrawlEngine:
+    """
+    プール済みの requests.Session を共有する非同期クローラー
+    - ホストごとのトークンバケットで送信レートを制限
+    - 同時リクエスト数は concurrency まで
+    - 429/5xx と通信エラーは指数バックオフで再試行 (Retry-After を優先)
+    - cache があれば新鮮なレスポンスはネットワークを使わずに返し、
+      期限切れのものは条件付きリクエストで再検証する
+    - offline の場合はキャッシュだけを使う (期限切れでも返す)
+    """
+
+    def __init__(self, headers: Optional[Dict[str, str]] = None,
+                 rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST,
+                 concurrency: int = DEFAULT_CONCURRENCY,
+                 timeout: Tuple[float, float] = DEFAULT_TIMEOUT,
+                 retries: int = DEFAULT_RETRIES, backoff: float = DEFAULT_BACKOFF,
+                 cache: Optional[ResponseCache] = None, offline: bool = False):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.timeout = tuple(timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+        self.offline = offline
+
+        self.session = requests.Session()
+        if headers:
+            self.session.headers.update(headers)
+        # Retries are handled here so that they also go through the rate limiter
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=concurrency, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='crawl')
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+    def _bucket(self, url: str) -> TokenBucket:
+        host = urlparse(url).netloc
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            bucket = self._buckets[host] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def _get(self, url: str, params: Optional[dict], key: Optional[str] = None,
+             entry: Optional[CachedResponse] = None) -> Tuple[int, Dict[str, str], str]:
+        """ワーカースレッドで実行 (本文のデコードとキャッシュの更新もここで行う)"""
+        headers = entry.validators() if entry is not None else None
+        response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+        if self.cache is not None:
+            if response.status_code == 304 and entry is not None:
+                self.cache.refresh(entry, response.headers)
+                return response.status_code, response.headers, entry.body
+            if response.status_code == 200:
+                self.cache.store(key, response.text, response.headers)
+        return response.status_code, response.headers, response.text
+
+    def _retry_delay(self, attempt: int, headers: Optional[Dict[str, str]] = None) -> float:
+        return retry_delay(attempt, self.backoff, headers)
+
+    async def fetch(self, url: str, params: Optional[dict] = None) -> Optional[str]:
+        """
+        URL の本文を取得
+        再試行しても取得できない場合や 4xx の場合は None
+        """
+        loop = asyncio.get_running_loop()
+
+        key = entry = None
+        if self.cache is not None:
+            key = self.cache.make_key(url, params)
+            entry = await loop.run_in_executor(self._executor, self.cache.get, key)
+            # Fresh hits skip the rate limiter as they never reach the host
+            if entry is not None and (self.offline or entry.is_fresh(self.cache.ttl)):
+                self.cache.stats['hits'] += 1
+                return entry.body
+        if self.offline:
+            print(f"{url} はキャッシュにありません (オフライン)")
+            return None
+
+        bucket = self._bucket(url)
+
+        for attempt in range(self.retries + 1):
+            await bucket.acquire()
+            headers = None
+            async with self._semaphore:
+                try:
+                    status, headers, text = await loop.run_in_executor(
+                        self._executor, self._get, url, params, key, entry
+                    )
+                except requests.RequestException as e:
+                    error = str(e)
+                else:
+                    if status < 400:
+                        return text
+                    if status not in RETRY_STATUSES:
+                        print(f"{url} の取得に失敗しました: HTTP {status}")
+                        return None
+                    error = f"HTTP {status}"
+
+            if attempt < self.retries:
+                delay = self._retry_delay(attempt, headers)
+                print(f"{url} の取得中にエラーが発生しました ({error})。{delay:.1f}秒後に再試行します")
+                await asyncio.sleep(delay)
+
+        print(f"{url} の取得を {self.retries + 1} 回試みましたが失敗しました: {error}")
+        return None
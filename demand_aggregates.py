@@ -0,0 +1,264 @@
+"""
+Mergeable per-pair state for the demand metrics
+Each (avatar_id, item_id) pair keeps sufficient statistics that can be folded
+together, so new batches and independently aggregated chunks combine without
+going back to the processed rows
+"""
+
+import io
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from column_mappings import DASHBOARD_COLUMNS
+from column_schema import DASHBOARD_SCHEMA, conform_frame, conform_table
+from snapshot_manifest import atomic_write_bytes
+
+KEYS = ['avatar_id', 'item_id']
+# Item IDs are integers (PROCESSED_SCHEMA); prices are summed in int64, and
+# user IDs are Arrow strings, a fraction of the size of Python objects once
+# the states of many chunks are merged
+STATE_TYPES = {
+    'avatar_id': 'int64',
+    'item_id': 'int64',
+    'twitter_id': 'string[pyarrow]',
+    'desired_price': 'int64',
+}
+
+PAIR_AGGREGATIONS = {
+    'request_count': 'sum',
+    'price_count': 'sum',
+    'price_sum': 'sum',
+    'min_price': 'min',
+    'max_price': 'max',
+}
+
+
+class DemandState:
+    """
+    Sufficient statistics per (avatar_id, item_id):
+    - pairs: request count, price count, sum, min and max
+    - users: distinct twitter_id set (exact unique_users)
+    - prices: price histogram (exact median and std)
+    """
+
+    def __init__(self, pairs: pd.DataFrame, users: pd.DataFrame, prices: pd.DataFrame):
+        self.pairs = pairs
+        self.users = users
+        self.prices = prices
+
+    @classmethod
+    def empty(cls) -> 'DemandState':
+        pairs = pd.DataFrame(
+            columns=KEYS + list(PAIR_AGGREGATIONS)
+        ).set_index(KEYS)
+        users = pd.DataFrame(columns=KEYS + ['twitter_id'])
+        prices = pd.DataFrame(columns=KEYS + ['desired_price', 'count'])
+        return cls(pairs, users, prices)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> 'DemandState':
+        """Aggregate processed rows (PROCESSED_COLUMNS) into a partial state"""
+        keyed = df[['avatar_item_id', 'item_item_id', 'twitter_id', 'desired_price']].rename(
+            columns={'avatar_item_id': 'avatar_id', 'item_item_id': 'item_id'}
+        )
+        # groupby drops pairs with a missing ID
+        keyed = keyed.dropna(subset=KEYS).astype(STATE_TYPES)
+
+        pairs = keyed.groupby(KEYS).agg(
+            request_count=('twitter_id', 'count'),
+            price_count=('desired_price', 'count'),
+            price_sum=('desired_price', 'sum'),
+            min_price=('desired_price', 'min'),
+            max_price=('desired_price', 'max'),
+        )
+        users = keyed[KEYS + ['twitter_id']].dropna().drop_duplicates(ignore_index=True)
+        prices = (
+            keyed.groupby(KEYS + ['desired_price']).size()
+            .rename('count').reset_index()
+        )
+        return cls(pairs, users, prices)
+
+    @classmethod
+    def merge_all(cls, states: Iterable['DemandState']) -> 'DemandState':
+        """Combine any number of partial states in one pass"""
+        # Empty states carry untyped columns that would upcast the result
+        states = [s for s in states if len(s.pairs)] or [cls.empty()]
+        if len(states) == 1:
+            return states[0]
+
+        pairs = (
+            pd.concat([s.pairs for s in states])
+            .groupby(level=KEYS).agg(PAIR_AGGREGATIONS)
+        )
+        users = pd.concat([s.users for s in states]).drop_duplicates(ignore_index=True)
+        prices = (
+            pd.concat([s.prices for s in states])
+            .groupby(KEYS + ['desired_price'], as_index=False)['count'].sum()
+        )
+        return cls(pairs, users, prices)
+
+    def merge(self, other: 'DemandState') -> 'DemandState':
+        return self.merge_all([self, other])
+
+    def to_metrics(self) -> pd.DataFrame:
+        """Finalize into DASHBOARD_COLUMNS, in the same order as the groupby result"""
+        pairs = self.pairs.sort_index()
+        count = pairs['price_count']
+
+        # Median and std come from the price histogram, sorted within each pair
+        prices = self.prices.sort_values(KEYS + ['desired_price'], ignore_index=True)
+        group_index = pd.MultiIndex.from_frame(prices[KEYS])
+        n = count.reindex(group_index).to_numpy()
+        mean = (pairs['price_sum'] / count).reindex(group_index).to_numpy()
+
+        end = prices.groupby(KEYS, sort=False)['count'].cumsum().to_numpy()
+        start = end - prices['count'].to_numpy()
+        lower = (n - 1) // 2
+        upper = n // 2
+        value = prices['desired_price'].to_numpy(dtype='float64')
+        is_lower = (start <= lower) & (lower < end)
+        is_upper = (start <= upper) & (upper < end)
+
+        deviations = prices[KEYS].assign(
+            lower=np.where(is_lower, value, 0.0),
+            upper=np.where(is_upper, value, 0.0),
+            sq_dev=prices['count'].to_numpy() * (value - mean) ** 2,
+        ).groupby(KEYS).sum()
+
+        unique_users = self.users.groupby(KEYS).size()
+
+        metrics = pd.DataFrame(index=pairs.index)
+        metrics['request_count'] = pairs['request_count'].astype('int64')
+        metrics['unique_users'] = unique_users.reindex(pairs.index, fill_value=0).astype('int64')
+        metrics['median_price'] = (deviations['lower'] + deviations['upper']) / 2
+        metrics['mean_price'] = pairs['price_sum'] / count
+        metrics['min_price'] = pairs['min_price']
+        metrics['max_price'] = pairs['max_price']
+        metrics['price_std'] = np.sqrt(deviations['sq_dev'] / (count - 1)).where(count > 1)
+        metrics['potential_sales'] = metrics['request_count'] * metrics['median_price']
+
+        metrics = metrics.reset_index()
+        return conform_frame(metrics[DASHBOARD_COLUMNS], DASHBOARD_SCHEMA)
+
+    def save(self, state_dir: Path) -> None:
+        state_dir = Path(state_dir)
+        state_dir.mkdir(parents=True, exist_ok=True)
+        for name, frame in (('pairs', self.pairs.reset_index()),
+                            ('users', self.users),
+                            ('prices', self.prices)):
+            buffer = io.BytesIO()
+            frame.to_parquet(buffer, index=False)
+            atomic_write_bytes(state_dir / f"{name}.parquet", buffer.getvalue())
+
+    @classmethod
+    def load(cls, state_dir: Path) -> Optional['DemandState']:
+        state_dir = Path(state_dir)
+        if not (state_dir / "pairs.parquet").exists():
+            return None
+
+        def read(name: str) -> pd.DataFrame:
+            # State saved before the typed schema has text IDs
+            frame = pd.read_parquet(state_dir / f"{name}.parquet")
+            return frame.astype({c: t for c, t in STATE_TYPES.items() if c in frame.columns})
+
+        return cls(read("pairs").set_index(KEYS), read("users"), read("prices"))
+
+
+def _group_sums(values: np.ndarray, starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    連続した行のグループごとの合計
+    pandas の groupby sum と同じ補正付き (Kahan) の加算を行の順に行うので、結果はビット単位で一致する
+    """
+    # Longest groups first, so the groups still running at step k are a prefix
+    order = np.argsort(-lengths, kind='stable')
+    group_starts = starts[order]
+    remaining = np.searchsorted(-lengths[order], -np.arange(lengths.max(initial=0)), side='left')
+    total = np.zeros(len(starts))
+    compensation = np.zeros(len(starts))
+    for k, m in enumerate(remaining):
+        y = values[group_starts[:m] + k] - compensation[:m]
+        t = total[:m] + y
+        compensation[:m] = t - total[:m] - y
+        total[:m] = t
+    result = np.empty_like(total)
+    result[order] = total
+    return result
+
+
+def demand_metrics_table(table: pa.Table) -> pa.Table:
+    """
+    DemandState.from_frame(df).to_metrics() for an Arrow table of processed rows
+    (the arrow engine): the same columns, types, values and row order, grouped
+    with pyarrow.compute and finished on numpy views of the sorted histogram
+    """
+    keyed = table.select(['avatar_item_id', 'item_item_id', 'twitter_id', 'desired_price'])
+    keyed = keyed.rename_columns(KEYS + ['twitter_id', 'desired_price'])
+    keyed = keyed.filter(pc.and_(pc.is_valid(keyed['avatar_id']), pc.is_valid(keyed['item_id'])))
+    keyed = keyed.set_column(3, 'desired_price', keyed['desired_price'].cast(pa.int64()))
+
+    # Sorted by key like the groupby result
+    pairs = keyed.group_by(KEYS).aggregate([
+        ('twitter_id', 'count'),
+        ('twitter_id', 'count_distinct'),
+        ('desired_price', 'count'),
+        ('desired_price', 'sum'),
+        ('desired_price', 'min'),
+        ('desired_price', 'max'),
+    ]).sort_by([(key, 'ascending') for key in KEYS])
+    prices = keyed.group_by(KEYS + ['desired_price']).aggregate([([], 'count_all')])
+    prices = prices.sort_by([(key, 'ascending') for key in KEYS + ['desired_price']])
+
+    # Each pair's histogram rows are contiguous and in the same order as pairs
+    hist_counts = prices['count_all'].to_numpy()
+    new_pair = np.zeros(len(prices), dtype=bool)
+    new_pair[:1] = True
+    for key in KEYS:
+        column = prices[key].combine_chunks()
+        new_pair[1:] |= pc.not_equal(column[1:], column[:-1]).to_numpy(zero_copy_only=False)
+    starts = np.flatnonzero(new_pair)
+    lengths = np.diff(np.append(starts, len(prices)))
+
+    count = pairs['desired_price_count'].to_numpy()
+    mean = pairs['desired_price_sum'].to_numpy() / count
+    n = np.repeat(count, lengths)
+    end = np.cumsum(hist_counts)
+    end -= np.repeat(end[starts] - hist_counts[starts], lengths)
+    start = end - hist_counts
+    lower = (n - 1) // 2
+    upper = n // 2
+    value = prices['desired_price'].to_numpy().astype('float64')
+    is_lower = (start <= lower) & (lower < end)
+    is_upper = (start <= upper) & (upper < end)
+
+    median = (_group_sums(np.where(is_lower, value, 0.0), starts, lengths)
+              + _group_sums(np.where(is_upper, value, 0.0), starts, lengths)) / 2
+    sq_dev = _group_sums(hist_counts * (value - np.repeat(mean, lengths)) ** 2, starts, lengths)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        price_std = np.sqrt(sq_dev / (count - 1))
+    request_count = pairs['twitter_id_count'].to_numpy()
+
+    return conform_table(pa.table({
+        'avatar_id': pairs['avatar_id'],
+        'item_id': pairs['item_id'],
+        'request_count': request_count,
+        'unique_users': pairs['twitter_id_count_distinct'],
+        'median_price': median,
+        'mean_price': mean,
+        'min_price': pairs['desired_price_min'],
+        'max_price': pairs['desired_price_max'],
+        'price_std': pa.array(price_std, mask=count <= 1),
+        'potential_sales': request_count * median,
+    }), DASHBOARD_SCHEMA)
+
+
+def aggregate_parallel(chunks: List[pd.DataFrame], max_workers: Optional[int] = None) -> DemandState:
+    """Aggregate independent chunks in worker processes and combine the results"""
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        states = list(executor.map(DemandState.from_frame, chunks))
+    return DemandState.merge_all(states)
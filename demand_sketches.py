@@ -0,0 +1,372 @@
+"""
+Approximate demand metrics from mergeable sketches
+DemandState keeps every distinct user and every distinct price of each
+(avatar_id, item_id) pair, so its size grows with the cardinality of the
+responses. SketchState keeps bounded, mergeable summaries instead:
+- unique_users: a HyperLogLog per pair (sparse registers, 64-bit hashes)
+- median_price and other quantiles: a log-bucketed price histogram
+  (DDSketch), whose quantiles are within a relative error alpha of the exact
+  ones and which merges exactly by adding bucket counts
+Counts, mean, min, max and std stay exact. Each estimated metric is published
+with its error bound in a <metric>_error column
+"""
+
+import io
+import json
+import math
+from pathlib import Path
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from column_schema import approximate_schema, conform_frame
+from demand_aggregates import KEYS, PAIR_AGGREGATIONS, STATE_TYPES
+from snapshot_manifest import atomic_write_bytes
+
+DEFAULT_USER_ERROR = 0.01
+DEFAULT_PRICE_ERROR = 0.01
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+HASH_BITS = 64
+# unique_users_error covers about 95% of the estimates (2 standard errors)
+USER_ERROR_SIGMAS = 2
+
+SKETCH_AGGREGATIONS = {**PAIR_AGGREGATIONS, 'price_sq_sum': 'sum'}
+
+
+class SketchParams(NamedTuple):
+    """
+    user_error: unique_users の相対標準誤差の上限 (HyperLogLog のレジスタ数を決める)
+    price_error: 価格の分位点の相対誤差 alpha
+    quantiles: median_price 以外に公開する分位点 (price_p25 など)
+    """
+    user_error: float = DEFAULT_USER_ERROR
+    price_error: float = DEFAULT_PRICE_ERROR
+    quantiles: Tuple[float, ...] = ()
+
+    @property
+    def precision(self) -> int:
+        """相対標準誤差 1.04/sqrt(m) が user_error 以下になる最小の p (m = 2^p)"""
+        needed = math.ceil(math.log2((1.04 / self.user_error) ** 2))
+        return min(max(needed, MIN_PRECISION), MAX_PRECISION)
+
+    @property
+    def registers(self) -> int:
+        return 1 << self.precision
+
+    @property
+    def user_std_error(self) -> float:
+        return 1.04 / math.sqrt(self.registers)
+
+    @property
+    def gamma(self) -> float:
+        return (1 + self.price_error) / (1 - self.price_error)
+
+    @property
+    def price_bound(self) -> float:
+        """推定値に対する誤差の比 (真の値の alpha 以内なら推定値の alpha/(1-alpha) 以内)"""
+        return self.price_error / (1 - self.price_error)
+
+    @property
+    def quantile_columns(self) -> list:
+        return [quantile_column(q) for q in self.quantiles]
+
+    def state_key(self) -> dict:
+        """保存した状態と併合できるかを決めるパラメータ"""
+        return {'precision': self.precision, 'price_error': self.price_error}
+
+
+def quantile_column(q: float) -> str:
+    return f"price_p{q * 100:g}"
+
+
+def sketch_params_from_config(config: dict) -> Optional[SketchParams]:
+    """
+    config.json の "approximate" (例: {"enabled": true, "user_error": 0.01,
+    "price_error": 0.01, "quantiles": [0.25, 0.75]})、無効の場合は None
+    """
+    approximate_config = config.get('approximate', {})
+    if not approximate_config.get('enabled', False):
+        return None
+    params = SketchParams(
+        user_error=float(approximate_config.get('user_error', DEFAULT_USER_ERROR)),
+        price_error=float(approximate_config.get('price_error', DEFAULT_PRICE_ERROR)),
+        quantiles=tuple(float(q) for q in approximate_config.get('quantiles', [])),
+    )
+    if not 0 < params.user_error < 1 or not 0 < params.price_error < 1:
+        raise ValueError("approximate: user_error and price_error must be between 0 and 1")
+    if any(not 0 <= q <= 1 for q in params.quantiles):
+        raise ValueError("approximate: quantiles must be between 0 and 1")
+    return params
+
+
+def _leading_zeros(words: np.ndarray) -> np.ndarray:
+    """uint64 の先頭のゼロビット数 (0 は 64)"""
+    words = words.copy()
+    zeros = np.zeros(len(words), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        empty = (words >> np.uint64(HASH_BITS - shift)) == 0
+        zeros += shift * empty
+        words = np.where(empty, words << np.uint64(shift), words)
+    return zeros + (words == 0)
+
+
+def _hll_registers(hashes: np.ndarray, precision: int) -> Tuple[np.ndarray, np.ndarray]:
+    """ハッシュ値の (レジスタ番号, 先頭の1の位置) (位置は 1..65-precision)"""
+    register = (hashes >> np.uint64(HASH_BITS - precision)).astype(np.uint16)
+    rest = hashes << np.uint64(precision)
+    rank = np.minimum(_leading_zeros(rest), HASH_BITS - precision) + 1
+    return register, rank.astype(np.int8)
+
+
+def _sigma(x: np.ndarray) -> np.ndarray:
+    """Ertl (2017) の改良推定の sigma (x = 空のレジスタの割合、1 は無限大)"""
+    full = x >= 1
+    x = np.where(full, 0.0, x)
+    y = 1.0
+    z = x.copy()
+    while True:
+        x = x * x
+        previous = z
+        z = z + x * y
+        y += y
+        if np.array_equal(z, previous):
+            break
+    return np.where(full, np.inf, z)
+
+
+def _tau(x: np.ndarray) -> np.ndarray:
+    """Ertl (2017) の改良推定の tau (x = 最大の位置に達していないレジスタの割合)"""
+    edge = (x <= 0) | (x >= 1)
+    x = np.where(edge, 0.5, x)
+    y = 1.0
+    z = 1 - x
+    while True:
+        x = np.sqrt(x)
+        previous = z
+        y *= 0.5
+        z = z - (1 - x) ** 2 * y
+        if np.array_equal(z, previous):
+            break
+    return np.where(edge, 0.0, z / 3)
+
+
+def _price_buckets(prices: np.ndarray, gamma: float) -> np.ndarray:
+    """価格のバケット: 0 以下は 0、x > 0 は gamma^(k-2) < x <= gamma^(k-1) の k"""
+    buckets = np.zeros(len(prices), dtype=np.int32)
+    positive = prices > 0
+    buckets[positive] = np.ceil(np.log(prices[positive]) / math.log(gamma)).astype(np.int32) + 1
+    return buckets
+
+
+def _bucket_values(buckets: np.ndarray, gamma: float) -> np.ndarray:
+    """バケットの代表値 (バケット内のどの価格とも相対誤差 alpha 以内)"""
+    values = 2 * np.power(gamma, buckets - 1.0) / (gamma + 1)
+    return np.where(buckets == 0, 0.0, values)
+
+
+class SketchState:
+    """
+    Mergeable sketches per (avatar_id, item_id):
+    - pairs: request count, price count, sum, sum of squares, min and max
+    - registers: non-zero HyperLogLog registers (register, rank) of the users
+    - buckets: price counts per log bucket
+    """
+
+    def __init__(self, params: SketchParams, pairs: pd.DataFrame,
+                 registers: pd.DataFrame, buckets: pd.DataFrame):
+        self.params = params
+        self.pairs = pairs
+        self.registers = registers
+        self.buckets = buckets
+
+    @classmethod
+    def empty(cls, params: SketchParams) -> 'SketchState':
+        # Built from no rows, so that every frame has its typed columns
+        rows = pd.DataFrame({
+            'avatar_item_id': pd.Series(dtype=STATE_TYPES['avatar_id']),
+            'item_item_id': pd.Series(dtype=STATE_TYPES['item_id']),
+            'twitter_id': pd.Series(dtype=STATE_TYPES['twitter_id']),
+            'desired_price': pd.Series(dtype=STATE_TYPES['desired_price']),
+        })
+        return cls.from_frame(rows, params)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, params: SketchParams) -> 'SketchState':
+        """処理済みの行 (PROCESSED_COLUMNS) をスケッチにまとめる"""
+        keyed = df[['avatar_item_id', 'item_item_id', 'twitter_id', 'desired_price']].rename(
+            columns={'avatar_item_id': 'avatar_id', 'item_item_id': 'item_id'}
+        )
+        keyed = keyed.dropna(subset=KEYS).astype(STATE_TYPES)
+        price = keyed['desired_price'].astype('float64')
+
+        pairs = keyed.assign(price_sq=price * price).groupby(KEYS).agg(
+            request_count=('twitter_id', 'count'),
+            price_count=('desired_price', 'count'),
+            price_sum=('desired_price', 'sum'),
+            min_price=('desired_price', 'min'),
+            max_price=('desired_price', 'max'),
+            price_sq_sum=('price_sq', 'sum'),
+        )
+
+        # The same ID hashes to the same value in every run and process.
+        # categorize=False gives the same hashes without factorizing the IDs first
+        users = keyed[KEYS + ['twitter_id']].dropna()
+        hashes = pd.util.hash_pandas_object(users['twitter_id'], index=False, categorize=False).to_numpy()
+        register, rank = _hll_registers(hashes, params.precision)
+        registers = (
+            users[KEYS].assign(register=register, rank=rank)
+            .groupby(KEYS + ['register'], as_index=False)['rank'].max()
+        )
+
+        prices = keyed.dropna(subset=['desired_price'])
+        buckets = (
+            prices[KEYS].assign(bucket=_price_buckets(prices['desired_price'].to_numpy(), params.gamma))
+            .groupby(KEYS + ['bucket']).size().rename('count').reset_index()
+        )
+        return cls(params, pairs, registers, buckets)
+
+    @classmethod
+    def merge_all(cls, states: Iterable['SketchState']) -> 'SketchState':
+        """同じパラメータの部分的なスケッチを一度にまとめる"""
+        states = list(states)
+        params = states[0].params
+        if any(s.params.state_key() != params.state_key() for s in states):
+            raise ValueError("Sketches with different precision or price_error cannot be merged")
+        # Empty states carry untyped columns that would upcast the result
+        states = [s for s in states if len(s.pairs)] or [cls.empty(params)]
+        if len(states) == 1:
+            return cls(params, states[0].pairs, states[0].registers, states[0].buckets)
+
+        pairs = (
+            pd.concat([s.pairs for s in states])
+            .groupby(level=KEYS).agg(SKETCH_AGGREGATIONS)
+        )
+        registers = (
+            pd.concat([s.registers for s in states])
+            .groupby(KEYS + ['register'], as_index=False)['rank'].max()
+        )
+        buckets = (
+            pd.concat([s.buckets for s in states])
+            .groupby(KEYS + ['bucket'], as_index=False)['count'].sum()
+        )
+        return cls(params, pairs, registers, buckets)
+
+    def merge(self, other: 'SketchState') -> 'SketchState':
+        return self.merge_all([self, other])
+
+    def unique_users(self) -> pd.Series:
+        """組み合わせごとの HyperLogLog の推定値 (Ertl 2017 の改良推定、補正表なし)"""
+        m = self.params.registers
+        q = HASH_BITS - self.params.precision
+        rank = self.registers['rank'].to_numpy().astype(np.int64)
+        grouped = self.registers[KEYS].assign(
+            nonzero=1,
+            inverse=np.where(rank <= q, np.ldexp(1.0, -np.minimum(rank, q)), 0.0),
+            top=(rank > q).astype(np.int64),
+        ).groupby(KEYS).sum().reindex(self.pairs.index, fill_value=0)
+
+        empty = m - grouped['nonzero'].to_numpy()
+        z = (grouped['inverse'].to_numpy()
+             + m * _tau(1 - grouped['top'].to_numpy() / m) * 2.0 ** -q
+             + m * _sigma(empty / m))
+        return pd.Series(m * m / (2 * math.log(2) * z), index=self.pairs.index)
+
+    def quantiles(self, qs: Iterable[float]) -> pd.DataFrame:
+        """
+        組み合わせごとの価格の分位点 (pandas と同じ線形補間)
+        バケットの代表値を各組み合わせの最小値と最大値の範囲に収める
+        """
+        pairs = self.pairs.sort_index()
+        buckets = self.buckets.sort_values(KEYS + ['bucket'], ignore_index=True)
+        group_index = pd.MultiIndex.from_frame(buckets[KEYS])
+        end = buckets.groupby(KEYS, sort=False)['count'].cumsum().to_numpy()
+        start = end - buckets['count'].to_numpy()
+        value = _bucket_values(buckets['bucket'].to_numpy(), self.params.gamma)
+
+        count = pairs['price_count'].astype('float64')
+        result = pd.DataFrame(index=pairs.index)
+        for q in qs:
+            # Ranks of the two values interpolated between, as in Series.quantile
+            position = q * (count - 1)
+            lower = np.floor(position)
+            upper = np.ceil(position)
+            row_lower = lower.reindex(group_index).to_numpy()
+            row_upper = upper.reindex(group_index).to_numpy()
+            picked = buckets[KEYS].assign(
+                lower=np.where((start <= row_lower) & (row_lower < end), value, 0.0),
+                upper=np.where((start <= row_upper) & (row_upper < end), value, 0.0),
+            ).groupby(KEYS).sum().reindex(pairs.index)
+            estimate = picked['lower'] + (picked['upper'] - picked['lower']) * (position - lower)
+            estimate = estimate.clip(pairs['min_price'].astype('float64'), pairs['max_price'].astype('float64'))
+            result[q] = estimate.where(pairs['price_count'] > 0)
+        return result
+
+    def to_metrics(self) -> pd.DataFrame:
+        """
+        DASHBOARD_COLUMNS (unique_users と分位点は推定値) と誤差の列
+        誤差は unique_users が標準誤差の2倍、価格の分位点が price_bound * 推定値
+        """
+        params = self.params
+        pairs = self.pairs.sort_index()
+        count = pairs['price_count']
+        bound = params.price_bound
+
+        quantiles = self.quantiles((0.5,) + params.quantiles)
+        estimate = self.unique_users().reindex(pairs.index)
+        unique_users = np.minimum(estimate.round(), pairs['request_count'])
+
+        metrics = pd.DataFrame(index=pairs.index)
+        metrics['request_count'] = pairs['request_count'].astype('int64')
+        metrics['unique_users'] = unique_users.astype('int64')
+        metrics['median_price'] = quantiles[0.5]
+        metrics['mean_price'] = pairs['price_sum'] / count
+        metrics['min_price'] = pairs['min_price']
+        metrics['max_price'] = pairs['max_price']
+        mean = metrics['mean_price']
+        # Sum of squared deviations from the exact moments, never negative
+        sq_dev = (pairs['price_sq_sum'] - count * mean * mean).clip(lower=0)
+        metrics['price_std'] = np.sqrt(sq_dev / (count - 1)).where(count > 1)
+        metrics['potential_sales'] = metrics['request_count'] * metrics['median_price']
+
+        metrics['unique_users_error'] = np.ceil(USER_ERROR_SIGMAS * params.user_std_error * unique_users)
+        metrics['median_price_error'] = bound * metrics['median_price']
+        metrics['potential_sales_error'] = metrics['request_count'] * metrics['median_price_error']
+        for q, column in zip(params.quantiles, params.quantile_columns):
+            metrics[column] = quantiles[q]
+            metrics[f"{column}_error"] = bound * quantiles[q]
+
+        schema = approximate_schema(params.quantile_columns)
+        return conform_frame(metrics.reset_index()[schema.names], schema)
+
+    def save(self, state_dir: Path) -> None:
+        state_dir = Path(state_dir)
+        state_dir.mkdir(parents=True, exist_ok=True)
+        for name, frame in (('pairs', self.pairs.reset_index()),
+                            ('registers', self.registers),
+                            ('buckets', self.buckets)):
+            buffer = io.BytesIO()
+            frame.to_parquet(buffer, index=False)
+            atomic_write_bytes(state_dir / f"{name}.parquet", buffer.getvalue())
+        atomic_write_bytes(state_dir / "sketch.json",
+                           json.dumps(self.params.state_key(), indent=2).encode('utf-8'))
+
+    @classmethod
+    def load(cls, state_dir: Path, params: SketchParams) -> Optional['SketchState']:
+        """
+        保存したスケッチを読み込む
+        ない場合や precision / price_error が変わった場合は None (処理済みの行から作り直す)
+        """
+        state_dir = Path(state_dir)
+        try:
+            saved = json.loads((state_dir / "sketch.json").read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            return None
+        if saved != params.state_key() or not (state_dir / "pairs.parquet").exists():
+            return None
+
+        pairs = pd.read_parquet(state_dir / "pairs.parquet").set_index(KEYS)
+        registers = pd.read_parquet(state_dir / "registers.parquet")
+        buckets = pd.read_parquet(state_dir / "buckets.parquet")
+        return cls(params, pairs, registers, buckets)
@@ -0,0 +1,129 @@
+"""
+Content fingerprints of the pipeline stages
+Each stage hashes its input (the Sheets payload, the processed frame, the
+demand metrics) and compares it with the fingerprint of the last published
+run, so an unchanged sheet stops the pipeline before any processing or writes.
+The settings that change the output (engine, approximate-mode parameters) are
+folded into every fingerprint, so changing them reruns the stages.
+Fingerprints are committed only once the whole run has succeeded
+"""
+
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+
+from snapshot_manifest import atomic_write_bytes
+
+
+def frame_fingerprint(df: pd.DataFrame) -> str:
+    """列名・型・値 (行順を含む) の SHA-256"""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([[str(c), str(t)] for c, t in df.dtypes.items()]).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+class TableHasher:
+    """
+    Arrow テーブルの列名・型・値 (行順を含む) の SHA-256 を、行を分けて渡されても
+    同じ値になるように計算する
+    チャンクの分かれ方に依らないよう、一定の行数ごとに新しいバッファにまとめた
+    レコードバッチの IPC 形式をハッシュする
+    辞書型の列は値に戻してからハッシュする (IPC のバッチには辞書が含まれない)
+    """
+
+    def __init__(self, schema: pa.Schema, batch_rows: int = 65536):
+        self.schema = schema
+        self.batch_rows = batch_rows
+        self._digest = hashlib.sha256(schema.serialize())
+        # Rows short of a full batch, carried over to the next update
+        self._pending = schema.empty_table()
+
+    def _serialize(self, part: pa.Table) -> bytes:
+        arrays = []
+        for column in part.columns:
+            array = pa.concat_arrays(column.chunks)
+            if pa.types.is_dictionary(array.type):
+                array = array.dictionary_decode()
+            arrays.append(array)
+        return pa.RecordBatch.from_arrays(arrays, names=self.schema.names).serialize()
+
+    def update(self, table: pa.Table) -> None:
+        """schema と同じスキーマの行を続けて追加"""
+        pending = pa.concat_tables([self._pending, table])
+        full = pending.num_rows - pending.num_rows % self.batch_rows
+        for start in range(0, full, self.batch_rows):
+            self._digest.update(self._serialize(pending.slice(start, self.batch_rows)))
+        self._pending = pending.slice(full)
+
+    def hexdigest(self) -> str:
+        digest = self._digest.copy()
+        if self._pending.num_rows:
+            digest.update(self._serialize(self._pending))
+        return digest.hexdigest()
+
+
+def table_fingerprint(table: pa.Table, batch_rows: int = 65536) -> str:
+    """Arrow テーブルの列名・型・値 (行順を含む) の SHA-256 (TableHasher)"""
+    hasher = TableHasher(table.schema, batch_rows)
+    hasher.update(table)
+    return hasher.hexdigest()
+
+
+def data_fingerprint(data: Union[pd.DataFrame, pa.Table]) -> str:
+    """DataFrame / Arrow テーブルのフィンガープリント"""
+    if isinstance(data, pa.Table):
+        return table_fingerprint(data)
+    return frame_fingerprint(data)
+
+
+class FingerprintStore:
+    """
+    最後に公開した実行のステージごとのフィンガープリント (JSON)
+    settings は出力に影響する設定で、各ステージのフィンガープリントに含める
+    """
+
+    def __init__(self, path: Path, settings: Optional[dict] = None):
+        self.path = Path(path)
+        self.settings = json.dumps(settings or {}, sort_keys=True)
+        self._published = self._load()
+        self._pending: Dict[str, str] = {}
+
+    def _with_settings(self, fingerprint: str) -> str:
+        return hashlib.sha256(f"{self.settings}\n{fingerprint}".encode('utf-8')).hexdigest()
+
+    def _load(self) -> Dict[str, str]:
+        try:
+            return json.loads(self.path.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            return {}
+
+    def matches(self, stage: str, fingerprint: Optional[str]) -> bool:
+        """前回公開した実行と同じ入力・設定か"""
+        return fingerprint is not None and self._published.get(stage) == self._with_settings(fingerprint)
+
+    def unchanged(self, stage: str) -> bool:
+        """今回記録したフィンガープリントが前回公開した実行と同じか"""
+        return self._pending.get(stage) is not None and \
+            self._published.get(stage) == self._pending[stage]
+
+    def record(self, stage: str, fingerprint: str) -> None:
+        """今回の実行のフィンガープリント (設定を含めて記録し、commit するまで保存しない)"""
+        self._pending[stage] = self._with_settings(fingerprint)
+
+    def commit(self) -> None:
+        """実行が成功したら記録したフィンガープリントを保存"""
+        if not self._pending:
+            return
+        self._published.update(self._pending)
+        self._pending = {}
+        atomic_write_bytes(self.path, json.dumps(self._published, indent=2).encode('utf-8'))
+
+    def clear(self) -> None:
+        self._published = {}
+        self._pending = {}
+        self.path.unlink(missing_ok=True)
@@ -0,0 +1,148 @@
+"""
+Persistent HTTP response cache for the crawler
+Bodies are kept in SQLite with their ETag / Last-Modified, served directly
+while fresh, revalidated with conditional requests once the TTL has passed,
+and evicted least-recently-used first when the cache exceeds its size limit
+"""
+
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional
+
+import requests
+
+DEFAULT_CACHE_PATH = Path("data/cache/http_cache.db")
+DEFAULT_TTL = 600
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class CachedResponse(NamedTuple):
+    key: str
+    body: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    stored_at: float
+
+    def is_fresh(self, ttl: float) -> bool:
+        return time.time() - self.stored_at < ttl
+
+    def validators(self) -> Dict[str, str]:
+        """条件付きリクエストのヘッダー"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    URL とクエリパラメータをキーにしたレスポンスキャッシュ
+    ワーカースレッドから呼ばれるため、接続はロックで保護する
+    """
+
+    def __init__(self, path: Path = DEFAULT_CACHE_PATH, ttl: float = DEFAULT_TTL,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'revalidated': 0, 'stored': 0, 'evicted': 0}
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                size INTEGER NOT NULL
+            )
+        ''')
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_responses_accessed_at ON responses(accessed_at)'
+        )
+        self._conn.commit()
+        self._total_bytes = self._conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses'
+        ).fetchone()[0]
+
+    @staticmethod
+    def make_key(url: str, params: Optional[dict] = None) -> str:
+        """requests と同じ方法でエンコードしたURL (パラメータはキー順)"""
+        if params:
+            params = sorted(params.items())
+        return requests.Request('GET', url, params=params).prepare().url
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT body, etag, last_modified, stored_at FROM responses WHERE key = ?',
+                (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                'UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key)
+            )
+            self._conn.commit()
+        body, etag, last_modified, stored_at = row
+        return CachedResponse(key, zlib.decompress(body).decode('utf-8'), etag, last_modified, stored_at)
+
+    def store(self, key: str, body: str, headers) -> None:
+        """200 のレスポンスを保存し、上限を超えた分を古い順に削除"""
+        data = zlib.compress(body.encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            previous = self._conn.execute(
+                'SELECT size FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, data, headers.get('ETag'), headers.get('Last-Modified'), now, now, len(data))
+            )
+            self._total_bytes += len(data) - (previous[0] if previous else 0)
+            self.stats['stored'] += 1
+            self._evict()
+            self._conn.commit()
+
+    def refresh(self, entry: CachedResponse, headers) -> None:
+        """304 を受けたエントリの鮮度を更新 (新しいバリデータがあれば置き換え)"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'UPDATE responses SET etag = ?, last_modified = ?, stored_at = ?, accessed_at = ? '
+                'WHERE key = ?',
+                (headers.get('ETag', entry.etag), headers.get('Last-Modified', entry.last_modified),
+                 now, now, entry.key)
+            )
+            self._conn.commit()
+            self.stats['revalidated'] += 1
+
+    def _evict(self) -> None:
+        """LRU: 最後に参照された時刻が古いものから削除"""
+        if self._total_bytes <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            'SELECT key, size FROM responses ORDER BY accessed_at'
+        )
+        victims = []
+        for key, size in rows:
+            if self._total_bytes <= self.max_bytes:
+                break
+            victims.append((key,))
+            self._total_bytes -= size
+        self._conn.executemany('DELETE FROM responses WHERE key = ?', victims)
+        self.stats['evicted'] += len(victims)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
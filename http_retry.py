@@ -0,0 +1,27 @@
+"""
+Retry policy shared by the HTTP clients (crawler, sheets_client)
+Which statuses are retried, how long a Retry-After may make a client wait,
+and the jittered exponential backoff used otherwise
+"""
+
+import random
+from typing import Dict, Optional
+
+MAX_RETRY_AFTER = 60.0
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def retry_delay(attempt: int, backoff: float, headers: Optional[Dict[str, str]] = None) -> float:
+    """
+    attempt 回目の再試行までの待ち時間 (秒)
+    Retry-After があればそれに従い (MAX_RETRY_AFTER まで)、なければ full jitter の指数バックオフ
+    """
+    retry_after = (headers or {}).get('Retry-After')
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), MAX_RETRY_AFTER)
+        except ValueError:
+            pass
+    # Full jitter keeps retrying workers from hitting the host in lockstep
+    return random.uniform(0, backoff * 2 ** attempt)
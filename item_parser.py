@@ -0,0 +1,126 @@
+"""
+Parser backends for Booth browse pages
+Every backend returns the same list of {'url', 'title', 'price'} dicts. The
+lxml backend evaluates precompiled XPath class selectors instead of building a
+BeautifulSoup tree, and parse_items is a plain function so it can run in a
+process pool
+"""
+
+from typing import Callable, Dict, List
+from urllib.parse import urljoin
+
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.etree
+    import lxml.html
+except ImportError:  # lxml is optional; html.parser is always available
+    lxml = None
+
+BASE_URL = 'https://booth.pm'
+
+
+def _parse_price(price_text: str) -> int:
+    return int(''.join(filter(str.isdigit, price_text)) or 0)
+
+
+def parse_items_bs4(html_content: str) -> List[dict]:
+    """BeautifulSoup (html.parser) による解析"""
+    soup = BeautifulSoup(html_content, 'html.parser')
+    items = []
+
+    # 商品カードを検索
+    for item in soup.select('.item-card'):
+        try:
+            # 商品リンクを取得
+            link_elem = item.select_one('.item-card-url')
+            if not link_elem:
+                continue
+
+            # 価格を取得
+            price_elem = item.select_one('.price')
+            price_text = price_elem.text.strip() if price_elem else '0'
+            price = _parse_price(price_text)
+
+            # タイトルを取得
+            title_elem = item.select_one('.item-card-title')
+            title = title_elem.text.strip() if title_elem else 'No Title'
+
+            # 商品情報を格納
+            items.append({
+                'url': urljoin(BASE_URL, link_elem['href']),
+                'title': title,
+                'price': price
+            })
+
+        except Exception as e:
+            print(f"商品情報の抽出中にエラーが発生しました: {e}")
+            continue
+
+    return items
+
+
+def _class_xpath(class_name: str, descendant: bool = False) -> str:
+    """CSS の .class と同じ条件 (空白区切りのトークンに一致) の XPath"""
+    prefix = './/*' if descendant else '//*'
+    return (f"{prefix}[contains(concat(' ', normalize-space(@class), ' '), "
+            f"' {class_name} ')]")
+
+
+if lxml is not None:
+    _ITEM_CARDS = lxml.etree.XPath(_class_xpath('item-card'))
+    _LINKS = lxml.etree.XPath(_class_xpath('item-card-url', descendant=True))
+    _PRICES = lxml.etree.XPath(_class_xpath('price', descendant=True))
+    _TITLES = lxml.etree.XPath(_class_xpath('item-card-title', descendant=True))
+
+
+def parse_items_lxml(html_content: str) -> List[dict]:
+    """lxml とコンパイル済み XPath による解析 (parse_items_bs4 と同じ結果)"""
+    root = lxml.html.document_fromstring(html_content)
+    items = []
+
+    for item in _ITEM_CARDS(root):
+        try:
+            links = _LINKS(item)
+            if not links:
+                continue
+            href = links[0].get('href')
+            if href is None:
+                raise KeyError('href')
+
+            prices = _PRICES(item)
+            price_text = prices[0].text_content().strip() if prices else '0'
+            price = _parse_price(price_text)
+
+            titles = _TITLES(item)
+            title = titles[0].text_content().strip() if titles else 'No Title'
+
+            items.append({
+                'url': urljoin(BASE_URL, href),
+                'title': title,
+                'price': price
+            })
+
+        except Exception as e:
+            print(f"商品情報の抽出中にエラーが発生しました: {e}")
+            continue
+
+    return items
+
+
+PARSER_BACKENDS: Dict[str, Callable[[str], List[dict]]] = {'html.parser': parse_items_bs4}
+if lxml is not None:
+    PARSER_BACKENDS['lxml'] = parse_items_lxml
+
+DEFAULT_BACKEND = 'lxml' if lxml is not None else 'html.parser'
+
+
+def parse_items(html_content: str, backend: str = DEFAULT_BACKEND) -> List[dict]:
+    """ページから商品情報を抽出"""
+    if not html_content:
+        return []
+    try:
+        parser = PARSER_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"parser must be one of {', '.join(PARSER_BACKENDS)}")
+    return parser(html_content)
@@ -0,0 +1,110 @@
+"""
+Streaming persistence for crawled items
+Items are buffered and written per batch, as one transaction of bulk upserts
+into master_item and optionally as a part file of an append-only parquet
+dataset, so memory stays flat however many pages are crawled
+"""
+
+import io
+import re
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import pandas as pd
+
+from booth_db import DB_PATH, connect
+from snapshot_manifest import atomic_write_bytes
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_DATASET_DIR = Path("results/booth_items")
+
+SHOP_URL_PATTERN = re.compile(r'^https?://([a-z0-9-]+)\.booth\.pm/', re.IGNORECASE)
+ITEM_URL_PATTERN = re.compile(r'/items/(\d+)')
+
+# The avatar flag comes from the form data, so a crawl never overwrites it
+UPSERT_ITEM_SQL = '''
+    INSERT INTO master_item (shop, item) VALUES (?, ?)
+    ON CONFLICT (shop, item) DO UPDATE SET updated_at = CURRENT_TIMESTAMP
+'''
+
+
+def item_key(url: str) -> Tuple[str, Optional[str]]:
+    """
+    商品URLから (shop, item) を取得
+    booth.pm/{lang}/items/{id} 形式のURLにはショップがないので空文字
+    """
+    shop = SHOP_URL_PATTERN.match(url)
+    item = ITEM_URL_PATTERN.search(url)
+    return (shop.group(1) if shop else '', item.group(1) if item else None)
+
+
+class ItemWriter:
+    """
+    商品情報をバッチごとに master_item へ書き込む (WALモード、1バッチ1トランザクション)
+    dataset_dir があれば同じバッチを parquet のパートファイルとして追記する
+    ワーカースレッドから呼ばれるため、書き込みはロックで直列化する
+    """
+
+    def __init__(self, db_path: Path = DB_PATH, dataset_dir: Optional[Path] = DEFAULT_DATASET_DIR,
+                 batch_size: int = DEFAULT_BATCH_SIZE):
+        self.db_path = Path(db_path)
+        self.dataset_dir = Path(dataset_dir) if dataset_dir else None
+        self.batch_size = batch_size
+        self.written = 0
+
+        self._lock = threading.Lock()
+        self._buffer: List[dict] = []
+        self._pending_pages: List[int] = []
+
+        self._conn = connect(self.db_path, check_same_thread=False)
+        if self.dataset_dir:
+            self.dataset_dir.mkdir(parents=True, exist_ok=True)
+
+    def add_page(self, page: int, items: List[dict]) -> List[int]:
+        """
+        ページの商品をバッファに追加
+        バッチを書き込んだ場合は、書き込みが完了したページ番号を返す
+        """
+        with self._lock:
+            crawled_at = datetime.now().isoformat()
+            self._buffer.extend(dict(item, page=page, crawled_at=crawled_at) for item in items)
+            self._pending_pages.append(page)
+            if len(self._buffer) >= self.batch_size:
+                return self._flush()
+            return []
+
+    def flush(self) -> List[int]:
+        """残りのバッファを書き込む"""
+        with self._lock:
+            return self._flush()
+
+    def _flush(self) -> List[int]:
+        pages, self._pending_pages = self._pending_pages, []
+        rows, self._buffer = self._buffer, []
+        if not rows:
+            return pages
+
+        keys = [item_key(row['url']) for row in rows]
+        with self._conn:
+            self._conn.executemany(
+                UPSERT_ITEM_SQL, [key for key in keys if key[1] is not None]
+            )
+
+        if self.dataset_dir:
+            df = pd.DataFrame(rows, columns=['page', 'url', 'title', 'price', 'crawled_at'])
+            df['shop'] = [shop for shop, _ in keys]
+            df['item_id'] = [item for _, item in keys]
+            buffer = io.BytesIO()
+            df.to_parquet(buffer, index=False)
+            part = f"part_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.parquet"
+            atomic_write_bytes(self.dataset_dir / part, buffer.getvalue())
+
+        self.written += len(rows)
+        return pages
+
+    def close(self) -> List[int]:
+        pages = self.flush()
+        self._conn.close()
+        return pages
@@ -0,0 +1,180 @@
+"""
+Bulk storage of processed form responses in master_matching
+Each batch is loaded into a temp staging table with executemany and merged in
+one INSERT ... SELECT upsert, in key order, inside a single transaction.
+Repeated (avatar, item, userid) submissions are collapsed by the primary key
+with the latest price winning. A full run also records the keys it wrote, so
+rows that have since been removed from the sheet can be deleted at the end
+"""
+
+from pathlib import Path
+from typing import List, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from booth_db import DB_PATH, connect, refresh_demand_metrics
+
+DEFAULT_BATCH_SIZE = 250_000
+
+# Page cache for the bulk merge (negative = KiB); the default 2 MB makes every
+# index update past the first few thousand rows a disk read
+BULK_CACHE_SIZE = -256 * 1024
+
+STAGING_SCHEMA = '''
+    CREATE TEMP TABLE IF NOT EXISTS matching_staging (
+        avatar TEXT,
+        item TEXT,
+        userid TEXT,
+        price INTEGER
+    )
+'''
+
+# Keys written by the current full run. A regular table rather than a temp
+# one, since a chunked run upserts over several connections
+RUN_KEYS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS matching_run_keys (
+        avatar TEXT,
+        item TEXT,
+        userid TEXT,
+        PRIMARY KEY (avatar, item, userid)
+    ) WITHOUT ROWID
+'''
+
+RECORD_RUN_KEYS_SQL = '''
+    INSERT OR IGNORE INTO matching_run_keys
+    SELECT avatar, item, userid FROM matching_staging
+    ORDER BY avatar, item, userid
+'''
+
+# The delete trigger marks the pairs that lose rows for the refresh
+PRUNE_MATCHING_SQL = '''
+    DELETE FROM master_matching
+    WHERE NOT EXISTS (
+        SELECT 1 FROM matching_run_keys k
+        WHERE k.avatar = master_matching.avatar
+          AND k.item = master_matching.item
+          AND k.userid = master_matching.userid
+    )
+'''
+
+# Key order makes the B-tree inserts sequential, and rowid keeps the latest of
+# several submissions last. Unchanged rows are left alone so updated_at only
+# moves on a real change ("WHERE true" is required by the upsert grammar)
+MERGE_MATCHING_SQL = '''
+    INSERT INTO master_matching (avatar, item, userid, price)
+    SELECT avatar, item, userid, price FROM matching_staging WHERE true
+    ORDER BY avatar, item, userid, rowid
+    ON CONFLICT (avatar, item, userid) DO UPDATE SET
+        price = excluded.price,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE price IS NOT excluded.price
+'''
+
+
+def matching_rows(df: Union[pd.DataFrame, pa.Table]) -> List[tuple]:
+    """
+    処理済みの行 (PROCESSED_COLUMNS) を master_matching の行に変換 (提出順のまま)
+    アバターか衣装のIDがない行は除き、twitter_id がない場合は空文字
+    """
+    columns = ['avatar_item_id', 'item_item_id', 'twitter_id', 'desired_price']
+    if isinstance(df, pd.DataFrame):
+        table = pa.Table.from_pandas(df[columns], preserve_index=False)
+    else:
+        table = df.select(columns)
+    keyed = table.filter(pc.and_(pc.is_valid(table['avatar_item_id']), pc.is_valid(table['item_item_id'])))
+    userid = pc.fill_null(keyed['twitter_id'].cast(pa.string()), '')
+    price = pc.fill_null(keyed['desired_price'].cast(pa.int64()), 0)
+    return list(zip(keyed['avatar_item_id'].cast(pa.string()).to_pylist(),
+                    keyed['item_item_id'].cast(pa.string()).to_pylist(),
+                    userid.to_pylist(), price.to_pylist()))
+
+
+class MatchingStore:
+    """master_matching への一括書き込み"""
+
+    def __init__(self, db_path: Path = DB_PATH, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.db_path = Path(db_path)
+        self.batch_size = batch_size
+
+    def upsert(self, df: Union[pd.DataFrame, pa.Table], refresh: bool = True,
+               full_run: bool = False) -> int:
+        """
+        行をまとめて upsert し、書き込んだ行数を返す
+        batch_size 行ごとに1トランザクション、最後に demand_metrics を更新
+        (refresh=False の場合は更新せず、後で refresh_metrics を呼ぶ)
+        full_run=True の場合はキーを記録し、begin_full_run から prune までの間に
+        書き込まれなかった行を prune で削除できるようにする
+        """
+        rows = matching_rows(df)
+        conn = connect(self.db_path)
+        try:
+            conn.execute(f'PRAGMA cache_size={BULK_CACHE_SIZE}')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            conn.execute(STAGING_SCHEMA)
+            if full_run:
+                conn.execute(RUN_KEYS_SCHEMA)
+            for start in range(0, len(rows), self.batch_size):
+                with conn:
+                    conn.executemany(
+                        'INSERT INTO matching_staging VALUES (?, ?, ?, ?)',
+                        rows[start:start + self.batch_size]
+                    )
+                    conn.execute(MERGE_MATCHING_SQL)
+                    if full_run:
+                        conn.execute(RECORD_RUN_KEYS_SQL)
+                    conn.execute('DELETE FROM matching_staging')
+            # Pairs touched by the batches were marked by the triggers
+            if refresh:
+                with conn:
+                    refresh_demand_metrics(conn)
+        finally:
+            conn.close()
+        return len(rows)
+
+    def begin_full_run(self) -> None:
+        """全件を書き込む実行の開始 (前回の実行で記録したキーを消す)"""
+        conn = connect(self.db_path)
+        try:
+            with conn:
+                conn.execute(RUN_KEYS_SCHEMA)
+                conn.execute('DELETE FROM matching_run_keys')
+        finally:
+            conn.close()
+
+    def prune(self, refresh: bool = True) -> int:
+        """
+        begin_full_run 以降の upsert(full_run=True) で書き込まれなかった行
+        (スプレッドシートから削除された回答) を削除し、削除した行数を返す
+        """
+        conn = connect(self.db_path)
+        try:
+            with conn:
+                conn.execute(RUN_KEYS_SCHEMA)
+                removed = conn.execute(PRUNE_MATCHING_SQL).rowcount
+                conn.execute('DELETE FROM matching_run_keys')
+                if refresh:
+                    refresh_demand_metrics(conn)
+        finally:
+            conn.close()
+        return removed
+
+    def refresh_metrics(self) -> None:
+        """refresh=False の upsert で変更された組み合わせの demand_metrics を更新"""
+        conn = connect(self.db_path)
+        try:
+            with conn:
+                refresh_demand_metrics(conn)
+        finally:
+            conn.close()
+
+    def clear(self) -> None:
+        """スプレッドシートが書き換えられた場合に全件を削除"""
+        conn = connect(self.db_path)
+        try:
+            with conn:
+                conn.execute('DELETE FROM master_matching')
+                refresh_demand_metrics(conn)
+        finally:
+            conn.close()
@@ -0,0 +1,339 @@
+"""
+Shared in-memory cache for the latest demand metrics snapshot
+The snapshot is kept sorted and pre-encoded as JSON bytes so that API requests
+only have to write the cached body
+"""
+
+import gzip
+import hashlib
+import json
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+from metrics_query import MetricsTable, QueryError
+from snapshot_manifest import MANIFEST_NAME, read_manifest
+
+DASHBOARD_DIR = Path("data/dashboard")
+SNAPSHOT_PATTERN = "demand_metrics_*.parquet"
+
+# Clients must revalidate, which is cheap with the ETag
+CACHE_CONTROL = "no-cache"
+
+ARROW_STREAM_TYPE = "application/vnd.apache.arrow.stream"
+
+# Values per json.dumps call when encoding a full snapshot. The C encoder holds
+# the GIL for a whole call, so one call over a large snapshot would stall every
+# other thread (and the FastAPI event loop) until it returns
+ENCODE_SLICE_ROWS = 10_000
+
+# Response formats for the full snapshot and their content types
+FORMAT_CONTENT_TYPES = {
+    'rows': "application/json",
+    'columns': "application/json",
+    'arrow': ARROW_STREAM_TYPE,
+}
+
+
+def choose_format(accept: Optional[str], fmt: Optional[str] = None) -> str:
+    """
+    ?format= (rows / columns / arrow) または Accept から応答形式を選ぶ
+    既定は従来の行形式JSON
+    """
+    if fmt is not None:
+        if fmt not in FORMAT_CONTENT_TYPES:
+            raise QueryError(f"format must be one of {', '.join(FORMAT_CONTENT_TYPES)}")
+        return fmt
+    if accept and ARROW_STREAM_TYPE in accept:
+        return 'arrow'
+    return 'rows'
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> str:
+    """Accept-Encoding から br > gzip > identity の順で選ぶ"""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = q
+
+    def ok(coding):
+        return accepted.get(coding, accepted.get('*', 0.0)) > 0
+
+    if brotli is not None and ok('br'):
+        return 'br'
+    if ok('gzip'):
+        return 'gzip'
+    return 'identity'
+
+
+def dumps_list(values: list) -> str:
+    """json.dumps(values, ensure_ascii=False) と同じ文字列 (ENCODE_SLICE_ROWS 件ずつエンコード)"""
+    return '[' + ', '.join(
+        json.dumps(values[start:start + ENCODE_SLICE_ROWS], ensure_ascii=False)[1:-1]
+        for start in range(0, len(values), ENCODE_SLICE_ROWS)
+    ) + ']'
+
+
+def query_digest(query: dict) -> str:
+    """検証済みクエリ (parse_query の結果) を正規化したダイジェスト"""
+    canonical = json.dumps(query, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:16]
+
+
+class MetricsSnapshot:
+    """ソート・エンコード済みの需要メトリクススナップショット"""
+
+    def __init__(self, path: Path, key: tuple, df: pd.DataFrame, timestamp: float,
+                 table=None):
+        """table: ページング用のクエリ元 (既定は df から作る MetricsTable)"""
+        self.path = path
+        self.key = key
+        self.df = df
+        self.timestamp = timestamp
+        self.filename = path.name
+        self.body = self.encode(df, timestamp, path.name)
+        self.table = table if table is not None else MetricsTable(df)
+        self.etag_base = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:32]
+        # Version of the snapshot for clients (pages of the same version fit together)
+        self.version = self.etag_base
+        self._bodies: Dict[str, bytes] = {'rows': self.body}
+        self._compressed: Dict[tuple, bytes] = {}
+        self._variant_lock = threading.Lock()
+
+    def etag(self, encoding: str = 'identity', fmt: str = 'rows',
+             query: Optional[dict] = None) -> str:
+        """
+        スナップショットの版・形式・エンコーディング・クエリごとの強いETag
+        ページング・フィルタ済みのレスポンスは全件とも他のクエリとも別のETagになる
+        """
+        suffix = ''.join(f'-{part}' for part in (fmt, encoding) if part not in ('rows', 'identity'))
+        if query is not None:
+            suffix += f'-q{query_digest(query)}'
+        return f'"{self.etag_base}{suffix}"'
+
+    def matches(self, if_none_match: Optional[str], fmt: str = 'rows',
+                query: Optional[dict] = None) -> bool:
+        """If-None-Match がこの形式・クエリのいずれかのETagと一致するか"""
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+        return any(self.etag(encoding, fmt, query) in tags for encoding in ('identity', 'gzip', 'br'))
+
+    def format_body(self, fmt: str) -> bytes:
+        """形式ごとの全件ボディ (スナップショットごとに1回だけ生成)"""
+        body = self._bodies.get(fmt)
+        if body is None:
+            with self._variant_lock:
+                body = self._bodies.get(fmt)
+                if body is None:
+                    if fmt == 'arrow' and self.path.suffix == '.parquet':
+                        body = self.encode_arrow(self.path)
+                    elif fmt == 'arrow':
+                        body = self.encode_arrow_frame(self.df)
+                    else:
+                        body = self.encode_columns(self.df, self.timestamp, self.filename)
+                    self._bodies[fmt] = body
+        return body
+
+    def cached_body(self, encoding: str, fmt: str = 'rows') -> Optional[bytes]:
+        """生成済みのボディ (まだなければ None)"""
+        if encoding == 'identity':
+            return self._bodies.get(fmt)
+        return self._compressed.get((fmt, encoding))
+
+    def warm(self, encodings=('gzip', 'br')) -> None:
+        """既定の行形式の圧縮ボディと既定のソート順を事前に生成"""
+        for encoding in encodings:
+            if encoding != 'br' or brotli is not None:
+                self.encoded_body(encoding)
+        self.table.warm()
+
+    def encoded_body(self, encoding: str, fmt: str = 'rows') -> bytes:
+        """全件ボディの圧縮版 (スナップショットごとに1回だけ圧縮)"""
+        body = self.format_body(fmt)
+        if encoding == 'identity':
+            return body
+        compressed = self._compressed.get((fmt, encoding))
+        if compressed is None:
+            with self._variant_lock:
+                compressed = self._compressed.get((fmt, encoding))
+                if compressed is None:
+                    if encoding == 'br':
+                        compressed = brotli.compress(body, quality=9)
+                    else:
+                        compressed = gzip.compress(body, compresslevel=9, mtime=0)
+                    self._compressed[(fmt, encoding)] = compressed
+        return compressed
+
+    def response_headers(self, encoding: str = 'identity', fmt: str = 'rows',
+                         query: Optional[dict] = None) -> Dict[str, str]:
+        """キャッシュ関連のレスポンスヘッダー"""
+        headers = {
+            'ETag': self.etag(encoding, fmt, query),
+            'Cache-Control': CACHE_CONTROL,
+            'Vary': 'Accept, Accept-Encoding',
+        }
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return headers
+
+    def query_body(self, query: dict) -> bytes:
+        """
+        ページング・フィルタ付きのレスポンスをエンコード (該当行のみ)
+        行はこのスナップショットの版から読む
+        """
+        response_data = self.table.query(**query)
+        response_data["timestamp"] = self.timestamp
+        response_data["filename"] = self.filename
+        response_data["version"] = self.version
+        return json.dumps(response_data, ensure_ascii=False).encode('utf-8')
+
+    @staticmethod
+    def encode(df: pd.DataFrame, timestamp: float, filename: str) -> bytes:
+        """APIレスポンスと同じ形式でJSONバイト列にエンコード"""
+        # NaN (e.g. price_std of a single request) is not valid JSON
+        records = df.astype(object).where(df.notna(), None).to_dict(orient='records')
+        # The same bytes as json.dumps of {"data", "timestamp", "filename"}
+        rest = json.dumps({"timestamp": timestamp, "filename": filename}, ensure_ascii=False)
+        return f'{{"data": {dumps_list(records)}, {rest[1:]}'.encode('utf-8')
+
+    @staticmethod
+    def encode_columns(df: pd.DataFrame, timestamp: float, filename: str) -> bytes:
+        """列指向JSON: キーを行ごとに繰り返さない"""
+        data = []
+        for col in df.columns:
+            values = df[col]
+            values = values.astype(object).where(values.notna(), None).tolist()
+            data.append(f'{json.dumps(col, ensure_ascii=False)}: {dumps_list(values)}')
+        # The same bytes as json.dumps of {"columns", "data", "timestamp", "filename"}
+        rest = json.dumps({"timestamp": timestamp, "filename": filename}, ensure_ascii=False)
+        columns = json.dumps(list(df.columns), ensure_ascii=False)
+        return f'{{"columns": {columns}, "data": {{{", ".join(data)}}}, {rest[1:]}'.encode('utf-8')
+
+    @staticmethod
+    def encode_arrow(path: Path) -> bytes:
+        """Parquetを直接Arrow IPCストリームに変換 (pandasを経由しない、列は公開されたすべて)"""
+        table = pq.read_table(path)
+        table = table.sort_by([('potential_sales', 'descending')])
+        return MetricsSnapshot._write_stream(table)
+
+    @staticmethod
+    def encode_arrow_frame(df: pd.DataFrame) -> bytes:
+        """ソート済みの DataFrame を Arrow IPC ストリームに変換"""
+        return MetricsSnapshot._write_stream(pa.Table.from_pandas(df, preserve_index=False))
+
+    @staticmethod
+    def _write_stream(table: pa.Table) -> bytes:
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+
+
+class MetricsCache:
+    """
+    最新スナップショットのキャッシュ
+    マニフェスト (なければディレクトリ) が更新された時だけ再読み込みし、
+    同時に複数のリクエストがミスした場合は1つだけが再読み込みを行う
+    """
+
+    def __init__(self, dashboard_dir: Path = DASHBOARD_DIR):
+        self.dashboard_dir = Path(dashboard_dir)
+        self._snapshot: Optional[MetricsSnapshot] = None
+        self._stamp: Optional[tuple] = None
+        self._reload_lock = threading.Lock()
+
+    def _current_stamp(self) -> Optional[tuple]:
+        """
+        マニフェストのmtimeで新しいスナップショットを検知
+        マニフェストがない古いデータではディレクトリのmtimeを使う
+        """
+        try:
+            return ('manifest', (self.dashboard_dir / MANIFEST_NAME).stat().st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        try:
+            return ('dir', self.dashboard_dir.stat().st_mtime_ns)
+        except FileNotFoundError:
+            return None
+
+    def _is_stale(self) -> bool:
+        stamp = self._current_stamp()
+        return stamp is None or stamp != self._stamp
+
+    @staticmethod
+    def _snapshot_key(path: Path) -> tuple:
+        stat = path.stat()
+        return (path.name, stat.st_mtime_ns, stat.st_size)
+
+    def peek(self) -> Optional[MetricsSnapshot]:
+        """読み込み済みのスナップショットを返す (ファイルは確認しない)"""
+        return self._snapshot
+
+    def get(self) -> Optional[MetricsSnapshot]:
+        """
+        最新のスナップショットを返す
+        他のリクエストが再読み込み中の場合は古いスナップショットを返す
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and not self._is_stale():
+            return snapshot
+
+        # Only the first request reloads; with a stale copy available the rest
+        # are served immediately, otherwise they wait for the reload
+        if not self._reload_lock.acquire(blocking=snapshot is None):
+            return snapshot
+
+        try:
+            snapshot = self._snapshot
+            if snapshot is not None and not self._is_stale():
+                return snapshot
+            return self._reload()
+        finally:
+            self._reload_lock.release()
+
+    def _reload(self) -> Optional[MetricsSnapshot]:
+        stamp = self._current_stamp()
+        if stamp is None:
+            return None
+
+        manifest = read_manifest(self.dashboard_dir) if stamp[0] == 'manifest' else None
+        if manifest is not None:
+            latest_file = self.dashboard_dir / manifest['file']
+            key = (manifest['file'], manifest['checksum'])
+        else:
+            parquet_files = list(self.dashboard_dir.glob(SNAPSHOT_PATTERN))
+            if not parquet_files:
+                self._snapshot = None
+                return None
+            latest_file = max(parquet_files, key=lambda p: p.stat().st_mtime)
+            key = self._snapshot_key(latest_file)
+
+        if self._snapshot is None or self._snapshot.key != key:
+            df = pd.read_parquet(latest_file)
+            df = df.sort_values('potential_sales', ascending=False)
+            self._snapshot = MetricsSnapshot(
+                latest_file, key, df, latest_file.stat().st_mtime
+            )
+
+        self._stamp = stamp
+        return self._snapshot
@@ -0,0 +1,283 @@
+"""
+Demand metrics served straight from the materialized demand_metrics table
+The API servers read booth_data.db through a small pool of read-only
+connections. Paged queries become indexed SQL (a top-N by potential_sales is a
+scan of idx_demand_metrics_potential_sales), and the version bumped by each
+refresh replaces the manifest mtime as the staleness check.
+
+The table reflects master_matching, which keeps the latest response per
+(avatar, item, user), so request_count counts users rather than submissions
+and the price statistics use each user's latest price. The parquet source
+counts every submission; see "ダッシュボードAPIのデータソース" in readme.md
+"""
+
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+import pandas as pd
+
+from booth_db import DB_PATH
+from column_mappings import DASHBOARD_COLUMNS
+from config_handler import read_config
+from metrics_cache import MetricsCache, MetricsSnapshot
+from metrics_query import DEFAULT_LIMIT, MetricsTable
+
+DEFAULT_POOL_SIZE = 4
+
+METRICS_SOURCES = ('parquet', 'sqlite')
+
+
+class MetricsDatabase:
+    """demand_metrics への読み取り専用コネクションプール"""
+
+    def __init__(self, db_path: Path = DB_PATH, pool_size: int = DEFAULT_POOL_SIZE):
+        self.db_path = Path(db_path)
+        self.pool_size = pool_size
+        self._pool: queue.LifoQueue = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        uri = f"{self.db_path.resolve().as_uri()}?mode=ro"
+        # Autocommit, so each read opens and ends its own WAL snapshot
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA query_only=ON')
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """
+        プールからコネクションを借りる (最大 pool_size 本、足りなければ返却を待つ)
+        エラーになったコネクションは破棄する
+        """
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.pool_size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._discard()
+                    raise
+            else:
+                conn = self._pool.get()
+        try:
+            yield conn
+        except Exception:
+            conn.close()
+            self._discard()
+            raise
+        else:
+            self._pool.put(conn)
+
+    def _discard(self) -> None:
+        with self._lock:
+            self._created -= 1
+
+    @contextmanager
+    def _read(self) -> Iterator[sqlite3.Connection]:
+        """1つの読み取りトランザクション (途中でリフレッシュされても同じ版を読む)"""
+        with self.connection() as conn:
+            conn.execute('BEGIN')
+            try:
+                yield conn
+            finally:
+                conn.execute('COMMIT')
+
+    def state(self) -> Optional[Tuple[int, float, int]]:
+        """(version, refreshed_at, row_count)。データベースやテーブルがなければ None"""
+        try:
+            with self.connection() as conn:
+                return conn.execute(
+                    'SELECT version, refreshed_at, row_count FROM demand_metrics_meta'
+                ).fetchone()
+        except sqlite3.OperationalError:
+            return None
+
+    def frame(self) -> Optional[Tuple[int, float, pd.DataFrame]]:
+        """メタ情報と全件 (potential_sales の降順) を同じ版で読む"""
+        try:
+            with self._read() as conn:
+                meta = conn.execute(
+                    'SELECT version, refreshed_at FROM demand_metrics_meta'
+                ).fetchone()
+                if meta is None:
+                    return None
+                # Every column of the table, the same as the paged rows
+                df = pd.read_sql_query(
+                    'SELECT * FROM demand_metrics '
+                    'ORDER BY potential_sales DESC, avatar_id, item_id',
+                    conn
+                )
+        except sqlite3.OperationalError:
+            return None
+        return meta[0], meta[1], df
+
+    def query(self, limit: int = DEFAULT_LIMIT, offset: int = 0,
+              sort: str = 'potential_sales', descending: bool = True,
+              min_requests: Optional[int] = None,
+              price_min: Optional[float] = None, price_max: Optional[float] = None,
+              avatar_id: Optional[str] = None, item_id: Optional[str] = None,
+              version: Optional[int] = None) -> Optional[dict]:
+        """
+        MetricsTable.query と同じ結果を SQL で返す (NULL は常に末尾)
+        version を指定した場合、テーブルが別の版にリフレッシュされていれば None
+        """
+        if sort not in DASHBOARD_COLUMNS:
+            raise ValueError(f"unknown sort column: {sort}")
+
+        conditions, args = [], []
+        for clause, value in (('request_count >= ?', min_requests),
+                              ('median_price >= ?', price_min),
+                              ('median_price <= ?', price_max),
+                              ('avatar_id = ?', avatar_id),
+                              ('item_id = ?', item_id)):
+            if value is not None:
+                conditions.append(clause)
+                args.append(str(value) if clause.endswith('id = ?') else value)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+
+        # NULL sorts first in SQLite, which only needs fixing for ascending order
+        if descending:
+            order = f'{sort} DESC, avatar_id, item_id'
+        else:
+            order = f'{sort} IS NULL, {sort}, avatar_id, item_id'
+
+        with self._read() as conn:
+            if version is not None:
+                current = conn.execute('SELECT version FROM demand_metrics_meta').fetchone()
+                if current is None or current[0] != version:
+                    return None
+            if conditions:
+                total = conn.execute(
+                    f'SELECT COUNT(*) FROM demand_metrics{where}', args
+                ).fetchone()[0]
+            else:
+                total = conn.execute('SELECT row_count FROM demand_metrics_meta').fetchone()[0]
+            cursor = conn.execute(
+                f'SELECT * FROM demand_metrics{where} '
+                f'ORDER BY {order} LIMIT ? OFFSET ?',
+                args + [limit, offset]
+            )
+            names = [description[0] for description in cursor.description]
+            records = [dict(zip(names, row)) for row in cursor]
+
+        next_offset = offset + len(records)
+        return {
+            'data': records,
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'next_offset': next_offset if next_offset < total else None,
+        }
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = 0
+
+
+class SnapshotTable:
+    """
+    版を固定したページング
+    demand_metrics がまだスナップショットの版ならインデックスを使った SQL で、
+    リフレッシュされた後はスナップショットの行 (MetricsTable) から返す
+    """
+
+    def __init__(self, database: MetricsDatabase, version: int, df: pd.DataFrame):
+        self.database = database
+        self.version = version
+        self.df = df
+        self._table: Optional[MetricsTable] = None
+        self._lock = threading.Lock()
+
+    def _snapshot_table(self) -> MetricsTable:
+        with self._lock:
+            if self._table is None:
+                self._table = MetricsTable(self.df)
+        return self._table
+
+    def query(self, **query) -> dict:
+        result = self.database.query(version=self.version, **query)
+        if result is None:
+            result = self._snapshot_table().query(**query)
+        return result
+
+    def warm(self) -> None:
+        """インデックスがあるので事前のソートは不要"""
+
+
+class DatabaseMetricsCache(MetricsCache):
+    """
+    demand_metrics テーブルを元にしたスナップショットのキャッシュ
+    全件レスポンスはリフレッシュの版ごとに1回だけ生成し、
+    ページングはプール経由の SQL で処理する (版が変わった後はスナップショットから)
+    """
+
+    def __init__(self, db_path: Path = DB_PATH, pool_size: int = DEFAULT_POOL_SIZE):
+        super().__init__()
+        self.database = MetricsDatabase(db_path, pool_size)
+
+    def _current_stamp(self) -> Optional[tuple]:
+        state = self.database.state()
+        return None if state is None else ('sqlite', state[0])
+
+    def _reload(self) -> Optional[MetricsSnapshot]:
+        loaded = self.database.frame()
+        if loaded is None:
+            return None
+        version, refreshed_at, df = loaded
+        key = ('sqlite', version)
+        if self._snapshot is None or self._snapshot.key != key:
+            self._snapshot = MetricsSnapshot(
+                self.database.db_path, key, df, refreshed_at,
+                table=SnapshotTable(self.database, version, df)
+            )
+        self._stamp = key
+        return self._snapshot
+
+
+def create_metrics_cache(source: Optional[str] = None) -> MetricsCache:
+    """
+    config.json の metrics_source (parquet / sqlite) に応じたキャッシュを作成
+    既定は data/dashboard の Parquet スナップショット
+    (sqlite の request_count は回答数ではなくユーザー数。readme.md を参照)
+    """
+    config = read_config()
+    source = source or config.get('metrics_source', 'parquet')
+    if source == 'sqlite':
+        return DatabaseMetricsCache(
+            config.get('db_path', DB_PATH), config.get('metrics_pool_size', DEFAULT_POOL_SIZE)
+        )
+    if source != 'parquet':
+        raise ValueError(f"metrics_source must be one of {', '.join(METRICS_SOURCES)}")
+    return MetricsCache()
+
+
+_shared_cache: Optional[MetricsCache] = None
+_shared_lock = threading.Lock()
+
+
+def shared_metrics_cache() -> MetricsCache:
+    """
+    全リクエストで共有するキャッシュ
+    最初に使われた時に create_metrics_cache で作成する (import 時には config.json を読まない)
+    """
+    global _shared_cache
+    if _shared_cache is None:
+        with _shared_lock:
+            if _shared_cache is None:
+                _shared_cache = create_metrics_cache()
+    return _shared_cache
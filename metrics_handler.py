@@ -0,0 +1,83 @@
+"""
+/api/demand-metrics for the http.server backends (server.py, server_nginx.py)
+Query parsing, format and encoding negotiation, ETags and 304s live here once,
+so both handlers answer the same request with the same response
+"""
+
+from urllib.parse import parse_qs
+
+from metrics_cache import FORMAT_CONTENT_TYPES, choose_encoding, choose_format
+from metrics_db import shared_metrics_cache
+from metrics_query import QueryError, parse_query
+
+
+class MetricsHandlerMixin:
+    """
+    需要メトリクスのハンドラー (BaseHTTPRequestHandler の前に継承する)
+    ハンドラー側の send_body_response / send_json_response /
+    handle_not_found / handle_server_error でレスポンスを送る
+    """
+
+    def handle_metrics(self, query_string=''):
+        """
+        メトリクスデータのハンドラー
+        クエリがなければキャッシュ済みのスナップショットをそのまま返し、
+        あればページング・フィルタ済みの行だけを返す
+        """
+        try:
+            params = {k: v[-1] for k, v in parse_qs(query_string).items()}
+            query = parse_query(params)
+            snapshot = shared_metrics_cache().get()
+
+            if snapshot is None:
+                self.handle_not_found("No metrics data found")
+                return
+
+            # 全件は要求された形式の圧縮済みボディ、ページング結果は非圧縮の行形式で返す
+            if query is None:
+                fmt = choose_format(self.headers.get('Accept'), params.get('format'))
+                encoding = choose_encoding(self.headers.get('Accept-Encoding'))
+            else:
+                fmt = 'rows'
+                encoding = 'identity'
+            headers = snapshot.response_headers(encoding, fmt, query)
+
+            # データが変わっていなければ304
+            if snapshot.matches(self.headers.get('If-None-Match'), fmt, query):
+                self.send_not_modified(headers)
+                return
+
+            if query is None:
+                response_body = snapshot.encoded_body(encoding, fmt)
+            else:
+                response_body = snapshot.query_body(query)
+            self.send_body_response(
+                200, response_body, FORMAT_CONTENT_TYPES[fmt], headers=headers
+            )
+
+        except QueryError as e:
+            self.handle_bad_request(str(e))
+        except Exception as e:
+            self.handle_server_error(str(e))
+
+    def send_not_modified(self, headers):
+        """
+        304 Not Modified を送信 (ボディなし)
+        """
+        self.send_response(304)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in headers.items():
+            if name != 'Content-Encoding':
+                self.send_header(name, value)
+        self.end_headers()
+
+    def handle_bad_request(self, message="Bad request"):
+        """
+        400エラーハンドラー
+        """
+        error_data = {
+            "error": True,
+            "message": message,
+            "status": 400
+        }
+        self.send_json_response(400, error_data)
@@ -0,0 +1,189 @@
+"""
+Paginated, filtered and sorted queries over a demand metrics snapshot
+The snapshot is held as numpy columns with lazily built sort indexes, so a
+top-N request only touches the rows it returns
+"""
+
+import math
+from typing import Dict, List, Mapping, Optional
+
+import numpy as np
+import pandas as pd
+
+from column_mappings import DASHBOARD_COLUMNS
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 1000
+
+# Query parameters that switch /api/demand-metrics to the paged response
+QUERY_PARAMS = {
+    'limit', 'offset', 'sort', 'order',
+    'min_requests', 'price_min', 'price_max', 'avatar_id', 'item_id'
+}
+
+
+class QueryError(ValueError):
+    """クエリパラメータが不正 (400)"""
+
+
+def parse_query(params: Mapping[str, str]) -> Optional[dict]:
+    """
+    クエリパラメータを検証して MetricsTable.query の引数に変換
+    対象のパラメータがなければ None (全件レスポンス)
+    """
+    if not QUERY_PARAMS.intersection(params):
+        return None
+
+    def get_int(name, default=None, minimum=0):
+        if name not in params:
+            return default
+        try:
+            value = int(params[name])
+        except ValueError:
+            raise QueryError(f"{name} must be an integer")
+        if value < minimum:
+            raise QueryError(f"{name} must be >= {minimum}")
+        return value
+
+    def get_float(name):
+        if name not in params:
+            return None
+        try:
+            return float(params[name])
+        except ValueError:
+            raise QueryError(f"{name} must be a number")
+
+    sort = params.get('sort', 'potential_sales')
+    if sort not in DASHBOARD_COLUMNS:
+        raise QueryError(f"sort must be one of {', '.join(DASHBOARD_COLUMNS)}")
+    order = params.get('order', 'desc')
+    if order not in ('asc', 'desc'):
+        raise QueryError("order must be asc or desc")
+
+    return {
+        'limit': min(get_int('limit', DEFAULT_LIMIT, minimum=1), MAX_LIMIT),
+        'offset': get_int('offset', 0),
+        'sort': sort,
+        'descending': order == 'desc',
+        'min_requests': get_int('min_requests'),
+        'price_min': get_float('price_min'),
+        'price_max': get_float('price_max'),
+        'avatar_id': params.get('avatar_id'),
+        'item_id': params.get('item_id'),
+    }
+
+
+class MetricsTable:
+    """
+    スナップショットの列指向コピーとソート済みインデックス
+    行は公開されたスナップショットのすべての列 (近似モードの誤差・分位点の列を含む) で返す
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.column_names = [str(col) for col in df.columns]
+        self.columns = {col: df[col].to_numpy() for col in self.column_names}
+        self.size = len(df)
+        self._orders: Dict[tuple, np.ndarray] = {}
+        self._ranks: Dict[tuple, np.ndarray] = {}
+        self._id_index: Dict[str, Dict[str, np.ndarray]] = {}
+
+    def sort_order(self, column: str, descending: bool) -> np.ndarray:
+        """列のソート順 (NaN は常に末尾)"""
+        key = (column, descending)
+        order = self._orders.get(key)
+        if order is None:
+            values = self.columns[column]
+            if values.dtype == object:
+                values = values.astype(str)
+                missing = pd.isna(self.columns[column])
+            else:
+                missing = np.isnan(values) if values.dtype.kind == 'f' else np.zeros(self.size, bool)
+            ascending = np.argsort(values, kind='stable')
+            ascending = np.concatenate([ascending[~missing[ascending]], ascending[missing[ascending]]])
+            if descending:
+                present = ascending[:self.size - missing.sum()]
+                order = np.concatenate([present[::-1], ascending[len(present):]])
+            else:
+                order = ascending
+            self._orders[key] = order
+        return order
+
+    def warm(self) -> None:
+        """既定のソート順 (potential_sales の降順) を事前に作る"""
+        self.sort_order('potential_sales', True)
+
+    def _rank(self, column: str, descending: bool) -> np.ndarray:
+        key = (column, descending)
+        rank = self._ranks.get(key)
+        if rank is None:
+            order = self.sort_order(column, descending)
+            rank = np.empty(self.size, dtype=np.int64)
+            rank[order] = np.arange(self.size)
+            self._ranks[key] = rank
+        return rank
+
+    def _positions_for_id(self, column: str, value: str) -> np.ndarray:
+        index = self._id_index.get(column)
+        if index is None:
+            keys = pd.Series(self.columns[column]).astype(str)
+            index = {k: np.asarray(v) for k, v in keys.groupby(keys).indices.items()}
+            self._id_index[column] = index
+        return index.get(str(value), np.empty(0, dtype=np.int64))
+
+    def query(self, limit: int = DEFAULT_LIMIT, offset: int = 0,
+              sort: str = 'potential_sales', descending: bool = True,
+              min_requests: Optional[int] = None,
+              price_min: Optional[float] = None, price_max: Optional[float] = None,
+              avatar_id: Optional[str] = None, item_id: Optional[str] = None) -> dict:
+        """条件に合う行を sort 順に offset から limit 件返す"""
+        candidates = None
+        for column, value in (('avatar_id', avatar_id), ('item_id', item_id)):
+            if value is not None:
+                positions = self._positions_for_id(column, value)
+                candidates = positions if candidates is None else np.intersect1d(candidates, positions)
+
+        mask = None
+        if min_requests is not None:
+            mask = self.columns['request_count'] >= min_requests
+        if price_min is not None:
+            bound = self.columns['median_price'] >= price_min
+            mask = bound if mask is None else mask & bound
+        if price_max is not None:
+            bound = self.columns['median_price'] <= price_max
+            mask = bound if mask is None else mask & bound
+
+        if candidates is not None:
+            if mask is not None:
+                candidates = candidates[mask[candidates]]
+            rank = self._rank(sort, descending)
+            selected = candidates[np.argsort(rank[candidates], kind='stable')]
+        else:
+            selected = self.sort_order(sort, descending)
+            if mask is not None:
+                selected = selected[mask[selected]]
+
+        total = len(selected)
+        page = selected[offset:offset + limit]
+        next_offset = offset + len(page)
+        return {
+            'data': self.records(page),
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'next_offset': next_offset if next_offset < total else None,
+        }
+
+    def records(self, positions: np.ndarray) -> List[dict]:
+        """指定行だけを JSON 化できる dict に変換 (NaN は None)"""
+        columns = {}
+        for col in self.column_names:
+            values = self.columns[col][positions]
+            if values.dtype.kind in 'iub':
+                columns[col] = values.tolist()
+            else:
+                columns[col] = [
+                    None if isinstance(v, float) and math.isnan(v) else v
+                    for v in values.tolist()
+                ]
+        return [dict(zip(self.column_names, row)) for row in zip(*columns.values())]
+
@@ -0,0 +1,175 @@
+"""
+Pooled HTTP/1.1 keep-alive mode for the http.server backends
+Connections are handled on a bounded thread pool. An idle keep-alive
+connection only keeps its worker while nobody else is waiting: as soon as a
+new connection is queued (or the idle timeout passes) it is closed, and the
+client reconnects for its next request. Connections beyond the queue limit
+get an immediate 503 instead of waiting behind idle ones
+"""
+
+import argparse
+import select
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer
+
+DEFAULT_WORKERS = 16
+# Accepted connections that may wait for a worker
+DEFAULT_MAX_QUEUED = 64
+DEFAULT_IDLE_TIMEOUT = 5.0
+# How often an idle connection checks for waiting connections
+IDLE_POLL_INTERVAL = 0.05
+
+REJECT_BODY = b'{"error": true, "message": "Server busy", "status": 503}'
+REJECT_RESPONSE = (
+    b'HTTP/1.1 503 Service Unavailable\r\n'
+    b'Content-Type: application/json\r\n'
+    b'Retry-After: 1\r\n'
+    b'Connection: close\r\n'
+    b'Content-Length: ' + str(len(REJECT_BODY)).encode('ascii') + b'\r\n\r\n'
+    + REJECT_BODY
+)
+
+
+class KeepAliveHandlerMixin:
+    """
+    HTTP/1.1 持続的接続に対応したハンドラー (BaseHTTPRequestHandler の前に継承する)
+    次のリクエストを待つ間に、他の接続が待っているかアイドル状態が
+    idle_timeout 秒続いた場合は接続を閉じてワーカーを空ける
+    """
+    protocol_version = 'HTTP/1.1'
+    idle_timeout = DEFAULT_IDLE_TIMEOUT
+    # 1つのリクエストの読み書きのタイムアウト
+    timeout = 30
+    # ヘッダーとボディを別々に書き込むため、Nagleによる遅延を避ける
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    def _has_buffered_request(self) -> bool:
+        """パイプライン化されたリクエストが読み込み済みのバッファに残っているか"""
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except (BlockingIOError, OSError):
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def wait_for_request(self) -> bool:
+        """次のリクエストが届いたら True、接続を閉じる場合は False"""
+        if self._has_buffered_request():
+            return True
+        deadline = time.monotonic() + self.idle_timeout
+        while not self.server.shutting_down and not self.server.has_waiting():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([self.connection], [], [], min(remaining, IDLE_POLL_INTERVAL))
+            if readable:
+                return True
+        return False
+
+
+class PooledHTTPServer(HTTPServer):
+    """
+    上限付きのスレッドプールで接続を並行処理するHTTPServer
+    遅いクライアントが他のクライアントをブロックせず、
+    ワーカー待ちの接続が max_queued を超えた分は 503 で断る
+    """
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, max_workers=DEFAULT_WORKERS,
+                 max_queued=DEFAULT_MAX_QUEUED):
+        super().__init__(server_address, handler_class)
+        self.shutting_down = False
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        # ワーカーを待っている接続数と、ワーカーが処理中の接続数
+        self.waiting = 0
+        self.active = 0
+        self.rejected = 0
+        self._waiting_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='dashboard-worker'
+        )
+
+    def has_waiting(self) -> bool:
+        """空いているワーカーがなく、ワーカーを待っている接続があるか"""
+        return self.waiting > self.max_workers - self.active
+
+    def process_request(self, request, client_address):
+        with self._waiting_lock:
+            accept = self.waiting < self.max_queued
+            if accept:
+                self.waiting += 1
+            else:
+                self.rejected += 1
+        if accept:
+            self.executor.submit(self.process_request_worker, request, client_address)
+        else:
+            self.reject_request(request)
+
+    def reject_request(self, request):
+        """ワーカー待ちが上限に達した接続に 503 を返して閉じる"""
+        try:
+            request.settimeout(1)
+            request.sendall(REJECT_RESPONSE)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def process_request_worker(self, request, client_address):
+        with self._waiting_lock:
+            self.waiting -= 1
+            self.active += 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._waiting_lock:
+                self.active -= 1
+
+    def server_close(self):
+        """新しい接続の受付を止め、処理中の接続が終わるのを待つ"""
+        self.shutting_down = True
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+def parse_server_args():
+    """起動オプションの解析"""
+    parser = argparse.ArgumentParser(description="Hitaiou Dashboard API Server")
+    parser.add_argument(
+        '--mode', choices=['single', 'pool'], default='single',
+        help="single: 従来のシングルスレッド (HTTP/1.0), pool: スレッドプール + HTTP/1.1 keep-alive"
+    )
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="pool モードのワーカー数")
+    parser.add_argument('--max-queued', type=int, default=DEFAULT_MAX_QUEUED,
+                        help="pool モードでワーカーを待てる接続数 (超えた分は 503)")
+    parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help="pool モードのアイドルタイムアウト (秒)")
+    return parser.parse_args()
+
+
+def create_server(server_address, handler_class, mode='single', workers=DEFAULT_WORKERS,
+                  idle_timeout=DEFAULT_IDLE_TIMEOUT, max_queued=DEFAULT_MAX_QUEUED):
+    """起動モードに応じたサーバーを作成 (pool モードでは handler_class を keep-alive 対応にする)"""
+    if mode == 'pool':
+        keep_alive_class = type(
+            f'KeepAlive{handler_class.__name__}',
+            (KeepAliveHandlerMixin, handler_class),
+            {'idle_timeout': idle_timeout}
+        )
+        return PooledHTTPServer(server_address, keep_alive_class, max_workers=workers,
+                                max_queued=max_queued)
+    return HTTPServer(server_address, handler_class)
@@ -1,71 +1,282 @@
+import hashlib
+import numpy as np
 import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import pyarrow.parquet as pq
 from pathlib import Path
-import requests
 from datetime import datetime
 import re
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Union
 from urllib.parse import urlparse
 import json
 from config_handler import load_config
-from column_mappings import FORM_COLUMNS, PROCESSED_COLUMNS, DASHBOARD_COLUMNS
+from column_mappings import FORM_COLUMNS, REVERSE_FORM_COLUMNS, PROCESSED_COLUMNS, DASHBOARD_COLUMNS
+from column_schema import (MAX_INT64_DIGITS, PARQUET_COMPRESSION, PROCESSED_SCHEMA,
+                           approximate_schema, bytes_per_row, conform_rows, conform_table, typed_frame)
+from snapshot_manifest import atomic_write_bytes, publish_snapshot
+from demand_aggregates import DemandState, demand_metrics_table
+from demand_sketches import SketchParams, SketchState, sketch_params_from_config
+from booth_db import DB_PATH
+from matching_store import MatchingStore
+from snapshot_archive import archive_from_config
+from fingerprints import FingerprintStore, data_fingerprint
+from sheets_client import DEFAULT_PAGE_ROWS, LAST_COLUMN, ColumnarRows, SheetsClient, SheetsError
+
+# extract_booth_info の3パターンと最後の手段を1つにまとめた正規表現 (RE2)
+# 左から順に試されるので、元の実装と同じパターンが優先される
+BOOTH_URL_PATTERN = (
+    r'(?s)^(?:https://(?:'
+    r'(?P<shop_id>[^.]+)\.booth\.pm/items/(?P<shop_item_id>\d+)'
+    r'|booth\.pm/[^/]+/items/(?P<lang_item_id>\d+)'
+    r'|booth\.pm/items/(?P<direct_item_id>\d+))'
+    r'|.*?/items/(?P<fallback_item_id>\d+))'
+)
+BOOTH_ITEM_ID_GROUPS = ['shop_item_id', 'lang_item_id', 'direct_item_id', 'fallback_item_id']
+
+# Characters removed by str.strip() within ASCII
+ASCII_WHITESPACE = ' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f'
+
+# pandas: DataFrames of Python objects; arrow: Arrow tables and pyarrow.compute
+ENGINES = ('pandas', 'arrow')
+Rows = Union[pd.DataFrame, pa.Table]
+# Rows per Arrow compute call, so intermediates stay bounded on large sheets
+COMPUTE_BATCH_ROWS = 1 << 18
+
+def column_names(data: Rows) -> list:
+    """Column names of a DataFrame or an Arrow table"""
+    if isinstance(data, pa.Table):
+        return data.column_names
+    return data.columns.tolist()
 
 class DataProcessor:
-    def __init__(self, data_dir: str = "data"):
+    def __init__(self, data_dir: str = "data", db_path: Path = DB_PATH, engine: str = 'pandas',
+                 sketch_params: Optional[SketchParams] = None):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine: {engine} (expected one of {', '.join(ENGINES)})")
+        # The arrow engine passes Arrow tables between the steps
+        self.engine = engine
         self.data_dir = Path(data_dir)
         self.data_dir.mkdir(exist_ok=True)
         self.raw_dir = self.data_dir / "raw"
         self.processed_dir = self.data_dir / "processed"
         self.dashboard_dir = self.data_dir / "dashboard"
+        self.state_dir = self.data_dir / "state"
+        # Append-only store of processed rows for incremental runs
+        self.processed_store_dir = self.processed_dir / "store"
+        self.watermark_path = self.state_dir / "watermark.json"
+        self.demand_state_dir = self.state_dir / "demand"
+        # Approximate mode: unique_users and price quantiles from sketches
+        self.sketch_params = sketch_params
+        self.sketch_state_dir = self.state_dir / "sketch"
+        # Fingerprints of the last published run, to skip unchanged stages
+        # (a different engine or approximate-mode setting reruns them)
+        self.fingerprints = FingerprintStore(self.state_dir / "fingerprints.json", {
+            'engine': engine,
+            'sketch_params': sketch_params._asdict() if sketch_params is not None else None,
+        })
+        # Processed rows are kept in master_matching, deduplicated by its key
+        self.matching_store = MatchingStore(db_path)
         
         self.raw_dir.mkdir(exist_ok=True)
         self.processed_dir.mkdir(exist_ok=True)
         self.dashboard_dir.mkdir(exist_ok=True)
+        self.state_dir.mkdir(exist_ok=True)
+        self.processed_store_dir.mkdir(exist_ok=True)
+
+    def _empty_rows(self, headers: list) -> Rows:
+        """Column-mapped rows with no data, in the engine's format"""
+        names = [FORM_COLUMNS.get(h, h) for h in headers]
+        if self.engine == 'arrow':
+            return pa.Table.from_arrays([pa.array([], pa.string()) for _ in names], names=names)
+        return pd.DataFrame(columns=names)
 
-    def download_spreadsheet(self, spreadsheet_id: str, api_key: str) -> Optional[pd.DataFrame]:
+    def _rows_data(self, rows: ColumnarRows, csv_path: Path) -> Rows:
+        """Save the downloaded rows as CSV and return them column-mapped"""
+        if self.engine == 'arrow':
+            table = rows.to_table()
+            pacsv.write_csv(table, csv_path)
+            return table.rename_columns([FORM_COLUMNS.get(h, h) for h in table.column_names])
+        df = rows.to_frame()
+        df.to_csv(csv_path, index=False)
+        return df.rename(columns=FORM_COLUMNS)
+
+    def download_spreadsheet(self, spreadsheet_id: str, api_key: str,
+                             page_rows: int = DEFAULT_PAGE_ROWS) -> Optional[Rows]:
         try:
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             csv_path = self.raw_dir / f"raw_data_{timestamp}.csv"
             
-            url = f"https://sheets.googleapis.com/v4/spreadsheets/{spreadsheet_id}/values/A:Z"
-            params = {
-                'key': api_key,
-                'majorDimension': 'ROWS',
-                'valueRenderOption': 'UNFORMATTED_VALUE'
-            }
-            
             print("Downloading spreadsheet using Google Sheets API...")
-            response = requests.get(url, params=params)
-            
-            if response.status_code == 200:
-                data = response.json().get('values', [])
-                if not data:
-                    print("No data found in spreadsheet")
-                    return None
-                    
-                headers = data[0]
-                df = pd.DataFrame(data[1:], columns=headers)
-                
-                # Save raw data before column mapping
-                df.to_csv(csv_path, index=False)
-                print(f"Raw data saved to: {csv_path}")
-                print(f"Downloaded {len(df)} rows")
-                print(f"Original columns: {headers}")
-                
-                # Apply column mapping
-                df = df.rename(columns=FORM_COLUMNS)
-                print(f"Mapped columns: {df.columns.tolist()}")
-                
-                return df
-            else:
-                print(f"Failed to download spreadsheet. Status code: {response.status_code}")
+            # Bounded row ranges, each converted straight into column buffers
+            # and hashed as received
+            rows = None
+            digest = hashlib.sha256()
+            with SheetsClient(api_key) as client:
+                for start, values in client.iter_pages(spreadsheet_id, 1, page_rows, digest):
+                    if rows is None:
+                        if not values:
+                            break
+                        rows = ColumnarRows(values[0])
+                        values = values[1:]
+                    rows.append(values)
+                    print(f"Downloaded rows {start}-{start + len(values)}")
+            
+            if rows is None:
+                print("No data found in spreadsheet")
                 return None
                 
+            headers = rows.headers
+            self.fingerprints.record('raw', digest.hexdigest())
+            if self.fingerprints.unchanged('raw'):
+                # Same payload as the last published run: nothing to save
+                return self._empty_rows(headers)
+            
+            # Save raw data before column mapping, then apply the mapping
+            df = self._rows_data(rows, csv_path)
+            print(f"Raw data saved to: {csv_path}")
+            print(f"Downloaded {len(df)} rows")
+            print(f"Original columns: {headers}")
+            print(f"Mapped columns: {column_names(df)}")
+            
+            return df
+                
+        except SheetsError as e:
+            print(f"Failed to download spreadsheet: {str(e)}")
+            return None
         except Exception as e:
             print(f"Error downloading spreadsheet: {str(e)}")
             return None
 
+    def load_watermark(self) -> Optional[dict]:
+        """Last ingested sheet row and its timestamp, or None before the first incremental run"""
+        try:
+            return json.loads(self.watermark_path.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            return None
+
+    def save_watermark(self, watermark: dict) -> None:
+        atomic_write_bytes(
+            self.watermark_path,
+            json.dumps(watermark, ensure_ascii=False, indent=2).encode('utf-8')
+        )
+        print(f"Watermark saved: row {watermark['last_row']}")
+
+    def download_new_rows(self, spreadsheet_id: str, api_key: str,
+                          page_rows: int = DEFAULT_PAGE_ROWS) -> Tuple[Optional[Rows], Optional[dict]]:
+        """
+        Download only the responses appended after the watermark
+        Rows are fetched in bounded A1 ranges; the watermark row itself is
+        re-read to check that the sheet was not edited or reordered
+        If a page still fails after retries, the pages fetched so far are
+        kept and the next run resumes after them
+        Returns the new rows (column-mapped) and the watermark to save once
+        they have been stored
+        """
+        try:
+            with SheetsClient(api_key) as client:
+                watermark = self.load_watermark()
+                start = watermark['last_row'] if watermark else 2
+                end = start + page_rows - 1
+                # The header row and the first page come in one request, so a
+                # run with no new responses costs a single call
+                headers, values = client.fetch_ranges(
+                    spreadsheet_id, [f"A1:{LAST_COLUMN}1", f"A{start}:{LAST_COLUMN}{end}"]
+                )
+                if not headers:
+                    print("No header row found in spreadsheet")
+                    return None, None
+                headers = headers[0]
+                ts_col = headers.index(REVERSE_FORM_COLUMNS['timestamp']) \
+                    if REVERSE_FORM_COLUMNS['timestamp'] in headers else 0
+
+                reset_store = False
+                rows = ColumnarRows(headers)
+
+                print(f"Downloading new responses from row {start}...")
+                while True:
+                    if watermark is not None and not rows.num_rows and start == watermark['last_row']:
+                        first = values[0] if values else []
+                        if (first[ts_col] if len(first) > ts_col else None) != watermark['last_timestamp']:
+                            print("Watermark row no longer matches the sheet; re-reading from the top")
+                            watermark = None
+                            reset_store = True
+                            start = 2
+                            end = start + page_rows - 1
+                            values = client.fetch_values(spreadsheet_id, f"A{start}:{LAST_COLUMN}{end}")
+                            continue
+                        values = values[1:]
+                        start += 1
+
+                    rows.append(values)
+                    if start + len(values) - 1 < end:
+                        break
+                    start = end + 1
+                    end = start + page_rows - 1
+                    try:
+                        values = client.fetch_values(spreadsheet_id, f"A{start}:{LAST_COLUMN}{end}")
+                    except SheetsError as e:
+                        if not rows.num_rows:
+                            raise
+                        print(f"Stopping at row {start - 1}: {str(e)}")
+                        break
+
+            if watermark is not None:
+                last_row = watermark['last_row'] + rows.num_rows
+            else:
+                last_row = 1 + rows.num_rows
+
+            if not rows.num_rows:
+                print("No new responses since last run")
+                return self._empty_rows(headers), None
+
+            last = rows.last_row
+            new_watermark = {
+                'last_row': last_row,
+                'last_timestamp': last[ts_col] if len(last) > ts_col else None,
+                'updated_at': datetime.now().isoformat(),
+                # The sheet was rewritten, so the stored rows must be replaced
+                'reset_store': reset_store
+            }
+
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            csv_path = self.raw_dir / f"raw_data_{timestamp}.csv"
+            df = self._rows_data(rows, csv_path)
+            print(f"Raw delta saved to: {csv_path}")
+            print(f"Downloaded {len(df)} new rows (up to row {last_row})")
+
+            return df, new_watermark
+
+        except Exception as e:
+            print(f"Error downloading new rows: {str(e)}")
+            return None, None
+
+    def load_processed_store(self) -> Optional[pd.DataFrame]:
+        """All processed rows appended by incremental runs"""
+        parts = sorted(self.processed_store_dir.glob("part_*.parquet"))
+        if not parts:
+            return None
+        # Parts are conformed one by one since parts written before the typed
+        # schema (or with an all-null column) have other parquet types
+        return typed_frame(pa.concat_tables(
+            [conform_table(pq.read_table(part), PROCESSED_SCHEMA) for part in parts]
+        ))
+
+    def clear_processed_store(self) -> None:
+        """Drop the stored rows and the aggregate state built from them"""
+        for part in self.processed_store_dir.glob("part_*.parquet"):
+            part.unlink()
+        self.drop_state(self.demand_state_dir)
+        self.drop_state(self.sketch_state_dir)
+        self.matching_store.clear()
+
+    @staticmethod
+    def drop_state(state_dir: Path) -> None:
+        """Remove a saved aggregate state so the next incremental run rebuilds it from the store"""
+        for state_file in state_dir.glob("*.parquet"):
+            state_file.unlink()
+
     @staticmethod
     def extract_booth_info(url: str) -> Tuple[Optional[str], Optional[str]]:
         """Extract shop_id and item_id from Booth URLs with improved pattern matching"""
@@ -117,63 +328,273 @@ class DataProcessor:
             print(f"Error processing URL {url}: {str(e)}")
             return (None, None)
 
-    def process_raw_data(self, df: pd.DataFrame) -> Optional[pd.DataFrame]:
-        try:
-            if df is None or df.empty:
-                print("No data to process")
-                return None
-                
-            print("Processing raw data...")
-            print("Input columns:", df.columns.tolist())
-            
-            # データの内容を確認
+    @staticmethod
+    def parse_booth_urls(strings: pa.Array) -> Tuple[pa.Array, pa.Array]:
+        """
+        Parse ASCII URL strings (no nulls) into shop_id and item_id arrays in one
+        Arrow compute pass; URLs that do not parse are reported and left null
+        """
+        # Bare IDs are kept as-is (checked before stripping, like str.isdigit)
+        digits = pc.match_substring_regex(strings, r'^[0-9]+$')
+        stripped = pc.utf8_trim(strings, characters=ASCII_WHITESPACE)
+        extracted = pc.extract_regex(stripped, BOOTH_URL_PATTERN)
+
+        # Groups that did not take part in the match come back as empty strings
+        item_id = pa.nulls(len(stripped), pa.string())
+        for group in reversed(BOOTH_ITEM_ID_GROUPS):
+            group_id = pc.struct_field(extracted, group)
+            item_id = pc.if_else(pc.greater(pc.utf8_length(group_id), 0), group_id, item_id)
+        item_id = pc.if_else(digits, strings, item_id)
+        shop_id = pc.struct_field(extracted, 'shop_id')
+        shop_id = pc.if_else(pc.greater(pc.utf8_length(shop_id), 0), shop_id, None)
+
+        for url in stripped.filter(pc.is_null(item_id)).to_pylist():
+            print(f"Warning: Could not parse Booth URL: {url}")
+        return shop_id, item_id
+
+    @staticmethod
+    def extract_booth_ids(urls: pd.Series) -> pd.DataFrame:
+        """
+        Vectorized extract_booth_info: shop_id and item_id for a whole URL column
+        ASCII strings are parsed in one Arrow compute pass, anything else
+        (numbers, non-ASCII text) falls back to extract_booth_info
+        """
+        values = urls.to_numpy(dtype=object)
+        shop_ids = np.full(len(values), None, dtype=object)
+        item_ids = np.full(len(values), None, dtype=object)
+        present = urls.notna().to_numpy()
+
+        if pd.api.types.infer_dtype(urls, skipna=True) in ('string', 'empty'):
+            is_str = present
+        else:
+            is_str = present & urls.map(lambda v: isinstance(v, str)).to_numpy(dtype=bool)
+
+        str_pos = np.flatnonzero(is_str)
+        strings = pa.array(values[str_pos], type=pa.string())
+        is_ascii = pc.string_is_ascii(strings).to_numpy(zero_copy_only=False)
+        ascii_pos = str_pos[is_ascii]
+
+        shop_id, item_id = DataProcessor.parse_booth_urls(strings.filter(pa.array(is_ascii)))
+        item_id = item_id.to_numpy(zero_copy_only=False)
+        matched = pd.notna(item_id)
+        item_ids[ascii_pos[matched]] = item_id[matched]
+        shop_id = shop_id.to_numpy(zero_copy_only=False)
+        has_shop = pd.notna(shop_id)
+        shop_ids[ascii_pos[has_shop]] = shop_id[has_shop]
+
+        # Numbers and non-ASCII strings are rare; use the scalar parser for them
+        other_pos = np.flatnonzero(present)
+        other_pos = np.setdiff1d(other_pos, ascii_pos, assume_unique=True)
+        for pos in other_pos:
+            shop_ids[pos], item_ids[pos] = DataProcessor.extract_booth_info(values[pos])
+
+        return pd.DataFrame(
+            {'shop_id': shop_ids, 'item_id': item_ids},
+            index=urls.index
+        )
+
+    @staticmethod
+    def _booth_id_arrays(urls: pa.Array) -> Tuple[pa.Array, pa.Array]:
+        """extract_booth_id_arrays for one contiguous slice"""
+        if not (pa.types.is_string(urls.type) or pa.types.is_large_string(urls.type)):
+            # A column with no text at all (numbers or empty cells)
+            ids = [DataProcessor.extract_booth_info(url) for url in urls.to_pylist()]
+            return (pa.array([shop for shop, _ in ids], pa.string()),
+                    pa.array([item for _, item in ids], pa.string()))
+        urls = urls.cast(pa.string())
+
+        is_ascii = pc.fill_null(pc.string_is_ascii(urls), False)
+        shop_id, item_id = DataProcessor.parse_booth_urls(urls.filter(is_ascii))
+        shop_ids = pc.replace_with_mask(pa.nulls(len(urls), pa.string()), is_ascii, shop_id)
+        item_ids = pc.replace_with_mask(pa.nulls(len(urls), pa.string()), is_ascii, item_id)
+
+        other = pc.and_(pc.is_valid(urls), pc.invert(is_ascii))
+        if pc.any(other).as_py():
+            ids = [DataProcessor.extract_booth_info(url) for url in urls.filter(other).to_pylist()]
+            shop_ids = pc.replace_with_mask(shop_ids, other, pa.array([shop for shop, _ in ids], pa.string()))
+            item_ids = pc.replace_with_mask(item_ids, other, pa.array([item for _, item in ids], pa.string()))
+        return shop_ids, item_ids
+
+    @staticmethod
+    def extract_booth_id_arrays(urls: pa.ChunkedArray) -> Tuple[pa.ChunkedArray, pa.ChunkedArray]:
+        """
+        Arrow version of extract_booth_ids for the arrow engine: shop_id and
+        item_id string columns, with the same fallback for numbers and non-ASCII
+        text. Slices of COMPUTE_BATCH_ROWS keep the regex intermediates small
+        """
+        shop_ids, item_ids = [], []
+        for start in range(0, len(urls), COMPUTE_BATCH_ROWS):
+            shop_id, item_id = DataProcessor._booth_id_arrays(
+                urls.slice(start, COMPUTE_BATCH_ROWS).combine_chunks()
+            )
+            shop_ids.append(shop_id)
+            item_ids.append(item_id)
+        return (pa.chunked_array(shop_ids, pa.string()),
+                pa.chunked_array(item_ids, pa.string()))
+
+    @staticmethod
+    def parse_price_array(prices: pa.ChunkedArray) -> pa.ChunkedArray:
+        """
+        Arrow version of the desired_price cleaning: the first run of digits of
+        the value as text, 0 where there is none (or too long for int64)
+        """
+        chunks = []
+        for start in range(0, len(prices), COMPUTE_BATCH_ROWS):
+            chunk = prices.slice(start, COMPUTE_BATCH_ROWS).combine_chunks()
+            if not pa.types.is_string(chunk.type):
+                chunk = chunk.cast(pa.string())
+            # Python's \d is any Unicode decimal digit; pd.to_numeric only parses ASCII ones
+            digits = pc.struct_field(pc.extract_regex(chunk, r'(?P<price>\p{Nd}+)'), 'price')
+            chunks.append(pc.if_else(pc.string_is_ascii(digits), digits, None))
+        digits = pa.chunked_array(chunks, pa.string())
+        digits = pc.if_else(pc.greater(pc.utf8_length(digits), MAX_INT64_DIGITS), None, digits)
+        return pc.fill_null(digits.cast(pa.int64()), 0)
+
+    @classmethod
+    def _process_frame(cls, df: pd.DataFrame, verbose: bool = True) -> pd.DataFrame:
+        """pandas engine: extract IDs, clean prices and keep rows with an item ID"""
+        # データの内容を確認
+        if verbose:
             print("\nSample of input data:")
             print(df[['avatar_url', 'item_url']].head())
-            
-            # Process URLs and extract IDs
-            df['avatar_info'] = df['avatar_url'].apply(self.extract_booth_info)
-            df['item_info'] = df['item_url'].apply(self.extract_booth_info)
-            
+        
+        # Process URLs and extract IDs (one regex pass per column)
+        avatar_ids = cls.extract_booth_ids(df['avatar_url'])
+        item_ids = cls.extract_booth_ids(df['item_url'])
+        
+        if verbose:
             print("\nExtracted URL info:")
             print(pd.DataFrame({
                 'avatar_url': df['avatar_url'],
-                'avatar_info': df['avatar_info'],
+                'avatar_item_id': avatar_ids['item_id'],
                 'item_url': df['item_url'],
-                'item_info': df['item_info']
+                'item_item_id': item_ids['item_id']
             }).head())
-            
-            # Extract shop_id and item_id
-            df['avatar_shop_id'] = df['avatar_info'].apply(lambda x: x[0] if x else None)
-            df['avatar_item_id'] = df['avatar_info'].apply(lambda x: x[1] if x else None)
-            df['item_shop_id'] = df['item_info'].apply(lambda x: x[0] if x else None)
-            df['item_item_id'] = df['item_info'].apply(lambda x: x[1] if x else None)
-            
-            # Clean price data - handle potential non-numeric values
-            df['desired_price'] = pd.to_numeric(
-                df['desired_price'].astype(str).str.extract(r'(\d+)')[0], 
-                errors='coerce'
-            ).fillna(0)  # 価格が指定されていない場合は0を設定
-            
-            # Drop temporary columns
-            df = df.drop(['avatar_info', 'item_info'], axis=1)
-            
-            # フィルタリング条件を緩和：item_idのどちらかが存在すれば良い
-            df = df[df['avatar_item_id'].notna() | df['item_item_id'].notna()]
-            
-            # Add is_avatar column based on URL position
-            df['is_avatar'] = 1  # avatarとして指定されたURLは1
-            
-            # Save processed data
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            parquet_path = self.processed_dir / f"processed_data_{timestamp}.parquet"
-            
-            df.to_parquet(
-                parquet_path,
-                compression='snappy',
-                engine='pyarrow'
-            )
-            print(f"\nProcessed data saved to: {parquet_path}")
-            print("Output columns:", df.columns.tolist())
+        
+        # Extract shop_id and item_id
+        df['avatar_shop_id'] = avatar_ids['shop_id']
+        df['avatar_item_id'] = avatar_ids['item_id']
+        df['item_shop_id'] = item_ids['shop_id']
+        df['item_item_id'] = item_ids['item_id']
+        
+        # Clean price data - handle potential non-numeric values
+        df['desired_price'] = pd.to_numeric(
+            df['desired_price'].astype(str).str.extract(r'(\d+)')[0], 
+            errors='coerce'
+        ).fillna(0)  # 価格が指定されていない場合は0を設定
+        
+        # フィルタリング条件を緩和：item_idのどちらかが存在すれば良い
+        df = df[df['avatar_item_id'].notna() | df['item_item_id'].notna()]
+        
+        # Add is_avatar column based on URL position
+        df['is_avatar'] = 1  # avatarとして指定されたURLは1
+        return df
+
+    @classmethod
+    def _process_table(cls, table: pa.Table, verbose: bool = True) -> pa.Table:
+        """arrow engine: the same steps as _process_frame on Arrow arrays"""
+        if verbose:
+            print("\nSample of input data:")
+            print(table.select(['avatar_url', 'item_url']).slice(0, 5))
+        
+        avatar_shop_id, avatar_item_id = cls.extract_booth_id_arrays(table['avatar_url'])
+        item_shop_id, item_item_id = cls.extract_booth_id_arrays(table['item_url'])
+        
+        if verbose:
+            print("\nExtracted URL info:")
+            print(pa.table({
+                'avatar_url': table['avatar_url'],
+                'avatar_item_id': avatar_item_id,
+                'item_url': table['item_url'],
+                'item_item_id': item_item_id
+            }).slice(0, 5))
+        
+        table = (
+            table.append_column('avatar_shop_id', avatar_shop_id)
+            .append_column('avatar_item_id', avatar_item_id)
+            .append_column('item_shop_id', item_shop_id)
+            .append_column('item_item_id', item_item_id)
+        )
+        price_index = table.column_names.index('desired_price')
+        table = table.set_column(price_index, 'desired_price',
+                                 cls.parse_price_array(table['desired_price']))
+        
+        table = table.filter(pc.or_(pc.is_valid(avatar_item_id), pc.is_valid(item_item_id)))
+        return table.append_column('is_avatar', pa.array(np.ones(table.num_rows, dtype='int64')))
+
+    @classmethod
+    def process_rows(cls, data: Rows, verbose: bool = True) -> Rows:
+        """
+        Processed rows in PROCESSED_SCHEMA, in the same format as data
+        Every row is processed on its own, so chunks of the raw rows can be
+        processed separately (chunked_pipeline)
+        """
+        if isinstance(data, pa.Table):
+            processed = cls._process_table(data, verbose)
+        else:
+            processed = cls._process_frame(data, verbose)
+        
+        # Enforce the typed schema before anything is stored
+        untyped = bytes_per_row(processed) if verbose else None
+        processed = conform_rows(processed, PROCESSED_SCHEMA)
+        if verbose:
+            print(f"\nProcessed rows: {untyped:.0f} -> {bytes_per_row(processed):.0f} bytes/row in memory (PROCESSED_SCHEMA)")
+        return processed
+
+    def process_raw_data(self, df: Rows, incremental: bool = False) -> Optional[Rows]:
+        """
+        Processed rows (PROCESSED_COLUMNS): a DataFrame, or an Arrow table with
+        the arrow engine
+        """
+        try:
+            if df is None or len(df) == 0:
+                print("No data to process")
+                return None
+                
+            print("Processing raw data...")
+            print("Input columns:", column_names(df))
+            
+            df = self.process_rows(df)
+            
+            # A full run whose processed rows match the last published run
+            # leaves master_matching as it is
+            if not incremental:
+                self.fingerprints.record('processed', data_fingerprint(df))
+                if self.fingerprints.unchanged('processed'):
+                    print("\nProcessed data unchanged since the last published run; master_matching not updated")
+                    return df
+            
+            # Upsert into master_matching; repeated (avatar, item, userid)
+            # submissions collapse on the primary key. A full run holds every
+            # response, so rows no longer in the sheet are deleted
+            if incremental:
+                upserted = self.matching_store.upsert(df)
+                print(f"\nUpserted {upserted} rows into master_matching ({self.matching_store.db_path})")
+            else:
+                self.matching_store.begin_full_run()
+                upserted = self.matching_store.upsert(df, refresh=False, full_run=True)
+                removed = self.matching_store.prune()
+                print(f"\nUpserted {upserted} rows into master_matching ({self.matching_store.db_path}), "
+                      f"removed {removed} rows no longer in the sheet")
+            
+            # Incremental runs also append the delta to the store (a delta
+            # whose rows were all dropped while cleaning adds no part)
+            if incremental and len(df) == 0:
+                print("No rows kept after cleaning; nothing appended to the store")
+            elif incremental:
+                part_id = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+                parquet_path = self.processed_store_dir / f"part_{part_id}.parquet"
+                if isinstance(df, pa.Table):
+                    pq.write_table(df, parquet_path, compression=PARQUET_COMPRESSION)
+                else:
+                    df.to_parquet(
+                        parquet_path,
+                        compression=PARQUET_COMPRESSION,
+                        engine='pyarrow'
+                    )
+                file_bytes = parquet_path.stat().st_size / len(df)
+                print(f"Processed data saved to: {parquet_path} ({file_bytes:.1f} bytes/row)")
+            print("Output columns:", column_names(df))
             print("\nProcessed data summary:")
             print(df)
             
@@ -181,79 +602,190 @@ class DataProcessor:
             
         except Exception as e:
             print(f"Error processing data: {str(e)}")
-            print("Current DataFrame columns:", df.columns.tolist())
+            print("Current DataFrame columns:", column_names(df))
             raise
 
-    def prepare_dashboard_data(self, df: pd.DataFrame) -> bool:
+    def prepare_dashboard_data(self, df: Rows, incremental: bool = False) -> bool:
+        """
+        Compute demand metrics and publish them
+        In incremental mode df holds only the new rows, which are folded into
+        the saved per-pair state instead of regrouping the whole history
+        """
         try:
-            if df is None or df.empty:
+            if df is None or len(df) == 0:
                 print("No data to prepare for dashboard")
                 return False
                 
             print("Preparing dashboard data...")
             
-            # Calculate demand metrics
-            demand_metrics = df.groupby(['avatar_item_id', 'item_item_id']).agg({
-                'twitter_id': ['count', 'nunique'],
-                'desired_price': ['median', 'mean', 'min', 'max', 'std']
-            }).reset_index()
-            
-            # Flatten column names
-            demand_metrics.columns = [
-                'avatar_id', 'item_id', 'request_count', 'unique_users',
-                'median_price', 'mean_price', 'min_price', 'max_price', 'price_std'
-            ]
-            
-            # Calculate potential sales
-            demand_metrics['potential_sales'] = (
-                demand_metrics['request_count'] * demand_metrics['median_price']
-            )
-            
-            # Sort by potential sales (highest first)
-            demand_metrics = demand_metrics.sort_values('potential_sales', ascending=False)
-            
-            # Save demand metrics
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            demand_metrics_path = self.dashboard_dir / f"demand_metrics_{timestamp}.parquet"
-            demand_metrics.to_parquet(demand_metrics_path, compression='snappy')
-            
-            print("\nDemand metrics summary:")
-            print(demand_metrics)
-            print(f"\nDemand metrics saved to: {demand_metrics_path}")
+            if self.sketch_params is not None:
+                demand_metrics = self.approximate_metrics(df, incremental)
+            elif isinstance(df, pa.Table) and not incremental:
+                # Grouped on the Arrow table; same values and row order
+                demand_metrics = demand_metrics_table(df)
+                order = pd.Series(demand_metrics['potential_sales'].to_numpy()).sort_values(ascending=False)
+                demand_metrics = demand_metrics.take(order.index.to_numpy())
+            else:
+                if isinstance(df, pa.Table):
+                    # The saved per-pair state is pandas
+                    df = typed_frame(df.select(['avatar_item_id', 'item_item_id', 'twitter_id', 'desired_price']))
+                
+                # Calculate demand metrics from mergeable per-pair statistics
+                if incremental:
+                    previous = DemandState.load(self.demand_state_dir)
+                    if previous is not None:
+                        state = previous.merge(DemandState.from_frame(df))
+                    else:
+                        # The store already holds the new rows
+                        state = DemandState.from_frame(self.load_processed_store())
+                    state.save(self.demand_state_dir)
+                    # Sketches saved by approximate runs no longer cover every row
+                    self.drop_state(self.sketch_state_dir)
+                else:
+                    state = DemandState.from_frame(df)
+                demand_metrics = state.to_metrics()
+                
+                # Sort by potential sales (highest first)
+                demand_metrics = demand_metrics.sort_values('potential_sales', ascending=False)
             
+            self.publish_demand_metrics(demand_metrics)
             return True
             
         except Exception as e:
             print(f"Error preparing dashboard data: {str(e)}")
             return False
 
+    def approximate_metrics(self, df: Rows, incremental: bool = False) -> Rows:
+        """
+        Demand metrics from the sketches, with an error column next to each
+        estimate. Incremental runs merge the new rows into the saved sketches;
+        when there are none, or they were built with other error settings,
+        they are rebuilt from the processed store
+        """
+        params = self.sketch_params
+        if isinstance(df, pa.Table):
+            df = typed_frame(df.select(['avatar_item_id', 'item_item_id', 'twitter_id', 'desired_price']))
+        
+        if incremental:
+            previous = SketchState.load(self.sketch_state_dir, params)
+            if previous is not None:
+                state = previous.merge(SketchState.from_frame(df, params))
+            else:
+                # The store already holds the new rows
+                print("Building sketches from the processed store...")
+                state = SketchState.from_frame(self.load_processed_store(), params)
+            state.save(self.sketch_state_dir)
+            self.drop_state(self.demand_state_dir)
+        else:
+            state = SketchState.from_frame(df, params)
+        print(f"Approximate metrics: unique_users +-{params.user_std_error:.2%} (std error, "
+              f"{params.registers} registers), price quantiles +-{params.price_error:.2%}")
+        
+        demand_metrics = state.to_metrics().sort_values('potential_sales', ascending=False)
+        if self.engine == 'arrow':
+            demand_metrics = conform_table(pa.Table.from_pandas(demand_metrics, preserve_index=False),
+                                           approximate_schema(params.quantile_columns))
+        return demand_metrics
+
+    def publish_demand_metrics(self, demand_metrics: Rows) -> None:
+        """Publish sorted demand metrics unless they match the last published snapshot"""
+        self.fingerprints.record('metrics', data_fingerprint(demand_metrics))
+        if self.fingerprints.unchanged('metrics'):
+            print("Demand metrics unchanged since the last published snapshot; not republished")
+            return
+        
+        # Publish demand metrics atomically and update the latest manifest
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        demand_metrics_path = publish_snapshot(demand_metrics, self.dashboard_dir, timestamp)
+        
+        print("\nDemand metrics summary:")
+        print(demand_metrics)
+        file_bytes = demand_metrics_path.stat().st_size / max(len(demand_metrics), 1)
+        print(f"\nDemand metrics saved to: {demand_metrics_path} ({file_bytes:.1f} bytes/row)")
+
+def run_incremental(processor: DataProcessor, spreadsheet_id: str, api_key: str):
+    """Fetch, process and store only the responses added since the last run"""
+    print("\n=== Step 1: Downloading New Responses ===")
+    new_rows, watermark = processor.download_new_rows(spreadsheet_id, api_key)
+
+    if new_rows is None:
+        print("Failed to download spreadsheet")
+        return
+    if len(new_rows) == 0:
+        return
+
+    print("\n=== Step 2: Processing New Rows ===")
+    if watermark.pop('reset_store'):
+        processor.clear_processed_store()
+    processed_data = processor.process_raw_data(new_rows, incremental=True)
+    if processed_data is None:
+        print("Failed to process raw data")
+        return
+
+    print("\n=== Step 3: Preparing Dashboard Data ===")
+    if len(processed_data) and not processor.prepare_dashboard_data(processed_data, incremental=True):
+        return
+    processor.save_watermark(watermark)
+    processor.fingerprints.commit()
+
+    print("\nAll processing steps completed successfully!")
+
+def compact_snapshots(processor: DataProcessor, config: dict):
+    """Fold this run's snapshot files into data/archive ("archive": {"compact": false} to skip)"""
+    if not config.get('archive', {}).get('compact', True):
+        return
+    try:
+        counts = archive_from_config(processor.data_dir, config).compact()
+        print("Archived snapshots: " + ", ".join(f"{k}={v}" for k, v in counts.items()))
+    except Exception as e:
+        print(f"Error compacting snapshots: {str(e)}")
+
 def main():
     config = load_config()
     if config.get('api_key') == 'YOUR-API-KEY':
         print("Please update the API key in config.json")
         return
 
-    processor = DataProcessor()
+    processor = DataProcessor(engine=config.get('engine', 'pandas'),
+                              sketch_params=sketch_params_from_config(config))
+    if config.get('force', False):
+        # Ignore the fingerprints and rerun every stage
+        processor.fingerprints.clear()
     
     spreadsheet_id = config.get('spreadsheet_id')
     api_key = config.get('api_key')
+
+    if config.get('incremental', False):
+        run_incremental(processor, spreadsheet_id, api_key)
+        compact_snapshots(processor, config)
+        return
     
     print("\n=== Step 1: Downloading Spreadsheet ===")
     raw_data = processor.download_spreadsheet(spreadsheet_id, api_key)
     
-    if raw_data is not None:
-        print("\n=== Step 2: Processing Raw Data ===")
-        processed_data = processor.process_raw_data(raw_data)
-        
-        if processed_data is not None:
-            print("\n=== Step 3: Preparing Dashboard Data ===")
-            processor.prepare_dashboard_data(processed_data)
-            
-            print("\nAll processing steps completed successfully!")
-        else:
-            print("Failed to process raw data")
-    else:
+    if raw_data is None:
         print("Failed to download spreadsheet")
+        return
+    if processor.fingerprints.unchanged('raw'):
+        print("Spreadsheet unchanged since the last published run; nothing to do")
+        return
+    
+    print("\n=== Step 2: Processing Raw Data ===")
+    processed_data = processor.process_raw_data(raw_data)
+    if processed_data is None:
+        print("Failed to process raw data")
+        return
+    
+    if processor.fingerprints.unchanged('processed'):
+        print("Processed data unchanged; skipping dashboard data")
+    else:
+        print("\n=== Step 3: Preparing Dashboard Data ===")
+        if not processor.prepare_dashboard_data(processed_data):
+            return
+    
+    processor.fingerprints.commit()
+    print("\nAll processing steps completed successfully!")
+    compact_snapshots(processor, config)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
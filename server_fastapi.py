@@ -1,10 +1,9 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 from pathlib import Path
-import pandas as pd
 import pyarrow.parquet as pq
 import socket
 import requests
@@ -12,8 +11,97 @@ import os
 import subprocess
 import sys
 import platform
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from metrics_cache import FORMAT_CONTENT_TYPES, choose_encoding, choose_format
+from metrics_db import shared_metrics_cache
+from metrics_query import QueryError, parse_query
 
-app = FastAPI(title="Hitaiou Dashboard")
+# 新しいスナップショットの確認間隔と、SSE接続のキープアライブ間隔 (秒)
+SNAPSHOT_POLL_INTERVAL = 2
+EVENT_HEARTBEAT_INTERVAL = 30
+
+class SnapshotNotifier:
+    """
+    新しいスナップショットを待機中の全SSE接続に通知
+    接続ごとのキューは持たず、1つのイベントを全員で待つ
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.message = None
+        self._event = asyncio.Event()
+
+    def publish(self, message: str):
+        self.version += 1
+        self.message = message
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+    async def wait(self, version: int, timeout: float) -> bool:
+        """version より新しい通知があれば True、timeout なら False"""
+        if self.version != version:
+            return True
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+snapshot_notifier = SnapshotNotifier()
+
+def refresh_snapshot(last_key=None):
+    """
+    最新のスナップショットを読み込み、新しければ圧縮ボディなどを事前生成
+    ワーカースレッドで実行する
+    """
+    snapshot = shared_metrics_cache().get()
+    if snapshot is not None and snapshot.key != last_key:
+        snapshot.warm()
+    return snapshot
+
+async def watch_snapshots(last_key=None):
+    """マニフェストを監視し、新しいスナップショットを読み込んで通知"""
+    while True:
+        await asyncio.sleep(SNAPSHOT_POLL_INTERVAL)
+        try:
+            snapshot = await asyncio.to_thread(refresh_snapshot, last_key)
+            if snapshot is not None and snapshot.key != last_key:
+                last_key = snapshot.key
+                publish_snapshot_event(snapshot)
+        except Exception as e:
+            print(f"[WARNING] スナップショットの確認に失敗しました: {e}")
+
+def publish_snapshot_event(snapshot):
+    snapshot_notifier.publish(json.dumps({
+        "filename": snapshot.filename,
+        "timestamp": snapshot.timestamp,
+        "etag": snapshot.etag(),
+        "version": snapshot.version
+    }, ensure_ascii=False))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    起動時にメトリクスを読み込み、以降は終了までバックグラウンドで更新
+    リクエスト処理中にファイルを読むことはない
+    """
+    last_key = None
+    try:
+        snapshot = await asyncio.to_thread(refresh_snapshot)
+        if snapshot is not None:
+            last_key = snapshot.key
+            publish_snapshot_event(snapshot)
+    except Exception as e:
+        print(f"[WARNING] メトリクスの読み込みに失敗しました: {e}")
+    snapshot_watcher = asyncio.create_task(watch_snapshots(last_key))
+    try:
+        yield
+    finally:
+        snapshot_watcher.cancel()
+
+app = FastAPI(title="Hitaiou Dashboard", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -171,34 +259,84 @@ async def read_root():
             )
 
 @app.get("/api/demand-metrics")
-async def get_demand_metrics():
-    """需要メトリクスデータを返す"""
+async def get_demand_metrics(request: Request):
+    """
+    需要メトリクスデータを返す
+    limit / offset / sort / order / min_requests / price_min / price_max /
+    avatar_id / item_id を指定するとページング・フィルタ済みの行だけを返す
+    format=columns または Accept: application/vnd.apache.arrow.stream で
+    列指向JSON / Arrow IPC を返す
+    """
     try:
-        dashboard_dir = Path("data/dashboard")
-        parquet_files = list(dashboard_dir.glob("demand_metrics_*.parquet"))
+        query = parse_query(request.query_params)
+        # 読み込みはバックグラウンドで行うので、ここではファイルを確認しない
+        snapshot = shared_metrics_cache().peek()
         
-        if not parquet_files:
+        if snapshot is None:
             return JSONResponse(
                 status_code=404,
                 content={"error": "No metrics data found"}
             )
-            
-        latest_file = max(parquet_files, key=lambda p: p.stat().st_mtime)
-        df = pd.read_parquet(latest_file)
-        df = df.sort_values('potential_sales', ascending=False)
         
-        return JSONResponse(content={
-            "data": df.to_dict(orient='records'),
-            "timestamp": latest_file.stat().st_mtime,
-            "filename": latest_file.name
-        })
+        # 全件は要求された形式の圧縮済みボディ、ページング結果は非圧縮の行形式で返す
+        if query is None:
+            fmt = choose_format(request.headers.get('accept'), request.query_params.get('format'))
+            encoding = choose_encoding(request.headers.get('accept-encoding'))
+        else:
+            fmt = 'rows'
+            encoding = 'identity'
+        headers = snapshot.response_headers(encoding, fmt, query)
+        
+        # データが変わっていなければ304
+        if snapshot.matches(request.headers.get('if-none-match'), fmt, query):
+            headers.pop('Content-Encoding', None)
+            return Response(status_code=304, headers=headers)
+        
+        if query is None:
+            # エンコード済みのボディをそのまま返す (未生成ならスレッドで生成)
+            content = snapshot.cached_body(encoding, fmt)
+            if content is None:
+                content = await asyncio.to_thread(snapshot.encoded_body, encoding, fmt)
+        else:
+            content = await asyncio.to_thread(snapshot.query_body, query)
+        return Response(content=content, media_type=FORMAT_CONTENT_TYPES[fmt], headers=headers)
         
+    except QueryError as e:
+        return JSONResponse(
+            status_code=400,
+            content={"error": str(e)}
+        )
     except Exception as e:
         return JSONResponse(
             status_code=500,
             content={"error": str(e)}
         )
 
+@app.get("/api/events")
+async def stream_events():
+    """
+    新しいスナップショットの通知をServer-Sent Eventsで配信
+    接続時に現在のスナップショットを1回送る
+    """
+    async def event_stream():
+        version = snapshot_notifier.version
+        yield "retry: 5000\n\n"
+        if snapshot_notifier.message is not None:
+            yield f"event: snapshot\ndata: {snapshot_notifier.message}\n\n"
+        while True:
+            if await snapshot_notifier.wait(version, EVENT_HEARTBEAT_INTERVAL):
+                version = snapshot_notifier.version
+                yield f"event: snapshot\ndata: {snapshot_notifier.message}\n\n"
+            else:
+                # プロキシに切断されないようにコメント行を送る
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 def main():
     """メイン関数"""
     static_dir = Path("static")
@@ -214,7 +352,7 @@ def main():
     display_server_info(port)
     
     uvicorn.run(
-        "server:app",
+        "server_fastapi:app",
         host="0.0.0.0",
         port=port,
         reload=True
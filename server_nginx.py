@@ -1,25 +1,27 @@
 # server.py
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import BaseHTTPRequestHandler
 import json
-from pathlib import Path
-import pandas as pd
 import socket
 import requests
 import platform
 import subprocess
 import os
+from urllib.parse import urlparse
+from metrics_handler import MetricsHandlerMixin
+from pooled_server import create_server, parse_server_args
 
-class DashboardHandler(BaseHTTPRequestHandler):
+class DashboardHandler(MetricsHandlerMixin, BaseHTTPRequestHandler):
     def do_GET(self):
         """
         GETリクエストの処理
         HTTPプロトコルに従って、正しい順序でヘッダーとボディを送信
         """
         try:
-            if self.path == '/':
+            url = urlparse(self.path)
+            if url.path == '/':
                 self.handle_root()
-            elif self.path == '/api/demand-metrics':
-                self.handle_metrics()
+            elif url.path == '/api/demand-metrics':
+                self.handle_metrics(url.query)
             else:
                 self.handle_not_found()
         except Exception as e:
@@ -37,63 +39,55 @@ class DashboardHandler(BaseHTTPRequestHandler):
                 {
                     "path": "/api/demand-metrics",
                     "method": "GET",
-                    "description": "需要メトリクスデータを取得"
+                    "description": "需要メトリクスデータを取得",
+                    "query": {
+                        "limit": "取得件数 (指定時はページング, 最大1000)",
+                        "offset": "開始位置 (レスポンスの next_offset を指定)",
+                        "sort": "ソートする列 (DASHBOARD_COLUMNS)",
+                        "order": "asc / desc",
+                        "min_requests": "最小リクエスト数",
+                        "price_min": "中央値価格の下限",
+                        "price_max": "中央値価格の上限",
+                        "avatar_id": "アバターID",
+                        "item_id": "アイテムID",
+                        "format": "rows (既定) / columns (列指向JSON) / arrow (Arrow IPC)"
+                    }
                 }
             ]
         }
         self.send_json_response(200, response_data)
 
-    def handle_metrics(self):
+    def send_json_response(self, status_code, data):
         """
-        メトリクスデータのハンドラー
-        Parquetファイルからデータを読み込んで返す
+        JSON形式でレスポンスを送信
         """
-        try:
-            dashboard_dir = Path("data/dashboard")
-            parquet_files = list(dashboard_dir.glob("demand_metrics_*.parquet"))
-            
-            if not parquet_files:
-                self.handle_not_found("No metrics data found")
-                return
-                
-            latest_file = max(parquet_files, key=lambda p: p.stat().st_mtime)
-            df = pd.read_parquet(latest_file)
-            df = df.sort_values('potential_sales', ascending=False)
-            
-            response_data = {
-                "data": df.to_dict(orient='records'),
-                "timestamp": latest_file.stat().st_mtime,
-                "filename": latest_file.name
-            }
-            self.send_json_response(200, response_data)
-            
-        except Exception as e:
-            self.handle_server_error(str(e))
+        # データをJSON形式にエンコード
+        response_body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_body_response(status_code, response_body)
 
-    def send_json_response(self, status_code, data):
+    def send_body_response(self, status_code, response_body, content_type='application/json', headers=None):
         """
-        JSON形式でレスポンスを送信
+        エンコード済みのボディでレスポンスを送信
         ヘッダーの送信順序を厳密に管理
         """
         # 1. まずステータスコードを送信
         self.send_response(status_code)
         
         # 2. 必要なヘッダーをすべて送信
-        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Type', content_type)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         
-        # 3. データをJSON形式にエンコード
-        response_body = json.dumps(data, ensure_ascii=False).encode('utf-8')
-        
-        # 4. Content-Lengthヘッダーを送信
+        # 3. Content-Lengthヘッダーを送信
         self.send_header('Content-Length', str(len(response_body)))
         
-        # 5. ヘッダーの終了を明示
+        # 4. ヘッダーの終了を明示
         self.end_headers()
         
-        # 6. レスポンスボディを送信
+        # 5. レスポンスボディを送信
         self.wfile.write(response_body)
 
     def handle_not_found(self, message="Resource not found"):
@@ -127,6 +121,8 @@ class DashboardHandler(BaseHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        # HTTP/1.1で接続を維持するため、ボディがないことを明示
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
 def get_local_ip():
@@ -188,7 +184,10 @@ def main():
     print("\nCtrl+C で終了")
     print("-"*60 + "\n")
     
-    server = HTTPServer(('0.0.0.0', API_PORT), DashboardHandler)
+    args = parse_server_args()
+    print(f"サーバーモード: {args.mode}" + (f" (workers={args.workers})" if args.mode == 'pool' else ""))
+    server = create_server(('0.0.0.0', API_PORT), DashboardHandler, args.mode, args.workers,
+                           args.idle_timeout, args.max_queued)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
@@ -0,0 +1,198 @@
+"""
+Paged Google Sheets download
+Rows are requested in bounded A1 ranges over one pooled keep-alive session
+with compressed responses, timeouts and exponential backoff, and each page is
+converted straight into per-column Arrow arrays, so neither the whole JSON
+response nor a list of row lists is ever held for the full sheet
+"""
+
+import re
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+from http_retry import RETRY_STATUSES, retry_delay
+
+SHEETS_VALUES_URL = "https://sheets.googleapis.com/v4/spreadsheets/{spreadsheet_id}/values/{a1_range}"
+SHEETS_BATCH_URL = "https://sheets.googleapis.com/v4/spreadsheets/{spreadsheet_id}/values:batchGet"
+
+LAST_COLUMN = 'Z'
+DEFAULT_PAGE_ROWS = 5000
+# (connect, read) seconds
+DEFAULT_TIMEOUT = (5.0, 60.0)
+DEFAULT_RETRIES = 4
+DEFAULT_BACKOFF = 1.0
+
+
+class SheetsError(Exception):
+    """再試行しても範囲を取得できなかった"""
+
+
+class SheetsClient:
+    """
+    Sheets API (values.get / values.batchGet) のクライアント
+    - 1つの requests.Session を使い回す (keep-alive, gzip/br)
+    - 429/5xx と通信エラーは指数バックオフで再試行 (Retry-After を優先)
+    """
+
+    def __init__(self, api_key: str, timeout: Tuple[float, float] = DEFAULT_TIMEOUT,
+                 retries: int = DEFAULT_RETRIES, backoff: float = DEFAULT_BACKOFF,
+                 base_url: str = SHEETS_VALUES_URL, batch_url: str = SHEETS_BATCH_URL):
+        self.api_key = api_key
+        self.timeout = tuple(timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.base_url = base_url
+        self.batch_url = batch_url
+
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = 'br, gzip' if brotli is not None else 'gzip'
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self.session.close()
+
+    def _retry_delay(self, attempt: int, headers: Optional[Dict[str, str]] = None) -> float:
+        return retry_delay(attempt, self.backoff, headers)
+
+    def _get_json(self, url: str, params: dict, a1_range: str, digest=None) -> dict:
+        """再試行付きの GET。digest があればレスポンスの本文をハッシュに加える"""
+        params = dict(params, key=self.api_key, majorDimension='ROWS',
+                      valueRenderOption='UNFORMATTED_VALUE')
+        for attempt in range(self.retries + 1):
+            headers = None
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except requests.RequestException as e:
+                error = str(e)
+            else:
+                if response.status_code == 200:
+                    if digest is not None:
+                        digest.update(response.content)
+                    return response.json()
+                if response.status_code not in RETRY_STATUSES:
+                    raise SheetsError(f"range {a1_range}: HTTP {response.status_code}")
+                error = f"HTTP {response.status_code}"
+                headers = response.headers
+
+            if attempt < self.retries:
+                delay = self._retry_delay(attempt, headers)
+                print(f"Range {a1_range} failed ({error}); retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+        raise SheetsError(f"range {a1_range}: {error} after {self.retries + 1} attempts")
+
+    def fetch_values(self, spreadsheet_id: str, a1_range: str, digest=None) -> list:
+        """1つの A1 範囲の値 (行のリスト)。取得できなければ SheetsError"""
+        url = self.base_url.format(spreadsheet_id=spreadsheet_id, a1_range=a1_range)
+        return self._get_json(url, {}, a1_range, digest).get('values', [])
+
+    def fetch_ranges(self, spreadsheet_id: str, a1_ranges: List[str]) -> List[list]:
+        """複数の A1 範囲を1回のリクエストで取得 (values:batchGet)"""
+        url = self.batch_url.format(spreadsheet_id=spreadsheet_id)
+        data = self._get_json(url, {'ranges': a1_ranges}, ', '.join(a1_ranges))
+        value_ranges = data.get('valueRanges', [])
+        return [value_range.get('values', []) for value_range in value_ranges]
+
+    def iter_pages(self, spreadsheet_id: str, start_row: int,
+                   page_rows: int = DEFAULT_PAGE_ROWS, digest=None) -> Iterator[Tuple[int, list]]:
+        """
+        start_row から page_rows 行ずつ (先頭の行番号, 行のリスト) を返す
+        行のない (空の) ページか、シートのグリッドの最終行を含むページで終わる
+        digest (hashlib のオブジェクト) があれば各ページの本文で更新する
+        """
+        while True:
+            end = start_row + page_rows - 1
+            a1_range = f"A{start_row}:{LAST_COLUMN}{end}"
+            url = self.base_url.format(spreadsheet_id=spreadsheet_id, a1_range=a1_range)
+            data = self._get_json(url, {}, a1_range, digest)
+            values = data.get('values', [])
+            yield start_row, values
+            # Trailing blank rows are trimmed from every page, so a short page
+            # may be followed by more responses. The returned range is cut off
+            # at the sheet's grid, which marks the real last page
+            grid_end = _range_end_row(data.get('range', ''))
+            if not values or (grid_end is not None and grid_end < end):
+                return
+            start_row = end + 1
+
+
+def _range_end_row(a1_range: str) -> Optional[int]:
+    """A1 範囲 ("シート1!A1:Z1000" など) の最後の行番号 (行番号がなければ None)"""
+    match = re.search(r'(\d+)$', a1_range)
+    return int(match.group(1)) if match else None
+
+
+def _column_array(values: list) -> pa.Array:
+    """1ページ分の列を Arrow 配列に変換 (型が混在する列は文字列)"""
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if v is None else str(v) for v in values], pa.string())
+
+
+def _common_type(types: List[pa.DataType]) -> pa.DataType:
+    """ページごとに推論された型をまとめる (数値同士は数値、それ以外は文字列)"""
+    present = {t for t in types if not pa.types.is_null(t)}
+    if not present:
+        return pa.null()
+    if len(present) == 1:
+        return present.pop()
+    if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in present):
+        return pa.float64()
+    return pa.string()
+
+
+class ColumnarRows:
+    """
+    ページごとの行を列ごとの Arrow 配列として蓄積する
+    ヘッダーより短い行 (末尾の空セルは返されない) は null で埋め、長い行は切り詰める
+    """
+
+    def __init__(self, headers: List[str]):
+        self.headers = list(headers)
+        self.num_rows = 0
+        self.last_row: Optional[list] = None
+        self._chunks: List[List[pa.Array]] = [[] for _ in self.headers]
+
+    def append(self, rows: list) -> None:
+        if not rows:
+            return
+        for i, chunks in enumerate(self._chunks):
+            chunks.append(_column_array([row[i] if len(row) > i else None for row in rows]))
+        self.num_rows += len(rows)
+        self.last_row = rows[-1]
+
+    def to_table(self) -> pa.Table:
+        columns = []
+        for chunks in self._chunks:
+            target = _common_type([chunk.type for chunk in chunks])
+            columns.append(pa.chunked_array(
+                [chunk if chunk.type == target else chunk.cast(target) for chunk in chunks],
+                type=target
+            ))
+        # Headers may repeat, so the table is built from arrays and positional names
+        return pa.Table.from_arrays(columns, names=self.headers)
+
+    def to_frame(self) -> pd.DataFrame:
+        """DataFrame に変換 (ヘッダー行のみの場合は空)"""
+        if self.num_rows == 0:
+            return pd.DataFrame(columns=self.headers)
+        return self.to_table().to_pandas()
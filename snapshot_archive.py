@@ -0,0 +1,301 @@
+"""
+Compaction, retention and point-in-time queries over the per-run snapshots
+Every run leaves a full raw_data_*.csv, processed_data_*.parquet and
+demand_metrics_*.parquet. compact() folds them into one hive-partitioned
+parquet dataset per kind (data/archive/<kind>/date=YYYY-MM-DD/), one file per
+day with one row group per run and a snapshot_at column, and then deletes the
+loose files. Only the snapshot being served stays in place.
+
+as_of() answers "the snapshot current at time T" by reading just snapshot_at
+to pick the run and then that run's rows; the date partition and the row group
+statistics on snapshot_at let the scan skip every other day and run
+"""
+
+import argparse
+import re
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from config_handler import read_config
+from snapshot_manifest import read_manifest
+
+SNAPSHOT_COLUMN = 'snapshot_at'
+PARTITION_COLUMN = 'date'
+PARTITIONING = ds.partitioning(pa.schema([(PARTITION_COLUMN, pa.string())]), flavor='hive')
+
+# kind -> (directory under data/, file pattern)
+SNAPSHOT_SOURCES = {
+    'raw': ('raw', 'raw_data_*.csv'),
+    'processed': ('processed', 'processed_data_*.parquet'),
+    'demand_metrics': ('dashboard', 'demand_metrics_*.parquet'),
+}
+
+TIMESTAMP_PATTERN = re.compile(r'_(\d{8}_\d{6})\.[a-z]+$')
+
+# Runs from the last keep_all_days are all kept; older days keep only their
+# last run, and days older than keep_daily_days are dropped (None: never)
+DEFAULT_KEEP_ALL_DAYS = 7
+DEFAULT_KEEP_DAILY_DAYS = None
+
+
+def snapshot_time(path: Path) -> Optional[datetime]:
+    """ファイル名の _YYYYMMDD_HHMMSS からスナップショットの時刻を取得"""
+    match = TIMESTAMP_PATTERN.search(path.name)
+    if match is None:
+        return None
+    return datetime.strptime(match.group(1), '%Y%m%d_%H%M%S')
+
+
+def read_snapshot_file(path: Path) -> pa.Table:
+    """
+    スナップショットを Arrow テーブルとして読む
+    生データの CSV は実行ごとに型推論が変わらないようにすべて文字列で読む
+    """
+    if path.suffix == '.csv':
+        return pa.Table.from_pandas(pd.read_csv(path, dtype=str), preserve_index=False)
+    return pq.read_table(path)
+
+
+def _archive_type(data_type: pa.DataType) -> pa.DataType:
+    """アーカイブ上の型 (辞書型は値の型、真偽値は int8)"""
+    if pa.types.is_dictionary(data_type):
+        data_type = data_type.value_type
+    return pa.int8() if pa.types.is_boolean(data_type) else data_type
+
+
+def _is_number(data_type: pa.DataType) -> bool:
+    return pa.types.is_integer(data_type) or pa.types.is_floating(data_type)
+
+
+def _unify(schemas: List[pa.Schema]) -> pa.Schema:
+    """
+    スキーマを統一する。数値同士は広い型にまとめ、それ以外で型が食い違う列
+    (文字列だった ID と整数の ID など) は文字列にする
+    """
+    schemas = [pa.schema([field.with_type(_archive_type(field.type)) for field in schema])
+               for schema in schemas]
+    types: Dict[str, set] = {}
+    for schema in schemas:
+        for field in schema:
+            if not pa.types.is_null(field.type):
+                types.setdefault(field.name, set()).add(field.type)
+    conflicting = {name for name, found in types.items()
+                   if len(found) > 1 and not all(_is_number(t) for t in found)}
+    schemas = [pa.schema([field.with_type(pa.string()) if field.name in conflicting else field
+                          for field in schema]) for schema in schemas]
+    return pa.unify_schemas(schemas, promote_options='permissive')
+
+
+def _conform(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """列の順序と型をスキーマに合わせる (ない列は null、フォームの質問が変わった場合など)"""
+    columns = [
+        table[field.name].cast(field.type) if field.name in table.column_names
+        else pa.nulls(table.num_rows, field.type)
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def _with_snapshot_time(table: pa.Table, when: datetime) -> pa.Table:
+    column = pa.array([when] * table.num_rows, pa.timestamp('s'))
+    return table.append_column(SNAPSHOT_COLUMN, column)
+
+
+class SnapshotArchive:
+    """data/archive 以下の種類ごとのパーティション分割済みデータセット"""
+
+    def __init__(self, data_dir: Path = Path("data"), archive_dir: Optional[Path] = None,
+                 keep_all_days: Optional[int] = DEFAULT_KEEP_ALL_DAYS,
+                 keep_daily_days: Optional[int] = DEFAULT_KEEP_DAILY_DAYS):
+        self.data_dir = Path(data_dir)
+        self.archive_dir = Path(archive_dir) if archive_dir else self.data_dir / "archive"
+        self.keep_all_days = keep_all_days
+        self.keep_daily_days = keep_daily_days
+
+    def _loose_files(self, kind: str) -> List[Path]:
+        subdir, pattern = SNAPSHOT_SOURCES[kind]
+        return sorted(p for p in (self.data_dir / subdir).glob(pattern) if snapshot_time(p))
+
+    def _serving_snapshot(self) -> Optional[str]:
+        """配信中のスナップショット (マニフェストがなければ最新のファイル)"""
+        manifest = read_manifest(self.data_dir / "dashboard")
+        if manifest is not None:
+            return manifest['file']
+        files = self._loose_files('demand_metrics')
+        return max(files, key=lambda p: p.stat().st_mtime).name if files else None
+
+    def _partition_path(self, kind: str, day: str) -> Path:
+        return self.archive_dir / kind / f"{PARTITION_COLUMN}={day}" / "part-0.parquet"
+
+    def _write_partition(self, path: Path, runs: Dict[datetime, pa.Table]) -> None:
+        """
+        1日分のスナップショットを1ファイルに書く (1回の実行 = 1行グループ)
+        一時ファイルに書いてからリネームする。行のない実行は残らない
+        """
+        tables = [runs[when] for when in sorted(runs)]
+        schema = _unify([t.schema for t in tables])
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        with pq.ParquetWriter(tmp_path, schema, compression='zstd') as writer:
+            for table in tables:
+                if table.num_rows:
+                    writer.write_table(_conform(table, schema), row_group_size=table.num_rows)
+        tmp_path.replace(path)
+
+    def _read_partition(self, path: Path) -> Dict[datetime, pa.Table]:
+        """既存のパーティションを実行ごとのテーブルに分けて読む"""
+        if not path.exists():
+            return {}
+        parquet_file = pq.ParquetFile(path)
+        runs: Dict[datetime, List[pa.Table]] = {}
+        for i in range(parquet_file.num_row_groups):
+            group = parquet_file.read_row_group(i)
+            if group.num_rows:
+                runs.setdefault(group[SNAPSHOT_COLUMN][0].as_py(), []).append(group)
+        return {when: pa.concat_tables(groups) for when, groups in runs.items()}
+
+    def compact(self, now: Optional[datetime] = None) -> Dict[str, int]:
+        """
+        散らばったスナップショットをアーカイブに追加して削除し、保持ポリシーを適用
+        配信中のスナップショットは追加するが残す
+        種類ごとに取り込んだファイル数を返す
+        """
+        serving = self._serving_snapshot()
+        counts = {}
+
+        for kind in SNAPSHOT_SOURCES:
+            files = self._loose_files(kind)
+            by_day: Dict[str, List[Path]] = {}
+            for path in files:
+                by_day.setdefault(snapshot_time(path).strftime('%Y-%m-%d'), []).append(path)
+
+            for day, paths in by_day.items():
+                partition = self._partition_path(kind, day)
+                runs = self._read_partition(partition)
+                for path in paths:
+                    # Re-running after an interrupted compaction replaces the run
+                    when = snapshot_time(path)
+                    runs[when] = _with_snapshot_time(read_snapshot_file(path), when)
+                self._write_partition(partition, runs)
+                for path in paths:
+                    if path.name != serving:
+                        path.unlink()
+
+            counts[kind] = len(files)
+            self.apply_retention(kind, now)
+        return counts
+
+    def apply_retention(self, kind: str, now: Optional[datetime] = None) -> None:
+        """保持期間を過ぎた日は最後の実行だけを残し、さらに古い日は削除"""
+        now = now or datetime.now()
+        for partition_dir in sorted((self.archive_dir / kind).glob(f"{PARTITION_COLUMN}=*")):
+            day = datetime.strptime(partition_dir.name.split('=', 1)[1], '%Y-%m-%d')
+            age = (now - day).days
+            path = partition_dir / "part-0.parquet"
+            if self.keep_daily_days is not None and age > self.keep_daily_days:
+                path.unlink(missing_ok=True)
+                partition_dir.rmdir()
+            elif self.keep_all_days is not None and age > self.keep_all_days:
+                if pq.ParquetFile(path).metadata.num_row_groups > 1:
+                    runs = self._read_partition(path)
+                    latest = max(runs)
+                    self._write_partition(path, {latest: runs[latest]})
+
+    def dataset(self, kind: str) -> Optional[ds.Dataset]:
+        """種類ごとのデータセット (パーティションの列型の違いは統一する)"""
+        root = self.archive_dir / kind
+        if not root.exists():
+            return None
+        dataset = ds.dataset(root, format='parquet', partitioning=PARTITIONING)
+        if not dataset.files:
+            return None
+        schema = _unify([pq.read_schema(path) for path in dataset.files])
+        schema = schema.append(pa.field(PARTITION_COLUMN, pa.string()))
+        return ds.dataset(root, format='parquet', partitioning=PARTITIONING, schema=schema)
+
+    def snapshots(self, kind: str = 'demand_metrics') -> List[datetime]:
+        """アーカイブ済みの実行時刻 (snapshot_at 列だけを読む)"""
+        dataset = self.dataset(kind)
+        if dataset is None:
+            return []
+        times = dataset.to_table(columns=[SNAPSHOT_COLUMN])[SNAPSHOT_COLUMN]
+        return sorted(pc.unique(times).to_pylist())
+
+    def as_of(self, when: datetime, kind: str = 'demand_metrics',
+              columns: Optional[List[str]] = None,
+              filter: Optional[ds.Expression] = None) -> Optional[pd.DataFrame]:
+        """
+        時刻 when の時点で最新だったスナップショット (なければ None)
+        filter は pyarrow.dataset の式で、行の読み込み時に適用する
+        """
+        dataset = self.dataset(kind)
+        if dataset is None:
+            return None
+
+        snapshot = pc.field(SNAPSHOT_COLUMN)
+        day = pc.field(PARTITION_COLUMN)
+        bound = pa.scalar(when, pa.timestamp('s'))
+        times = dataset.to_table(
+            columns=[SNAPSHOT_COLUMN],
+            filter=(day <= when.strftime('%Y-%m-%d')) & (snapshot <= bound)
+        )[SNAPSHOT_COLUMN]
+        if len(times) == 0:
+            return None
+        latest = pc.max(times)
+
+        condition = (day == latest.as_py().strftime('%Y-%m-%d')) & (snapshot == latest)
+        if filter is not None:
+            condition = condition & filter
+        if columns is None:
+            columns = [name for name in dataset.schema.names if name != PARTITION_COLUMN]
+        return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+
+def metrics_as_of(when: datetime, data_dir: Path = Path("data"), **kwargs) -> Optional[pd.DataFrame]:
+    """時刻 when の時点の需要メトリクス (potential_sales の降順)"""
+    df = SnapshotArchive(data_dir).as_of(when, 'demand_metrics', **kwargs)
+    if df is not None and 'potential_sales' in df.columns:
+        df = df.sort_values('potential_sales', ascending=False, ignore_index=True)
+    return df
+
+
+def archive_from_config(data_dir: Path = Path("data"), config: Optional[dict] = None) -> SnapshotArchive:
+    """config.json の "archive" (keep_all_days / keep_daily_days) からアーカイブを作成"""
+    archive_config = (config if config is not None else read_config()).get('archive', {})
+    return SnapshotArchive(
+        data_dir,
+        keep_all_days=archive_config.get('keep_all_days', DEFAULT_KEEP_ALL_DAYS),
+        keep_daily_days=archive_config.get('keep_daily_days', DEFAULT_KEEP_DAILY_DAYS),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Snapshot archive")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('compact', help="スナップショットをアーカイブにまとめる")
+    as_of_parser = subparsers.add_parser('as-of', help="指定時刻の時点のスナップショットを表示")
+    as_of_parser.add_argument('when', type=datetime.fromisoformat, help="例: 2025-01-25T22:00")
+    as_of_parser.add_argument('--kind', choices=list(SNAPSHOT_SOURCES), default='demand_metrics')
+    args = parser.parse_args()
+
+    archive = archive_from_config()
+    if args.command == 'compact':
+        counts = archive.compact()
+        print("Archived snapshots: " + ", ".join(f"{k}={v}" for k, v in counts.items()))
+    else:
+        df = archive.as_of(args.when, args.kind)
+        if df is None:
+            print(f"No snapshot at or before {args.when}")
+        else:
+            print(df)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Atomic publishing of dashboard snapshots
+Snapshots are written to a temp file and renamed into place, then a small
+manifest pointing at the latest snapshot is replaced atomically
+"""
+
+import hashlib
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from column_schema import PARQUET_COMPRESSION
+
+MANIFEST_NAME = "latest.json"
+
+
+def atomic_write_bytes(path: Path, data: bytes) -> None:
+    """一時ファイルに書き込んでからリネームする"""
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def file_checksum(path: Path) -> str:
+    """ファイルのSHA-256チェックサム"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def publish_snapshot(df: Union[pd.DataFrame, pa.Table], dashboard_dir: Path, timestamp: str) -> Path:
+    """
+    demand_metrics_<timestamp>.parquet を書き込み、マニフェストを更新
+    読み込み側が書き込み途中のファイルを拾うことはない
+    Arrow テーブルは pandas を経由せずにそのまま書き込む
+    """
+    dashboard_dir = Path(dashboard_dir)
+    snapshot_path = dashboard_dir / f"demand_metrics_{timestamp}.parquet"
+
+    # The temp name does not match demand_metrics_*.parquet
+    tmp_path = snapshot_path.with_name(f".{snapshot_path.name}.tmp")
+    if isinstance(df, pa.Table):
+        pq.write_table(df, tmp_path, compression=PARQUET_COMPRESSION)
+    else:
+        # The row index (sort positions) is not part of the snapshot
+        df.to_parquet(tmp_path, compression=PARQUET_COMPRESSION, index=False)
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    checksum = file_checksum(tmp_path)
+    os.replace(tmp_path, snapshot_path)
+
+    manifest = {
+        "file": snapshot_path.name,
+        "row_count": len(df),
+        "checksum": checksum,
+        "generated_at": datetime.now().isoformat()
+    }
+    atomic_write_bytes(
+        dashboard_dir / MANIFEST_NAME,
+        json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8')
+    )
+    return snapshot_path
+
+
+def read_manifest(dashboard_dir: Path) -> Optional[dict]:
+    """マニフェストを読み込む (存在しない場合は None)"""
+    try:
+        with open(Path(dashboard_dir) / MANIFEST_NAME, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,145 @@
+"""
+Engine benchmark for the processing pipeline: pandas against arrow
+    python tests/bench_engines.py [--rows N ...] [--engines pandas arrow] [--seed N]
+Generates column-mapped form responses (every URL form from Poll.md, messy
+prices, repeated users) and times, per engine, the steps that differ between
+them: process_rows, writing the processed rows to parquet, and
+prepare_dashboard_data (demand metrics and the published snapshot). The
+master_matching upsert is shared by both engines and left out. Each engine runs
+in its own process so the peak RSS is its own, and the published snapshots are
+compared at the end (an engine killed for running out of memory is reported
+as failed)
+"""
+
+import argparse
+import contextlib
+import io
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from process import ENGINES, DataProcessor  # noqa: E402
+
+URL_PREFIXES = [
+    'https://booth.pm/ja/items/',
+    'https://booth.pm/items/',
+    'https://shop1.booth.pm/items/',
+    'https://shop2.booth.pm/items/',
+    ' https://booth.pm/en/items/',
+    '',
+]
+PRICES = ['1000', '2,000円', '', None, '3000', 'free', '500', '1500', '¥2500']
+
+
+def coded(rng, rows, values):
+    """values から一様に選んだ文字列の列 (辞書を展開して作るので行ごとの Python 文字列を作らない)"""
+    indices = pa.array(rng.integers(0, len(values), rows).astype('int32'))
+    return pa.DictionaryArray.from_arrays(indices, pa.array(values, pa.string())).dictionary_decode()
+
+
+def url_column(rng, rows, ids):
+    return pc.binary_join_element_wise(
+        coded(rng, rows, URL_PREFIXES), pa.array(ids).cast(pa.string()), ''
+    )
+
+
+def raw_table(rows, seed):
+    """列名を対応付けた生データ (すべて文字列、シートから読んだ場合と同じ)"""
+    rng = np.random.default_rng(seed)
+    return pa.table({
+        'timestamp': pa.array(45600 + rng.random(rows)).cast(pa.string()),
+        'avatar_url': url_column(rng, rows, rng.integers(1_000_000, 1_000_200, rows)),
+        'item_url': url_column(rng, rows, rng.integers(2_000_000, 2_000_000 + max(rows // 50, 1), rows)),
+        'twitter_id': pc.binary_join_element_wise(
+            pa.scalar('@user'), pa.array(rng.integers(0, max(rows // 3, 1), rows)).cast(pa.string()), ''
+        ),
+        'desired_price': coded(rng, rows, PRICES),
+        'hitaiou_worker_name': coded(rng, rows, ['']),
+    })
+
+
+def run_engine(engine, rows, seed, work_dir):
+    """1つのエンジンで各ステップを実行し、(ステップごとの秒数, ピーク RSS (MB), 公開したスナップショット) を返す"""
+    table = raw_table(rows, seed)
+    data = table if engine == 'arrow' else table.to_pandas()
+    del table
+    work_dir = Path(work_dir) / engine
+    work_dir.mkdir()
+    processor = DataProcessor(work_dir / "data", db_path=work_dir / "booth_data.db", engine=engine)
+
+    timings = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        processed = DataProcessor.process_rows(data, verbose=False)
+        timings['process_rows'] = time.perf_counter() - started
+        del data
+
+        started = time.perf_counter()
+        store_path = work_dir / "processed.parquet"
+        if isinstance(processed, pa.Table):
+            pq.write_table(processed, store_path)
+        else:
+            processed.to_parquet(store_path, engine='pyarrow')
+        timings['write parquet'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        processor.prepare_dashboard_data(processed)
+        timings['prepare_dashboard_data'] = time.perf_counter() - started
+
+    snapshot = sorted(processor.dashboard_dir.glob("demand_metrics_*.parquet"))[-1]
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return timings, peak_mb, str(snapshot)
+
+
+def run_and_send(sender, *args):
+    sender.send(run_engine(*args))
+    sender.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pandas and arrow engines")
+    parser.add_argument('--rows', type=int, nargs='+', default=[100_000, 1_000_000, 10_000_000],
+                        help="生データの行数 (複数指定可)")
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=ENGINES)
+    parser.add_argument('--seed', type=int, default=0, help="乱数のシード")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    for rows in args.rows:
+        print(f"\n{rows} rows")
+        snapshots = {}
+        with tempfile.TemporaryDirectory() as work_dir:
+            for engine in args.engines:
+                # A fresh process per engine keeps the peak RSS of one from hiding the other
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(target=run_and_send, args=(sender, engine, rows, args.seed, work_dir))
+                process.start()
+                sender.close()
+                process.join()
+                if process.exitcode != 0:
+                    # Usually the OOM killer on the largest sizes
+                    print(f"{engine:7s} failed (exit code {process.exitcode})")
+                    continue
+                timings, peak_mb, snapshot = receiver.recv()
+                steps = '  '.join(f"{step} {seconds:6.2f}s" for step, seconds in timings.items())
+                print(f"{engine:7s} {steps}  total {sum(timings.values()):6.2f}s  peak RSS {peak_mb:,.0f} MB")
+                snapshots[engine] = pd.read_parquet(snapshot)
+
+        if len(snapshots) > 1:
+            first, *others = snapshots.values()
+            print("identical snapshots:", all(other.equals(first) for other in others))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Event-loop latency benchmark for server_fastapi under concurrent clients
+    python tests/bench_fastapi_loop.py [--rows N ...] [--clients N] [--requests N] [--full]
+For each snapshot size the app is served by uvicorn in a separate process.
+A probe task on the server's event loop measures how late its timer fires
+while the clients request pages (and the full body with --full). Halfway
+through, a new snapshot is published so the background reload is measured
+too. The loop lag should stay flat as the snapshot grows
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+import httpx
+import numpy as np
+import pandas as pd
+import uvicorn
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import metrics_db  # noqa: E402
+import server_fastapi  # noqa: E402
+from column_mappings import DASHBOARD_COLUMNS  # noqa: E402
+from metrics_cache import MetricsCache  # noqa: E402
+from snapshot_manifest import publish_snapshot  # noqa: E402
+
+PAGE_PATH = '/api/demand-metrics?limit=100&offset=200'
+FULL_PATH = '/api/demand-metrics'
+PROBE_INTERVAL = 0.005
+STARTUP_TIMEOUT = 600.0
+RELOAD_TIMEOUT = 300.0
+
+
+def metrics_frame(rows, seed):
+    rng = np.random.default_rng(seed)
+    count = rng.integers(1, 50, rows)
+    price = rng.integers(500, 10000, rows).astype('float64')
+    return pd.DataFrame({
+        'avatar_id': [str(100000 + i % 500) for i in range(rows)],
+        'item_id': [str(200000 + i) for i in range(rows)],
+        'request_count': count,
+        'unique_users': count,
+        'median_price': price,
+        'mean_price': price,
+        'min_price': price,
+        'max_price': price,
+        'price_std': 0.0,
+        'potential_sales': count * price,
+    })[DASHBOARD_COLUMNS]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(dashboard_dir, port, measuring, stop, results):
+    """
+    別プロセスで uvicorn を動かし、イベントループの遅れを測るプローブを並行して実行
+    (クライアントと GIL を取り合わないようにプロセスを分ける)
+    """
+    metrics_db._shared_cache = MetricsCache(dashboard_dir)
+    server = uvicorn.Server(uvicorn.Config(
+        server_fastapi.app, host='127.0.0.1', port=port, log_level='warning', lifespan='on'
+    ))
+    lags = []
+
+    async def probe():
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(PROBE_INTERVAL)
+            if measuring.is_set():
+                lags.append(time.perf_counter() - started - PROBE_INTERVAL)
+
+    async def stop_when_asked():
+        await asyncio.to_thread(stop.wait)
+        server.should_exit = True
+
+    async def main():
+        tasks = [asyncio.create_task(probe()), asyncio.create_task(stop_when_asked())]
+        try:
+            await server.serve()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    asyncio.run(main())
+    results.put(lags)
+
+
+async def wait_for_etag(client, etag=None, timeout=30.0):
+    """ページの ETag が etag 以外になるまで待って返す (起動待ちとリロード待ち)"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = await client.get(PAGE_PATH)
+            if response.status_code == 200 and response.headers.get('etag') != etag:
+                return response.headers.get('etag')
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.05)
+    return None
+
+
+async def load(base_url, args, republish):
+    latencies, errors = [], []
+    paths = [PAGE_PATH, FULL_PATH] if args.full else [PAGE_PATH]
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def run_client(number):
+            for i in range(args.requests):
+                started = time.perf_counter()
+                try:
+                    response = await client.get(paths[(number + i) % len(paths)],
+                                                headers={'Accept-Encoding': 'gzip'})
+                except httpx.HTTPError as e:
+                    errors.append(type(e).__name__)
+                    continue
+                if response.status_code != 200:
+                    errors.append(response.status_code)
+                    continue
+                latencies.append(time.perf_counter() - started)
+
+        async def republish_halfway():
+            while len(latencies) + len(errors) < args.clients * args.requests // 2:
+                await asyncio.sleep(0.01)
+            await asyncio.to_thread(republish)
+
+        # Startup loads and encodes the snapshot before the first request is served
+        etag = await wait_for_etag(client, timeout=STARTUP_TIMEOUT)
+        if etag is None:
+            raise RuntimeError(f"server did not serve the snapshot within {STARTUP_TIMEOUT:.0f}s")
+        args.measuring.set()
+        started = time.perf_counter()
+        await asyncio.gather(republish_halfway(), *(run_client(n) for n in range(args.clients)))
+        elapsed = time.perf_counter() - started
+        # The watcher picks up the republished snapshot in the background
+        reloaded = await wait_for_etag(client, etag, RELOAD_TIMEOUT) is not None
+        args.measuring.clear()
+        return latencies, errors, elapsed, reloaded
+
+
+def run(rows, args):
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as dashboard_dir:
+        publish_snapshot(metrics_frame(rows, 0), Path(dashboard_dir), '20240101_000000')
+
+        def republish():
+            publish_snapshot(metrics_frame(rows, 1), Path(dashboard_dir), '20240101_000100')
+
+        port = free_port()
+        args.measuring, stop, results = context.Event(), context.Event(), context.Queue()
+        process = context.Process(target=serve, args=(dashboard_dir, port, args.measuring, stop, results))
+        process.start()
+        try:
+            latencies, errors, elapsed, reloaded = asyncio.run(
+                load(f"http://127.0.0.1:{port}", args, republish)
+            )
+        finally:
+            stop.set()
+        lags = results.get()
+        process.join()
+
+    lag = np.array(lags) * 1000
+    p99 = np.percentile(latencies, 99) * 1000 if latencies else float('nan')
+    print(f"{rows:>9} rows {len(latencies) / elapsed:8.0f} req/s  request p99 {p99:8.1f} ms"
+          f"  loop lag p99 {np.percentile(lag, 99):6.1f} ms  max {lag.max():6.1f} ms"
+          f"  ({len(errors)} failed, reloaded: {reloaded})")
+    if errors:
+        print("          failures:", ', '.join(f"{error} x{n}" for error, n in Counter(errors).most_common()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark event-loop latency of the FastAPI app")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                        help="スナップショットの行数 (複数指定可)")
+    parser.add_argument('--clients', type=int, default=200, help="同時に接続するクライアント数")
+    parser.add_argument('--requests', type=int, default=20, help="クライアントごとのリクエスト数")
+    parser.add_argument('--full', action='store_true', help="全件 (gzip) のリクエストも混ぜる")
+    args = parser.parse_args()
+
+    print(f"{args.clients} clients x {args.requests} requests: GET {PAGE_PATH}"
+          + (f" and {FULL_PATH}" if args.full else ""))
+    for rows in args.rows:
+        run(rows, args)
+
+
+if __name__ == "__main__":
+    main()
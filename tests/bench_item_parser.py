@@ -0,0 +1,64 @@
+"""
+Parse benchmark for the browse-page backends on saved pages
+    python tests/bench_item_parser.py [PAGE_OR_DIR ...] [--repeat N] [--workers N]
+Defaults to the fixture pages. Saved pages (for example those written by a
+crawl) give more representative numbers
+"""
+
+import argparse
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from item_parser import PARSER_BACKENDS, parse_items  # noqa: E402
+
+FIXTURES = Path(__file__).parent / "fixtures" / "booth_pages"
+
+
+def load_pages(paths):
+    pages = []
+    for path in map(Path, paths):
+        files = sorted(path.glob("*.html")) if path.is_dir() else [path]
+        pages.extend(f.read_text(encoding='utf-8') for f in files)
+    return pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the item parser backends")
+    parser.add_argument('paths', nargs='*', default=[FIXTURES], help="保存したページ (HTML) かそのディレクトリ")
+    parser.add_argument('--repeat', type=int, default=20, help="各ページを解析する回数")
+    parser.add_argument('--workers', type=int, default=0, help="プロセスプールでも計測する場合のワーカー数")
+    args = parser.parse_args()
+
+    pages = load_pages(args.paths) * args.repeat
+    if not pages:
+        print("No pages to parse")
+        return
+    size = sum(map(len, pages)) / len(pages) / 1024
+    print(f"{len(pages)} pages ({size:.1f} KB on average)")
+
+    results = {}
+    for backend in PARSER_BACKENDS:
+        started = time.perf_counter()
+        results[backend] = [parse_items(page, backend) for page in pages]
+        elapsed = time.perf_counter() - started
+        items = sum(map(len, results[backend]))
+        print(f"{backend:18s} {elapsed / len(pages) * 1000:7.2f} ms/page ({items} items)")
+
+        if args.workers:
+            with ProcessPoolExecutor(max_workers=args.workers) as pool:
+                started = time.perf_counter()
+                pooled = list(pool.map(parse_items, pages, [backend] * len(pages), chunksize=8))
+                elapsed = time.perf_counter() - started
+            assert pooled == results[backend]
+            print(f"{backend + ' (pool)':18s} {elapsed / len(pages) * 1000:7.2f} ms/page")
+
+    first, *others = results.values()
+    print("identical items:", all(other == first for other in others))
+
+
+if __name__ == "__main__":
+    main()
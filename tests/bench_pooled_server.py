@@ -0,0 +1,165 @@
+"""
+Serving benchmark for the http.server backends: single mode against pool mode
+    python tests/bench_pooled_server.py [--clients N] [--requests N] [--slow N] [--rows N] [--workers N]
+Each client sends its requests back to back over one connection (reconnecting
+when the server closes it). Slow clients trickle their request headers in
+meanwhile, which is what holds up every other client in single mode.
+Reports throughput and latency percentiles per mode
+"""
+
+import argparse
+import http.client
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import metrics_db  # noqa: E402
+from column_mappings import DASHBOARD_COLUMNS  # noqa: E402
+from metrics_cache import MetricsCache  # noqa: E402
+from pooled_server import DEFAULT_WORKERS, create_server  # noqa: E402
+from server_nginx import DashboardHandler  # noqa: E402
+from snapshot_manifest import publish_snapshot  # noqa: E402
+
+PATH = '/api/demand-metrics?limit=100'
+
+
+class QuietHandler(DashboardHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def metrics_frame(rows):
+    rng = np.random.default_rng(0)
+    count = rng.integers(1, 50, rows)
+    price = rng.integers(500, 10000, rows).astype('float64')
+    return pd.DataFrame({
+        'avatar_id': [str(100000 + i % 500) for i in range(rows)],
+        'item_id': [str(200000 + i) for i in range(rows)],
+        'request_count': count,
+        'unique_users': count,
+        'median_price': price,
+        'mean_price': price,
+        'min_price': price,
+        'max_price': price,
+        'price_std': 0.0,
+        'potential_sales': count * price,
+    })[DASHBOARD_COLUMNS]
+
+
+def fetch(conn):
+    """
+    1回の GET のステータス
+    サーバーが閉じたアイドル接続で失敗した場合は、ブラウザや nginx と同じく
+    接続し直して1回だけ再送する
+    """
+    for retry in (True, False):
+        try:
+            conn.request('GET', PATH)
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        except ConnectionError:
+            conn.close()
+            if not retry:
+                raise
+
+
+def client(address, requests, latencies, errors):
+    conn = http.client.HTTPConnection(*address, timeout=30)
+    for _ in range(requests):
+        started = time.perf_counter()
+        try:
+            status = fetch(conn)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(type(e).__name__)
+            conn.close()
+            continue
+        if status != 200:
+            errors.append(status)
+            continue
+        latencies.append(time.perf_counter() - started)
+    conn.close()
+
+
+def slow_client(address, delay, stop):
+    """ヘッダーを delay 秒かけて送るクライアント (stop まで繰り返す)"""
+    while not stop.is_set():
+        try:
+            with socket.create_connection(address, timeout=30) as sock:
+                sock.sendall(f"GET {PATH} HTTP/1.1\r\nHost: bench\r\n".encode('ascii'))
+                time.sleep(delay)
+                sock.sendall(b"Connection: close\r\n\r\n")
+                while sock.recv(65536):
+                    pass
+        except OSError:
+            time.sleep(delay)
+
+
+def run(mode, args):
+    server = create_server(('127.0.0.1', 0), QuietHandler, mode, args.workers)
+    # Clients that gave up on a queued connection are counted below, not logged
+    server.handle_error = lambda request, client_address: None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    address = server.server_address
+
+    stop = threading.Event()
+    slow = [threading.Thread(target=slow_client, args=(address, args.slow_delay, stop))
+            for _ in range(args.slow)]
+    for thread in slow:
+        thread.start()
+
+    latencies, errors = [], []
+    clients = [threading.Thread(target=client, args=(address, args.requests, latencies, errors))
+               for _ in range(args.clients)]
+    started = time.perf_counter()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    for thread in slow:
+        thread.join()
+    server.shutdown()
+    server.server_close()
+
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1000 if latencies else (float('nan'),) * 2
+    print(f"{mode:6s} {len(latencies) / elapsed:9.0f} req/s  p50 {p50:7.1f} ms  p99 {p99:8.1f} ms"
+          f"  ({len(latencies)} ok, {len(errors)} failed)")
+    if errors:
+        print("       failures:", ', '.join(f"{error} x{n}" for error, n in Counter(errors).most_common()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark single and pool serving modes")
+    parser.add_argument('--clients', type=int, default=50, help="同時に接続するクライアント数")
+    parser.add_argument('--requests', type=int, default=100, help="クライアントごとのリクエスト数")
+    parser.add_argument('--slow', type=int, default=2, help="ヘッダーをゆっくり送るクライアント数")
+    parser.add_argument('--slow-delay', type=float, default=0.2, help="遅いクライアントがヘッダーを送る時間 (秒)")
+    parser.add_argument('--rows', type=int, default=20000, help="スナップショットの行数")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="pool モードのワーカー数")
+    parser.add_argument('--modes', nargs='+', default=['single', 'pool'], choices=['single', 'pool'])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dashboard_dir:
+        publish_snapshot(metrics_frame(args.rows), Path(dashboard_dir), '20240101_000000')
+        metrics_db._shared_cache = MetricsCache(dashboard_dir)
+        metrics_db.shared_metrics_cache().get()
+        print(f"{args.clients} clients x {args.requests} requests, {args.slow} slow clients, "
+              f"{args.rows} rows: GET {PATH}")
+        for mode in args.modes:
+            run(mode, args)
+
+
+if __name__ == "__main__":
+    main()
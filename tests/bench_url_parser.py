@@ -0,0 +1,79 @@
+"""
+URL parsing benchmark: extract_booth_info per cell against the vectorized parsers
+    python tests/bench_url_parser.py [--rows N] [--seed N]
+Generates a URL column with every form listed in Poll.md (bare IDs, shop
+URLs, language URLs, direct URLs, numeric cells and empty cells) and checks
+that all parsers return the same IDs
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from process import DataProcessor  # noqa: E402
+
+URL_FORMS = [
+    lambda i: f"https://booth.pm/ja/items/{i}",
+    lambda i: f"https://shop{i % 97}.booth.pm/items/{i}",
+    lambda i: f"https://booth.pm/items/{i}",
+    lambda i: f" https://booth.pm/en/items/{i}\n",
+    lambda i: f"https://booth.pm/ja/items/{i}?utm_source=form",
+    lambda i: str(i),
+    lambda i: float(i),
+    lambda i: None,
+]
+
+
+def url_column(rows, seed):
+    rng = np.random.default_rng(seed)
+    ids = rng.integers(1_000_000, 9_999_999, rows)
+    forms = rng.integers(0, len(URL_FORMS), rows)
+    return pd.Series([URL_FORMS[form](int(i)) for form, i in zip(forms, ids)], dtype=object)
+
+
+def timed(label, rows, run):
+    started = time.perf_counter()
+    result = run()
+    elapsed = time.perf_counter() - started
+    print(f"{label:24s} {elapsed:7.2f} s ({rows / elapsed:,.0f} rows/s)")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Booth URL parsing")
+    parser.add_argument('--rows', type=int, default=1_000_000, help="URL の行数")
+    parser.add_argument('--seed', type=int, default=0, help="乱数のシード")
+    args = parser.parse_args()
+
+    urls = url_column(args.rows, args.seed)
+    print(f"{len(urls)} URLs")
+
+    def per_cell():
+        # process_raw_data before vectorization: apply, then unpack the tuples
+        info = urls.apply(DataProcessor.extract_booth_info)
+        return pd.DataFrame({'shop_id': info.apply(lambda x: x[0]), 'item_id': info.apply(lambda x: x[1])})
+
+    # The arrow engine reads mixed columns as text (whole numbers without ".0")
+    text = pa.chunked_array([pa.array(urls.map(lambda v: str(int(v)) if isinstance(v, float) else v),
+                                      pa.string())])
+
+    def arrow():
+        shop_id, item_id = DataProcessor.extract_booth_id_arrays(text)
+        return pd.DataFrame({'shop_id': shop_id.to_pandas(), 'item_id': item_id.to_pandas()})
+
+    expected = timed("extract_booth_info", len(urls), per_cell)
+    vectorized = timed("extract_booth_ids", len(urls), lambda: DataProcessor.extract_booth_ids(urls))
+    arrow_ids = timed("extract_booth_id_arrays", len(urls), arrow)
+
+    print("identical:", vectorized.equals(expected) and arrow_ids.equals(expected))
+
+
+if __name__ == "__main__":
+    main()
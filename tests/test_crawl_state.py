@@ -0,0 +1,105 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from crawl_state import CrawlCheckpoint
+from urls import MAX_CONSECUTIVE_FAILURES, BoothScraper
+
+SETTINGS = {'base_url': 'https://booth.pm/ja/browse/3Dモデル', 'incremental': False}
+
+BROWSE_PAGE = (Path(__file__).parent / "fixtures" / "booth_pages" / "browse_typical.html").read_bytes()
+
+
+def write_checkpoint(path, pages):
+    checkpoint = CrawlCheckpoint(path)
+    checkpoint.open(SETTINGS)
+    for page in pages:
+        checkpoint.add_page(page)
+    checkpoint.close()
+
+
+def test_resume_drops_torn_line(tmp_path):
+    path = tmp_path / 'checkpoint.jsonl'
+    write_checkpoint(path, [1, 2])
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"page": 9')
+
+    checkpoint = CrawlCheckpoint(path)
+    assert checkpoint.open(SETTINGS)
+    checkpoint.add_page(3)
+    checkpoint.close()
+
+    assert checkpoint.pages == {1, 2, 3}
+    assert '{"page": 9' not in path.read_text(encoding='utf-8')
+    assert not list(tmp_path.glob('.*.tmp'))
+
+
+def test_interrupted_rewrite_keeps_previous_checkpoint(tmp_path, monkeypatch):
+    path = tmp_path / 'checkpoint.jsonl'
+    write_checkpoint(path, [1, 2])
+    before = path.read_bytes()
+
+    def interrupted(src, dst):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(os, 'replace', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        CrawlCheckpoint(path).open(SETTINGS)
+
+    assert path.read_bytes() == before
+
+
+class BrowseHandler(BaseHTTPRequestHandler):
+    """一覧ページを返す (server.failing のページは 500)"""
+
+    def do_GET(self):
+        page = int(parse_qs(urlparse(self.path).query)['page'][0])
+        self.server.requested.append(page)
+        status, body = (500, b'') if page in self.server.failing else (200, BROWSE_PAGE)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def browse_server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), BrowseHandler)
+    httpd.requested = []
+    httpd.failing = set()
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_aborted_crawl_keeps_checkpoint_and_resumes(tmp_path, browse_server):
+    path = tmp_path / 'checkpoint.jsonl'
+
+    def scrape():
+        browse_server.requested.clear()
+        scraper = BoothScraper(
+            base_url=f"http://127.0.0.1:{browse_server.server_address[1]}/browse",
+            cache_path=None, db_path=tmp_path / 'booth_data.db', checkpoint_path=path,
+            parse_workers=0, dataset_dir=None, rate=1000.0, concurrency=1, retries=0
+        )
+        scraper.scrape(max_pages=8)
+
+    # Page 1 is written, then the crawl gives up after consecutive failures
+    browse_server.failing = set(range(2, 2 + MAX_CONSECUTIVE_FAILURES))
+    scrape()
+    assert browse_server.requested == list(range(1, 2 + MAX_CONSECUTIVE_FAILURES))
+    assert path.exists()
+
+    browse_server.failing = set()
+    scrape()
+    assert browse_server.requested == list(range(2, 9))
+    assert not path.exists()
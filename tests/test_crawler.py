@@ -0,0 +1,115 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from crawler import CrawlEngine, TokenBucket
+from http_retry import MAX_RETRY_AFTER
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """パスごとに用意した (status, headers) を順に返し、最後のものを繰り返す"""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.hits.append((self.path, time.monotonic()))
+            script = server.scripts.get(self.path, [(200, {})])
+            status, headers = script.pop(0) if len(script) > 1 else script[0]
+        body = f"{self.path} {status}".encode('utf-8')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    httpd.lock = threading.Lock()
+    httpd.hits = []
+    httpd.scripts = {}
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def fetch_all(engine, urls):
+    async def run():
+        return await asyncio.gather(*(engine.fetch(url) for url in urls))
+    return asyncio.run(run())
+
+
+def test_rate_limit_spaces_requests_to_a_host(server):
+    rate = 20.0
+    with CrawlEngine(rate=rate, burst=1, concurrency=4) as engine:
+        bodies = fetch_all(engine, [f"{server.url}/page/{i}" for i in range(8)])
+
+    assert bodies == [f"/page/{i} 200" for i in range(8)]
+    times = sorted(t for _, t in server.hits)
+    # One token up front, then one every 1/rate seconds
+    assert times[-1] - times[0] >= (len(times) - 1) / rate * 0.9
+
+
+def test_token_bucket_allows_burst_then_rate():
+    async def run():
+        bucket = TokenBucket(rate=10.0, burst=3)
+        started = time.monotonic()
+        for _ in range(5):
+            await bucket.acquire()
+        return time.monotonic() - started
+    elapsed = asyncio.run(run())
+    assert 0.18 <= elapsed < 0.5
+
+
+@pytest.mark.parametrize('status', [429, 500, 502, 503, 504])
+def test_retries_retryable_statuses(server, status):
+    server.scripts['/flaky'] = [(status, {}), (status, {}), (200, {})]
+    with CrawlEngine(rate=100.0, retries=3, backoff=0.01) as engine:
+        body = fetch_all(engine, [f"{server.url}/flaky"])[0]
+
+    assert body == "/flaky 200"
+    assert len(server.hits) == 3
+
+
+def test_gives_up_after_retries(server):
+    server.scripts['/down'] = [(503, {})]
+    with CrawlEngine(rate=100.0, retries=2, backoff=0.01) as engine:
+        assert fetch_all(engine, [f"{server.url}/down"])[0] is None
+    assert len(server.hits) == 3
+
+
+def test_client_errors_are_not_retried(server):
+    server.scripts['/missing'] = [(404, {})]
+    with CrawlEngine(rate=100.0, retries=3, backoff=0.01) as engine:
+        assert fetch_all(engine, [f"{server.url}/missing"])[0] is None
+    assert len(server.hits) == 1
+
+
+def test_retry_after_is_honoured(server):
+    server.scripts['/busy'] = [(429, {'Retry-After': '1'}), (200, {})]
+    # The backoff alone would retry almost at once
+    with CrawlEngine(rate=100.0, retries=1, backoff=0.001) as engine:
+        body = fetch_all(engine, [f"{server.url}/busy"])[0]
+
+    assert body == "/busy 200"
+    (_, first), (_, second) = server.hits
+    assert second - first >= 0.95
+
+
+def test_retry_after_is_capped():
+    with CrawlEngine(backoff=0.01) as engine:
+        assert engine._retry_delay(0, {'Retry-After': '3600'}) == MAX_RETRY_AFTER
+        assert engine._retry_delay(0, {'Retry-After': '2'}) == 2.0
+        # An HTTP date is not parsed; the jittered backoff is used instead
+        assert 0 <= engine._retry_delay(1, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}) <= 0.02
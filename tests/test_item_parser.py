@@ -0,0 +1,44 @@
+from pathlib import Path
+
+import pytest
+
+from item_parser import PARSER_BACKENDS, parse_items, parse_items_bs4
+
+FIXTURES = Path(__file__).parent / "fixtures" / "booth_pages"
+PAGES = sorted(FIXTURES.glob("*.html"))
+
+requires_lxml = pytest.mark.skipif('lxml' not in PARSER_BACKENDS, reason="lxml is not installed")
+
+
+@requires_lxml
+@pytest.mark.parametrize('page', PAGES, ids=[p.stem for p in PAGES])
+def test_backends_return_identical_items(page, capsys):
+    """html.parser と lxml が同じ商品 (と同じエラー出力) を返す"""
+    html = page.read_text(encoding='utf-8')
+    expected = parse_items(html, 'html.parser')
+    expected_output = capsys.readouterr().out
+
+    assert parse_items(html, 'lxml') == expected
+    assert capsys.readouterr().out == expected_output
+
+
+def test_edge_cases():
+    items = parse_items_bs4((FIXTURES / "browse_edge_cases.html").read_text(encoding='utf-8'))
+    by_url = {item['url']: item for item in items}
+
+    # Cards without a link or href, and classes that only contain "item-card", are skipped
+    assert len(items) == 7
+    assert by_url['https://booth.pm/ja/items/100001']['title'] == 'タブ\tと改行\n のタイトル'
+    assert by_url['https://booth.pm/ja/items/100002']['price'] == 1200
+    assert by_url['https://booth.pm/ja/items/100003']['price'] == 0
+    assert by_url['https://booth.pm/en/items/555'] == {
+        'url': 'https://booth.pm/en/items/555', 'title': 'No Title', 'price': 0
+    }
+    assert by_url['https://booth.pm/ja/items/556']['title'] == '<限定> "セット" ★'
+
+
+def test_empty_page_and_unknown_backend():
+    assert parse_items('') == []
+    assert parse_items((FIXTURES / "browse_empty.html").read_text(encoding='utf-8')) == []
+    with pytest.raises(ValueError):
+        parse_items('<html></html>', 'html5lib-unknown')
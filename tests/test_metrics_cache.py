@@ -0,0 +1,191 @@
+import http.client
+import importlib
+import json
+import sys
+import threading
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+import booth_db
+import metrics_db
+from column_mappings import DASHBOARD_COLUMNS
+from column_schema import approximate_schema
+from demand_sketches import SketchParams, SketchState
+from metrics_cache import MetricsCache, MetricsSnapshot
+from metrics_db import DatabaseMetricsCache
+from metrics_query import parse_query
+from pooled_server import create_server
+from snapshot_manifest import publish_snapshot
+
+
+def metrics_frame(n=5):
+    return pd.DataFrame({
+        'avatar_id': [str(100 + i) for i in range(n)],
+        'item_id': [str(200 + i) for i in range(n)],
+        'request_count': list(range(n, 0, -1)),
+        'unique_users': list(range(n, 0, -1)),
+        'median_price': [1000.0] * n,
+        'mean_price': [1000.0] * n,
+        'min_price': [1000.0] * n,
+        'max_price': [1000.0] * n,
+        'price_std': [0.0] * n,
+        'potential_sales': [1000.0 * c for c in range(n, 0, -1)],
+    })[DASHBOARD_COLUMNS]
+
+
+@pytest.fixture
+def snapshot():
+    return MetricsSnapshot(Path('demand_metrics_test.parquet'), ('test', 1), metrics_frame(), 0.0)
+
+
+def test_etag_differs_per_query(snapshot):
+    first = parse_query({'limit': '2'})
+    second = parse_query({'limit': '2', 'offset': '2'})
+    tags = {snapshot.etag(), snapshot.etag(query=first), snapshot.etag(query=second)}
+    assert len(tags) == 3
+
+    # A 304 is only given for the representation the tag was issued for
+    assert snapshot.matches(snapshot.etag(query=first), query=first)
+    assert not snapshot.matches(snapshot.etag(), query=first)
+    assert not snapshot.matches(snapshot.etag(query=first))
+    assert not snapshot.matches(snapshot.etag(query=first), query=second)
+
+
+def test_etag_ignores_parameter_spelling(snapshot):
+    # Equivalent queries canonicalize to the same tag
+    explicit = parse_query({'offset': '0', 'limit': '2', 'order': 'desc', 'sort': 'potential_sales'})
+    assert snapshot.etag(query=explicit) == snapshot.etag(query=parse_query({'limit': '2'}))
+
+
+def add_requests(conn, avatar, item, prices):
+    with conn:
+        conn.executemany(
+            'INSERT INTO master_matching (avatar, item, userid, price) VALUES (?, ?, ?, ?)',
+            [(avatar, item, f'user{i}', price) for i, price in enumerate(prices)]
+        )
+        booth_db.refresh_demand_metrics(conn)
+
+
+def test_sqlite_pages_read_at_snapshot_version(tmp_path):
+    db_path = tmp_path / 'booth_data.db'
+    conn = booth_db.connect(db_path)
+    add_requests(conn, '1', '10', [1000, 2000])
+    cache = DatabaseMetricsCache(db_path)
+    try:
+        snapshot = cache.get()
+        query = parse_query({'limit': '10'})
+        live = json.loads(snapshot.query_body(query))
+        assert [row['item_id'] for row in live['data']] == ['10']
+
+        # A refresh after the snapshot was loaded must not leak into its pages
+        add_requests(conn, '2', '20', [5000] * 3)
+        stale = json.loads(snapshot.query_body(query))
+        assert stale['version'] == snapshot.version
+        assert stale['data'] == live['data']
+        assert stale['total'] == 1
+
+        refreshed = cache.get()
+        assert refreshed.version != snapshot.version
+        assert json.loads(refreshed.query_body(query))['total'] == 2
+    finally:
+        cache.database.close()
+        conn.close()
+
+
+def approximate_metrics():
+    params = SketchParams(quantiles=(0.9,))
+    processed = pd.DataFrame({
+        'avatar_item_id': [1, 1, 1, 2],
+        'item_item_id': [10, 10, 10, 20],
+        'twitter_id': ['@a', '@b', '@c', '@a'],
+        'desired_price': [1000, 2000, 3000, 500],
+    })
+    metrics = SketchState.from_frame(processed, params).to_metrics()
+    return metrics.sort_values('potential_sales', ascending=False), params
+
+
+def served_columns(snapshot, query):
+    """全件の各形式とページング結果の列名"""
+    rows = json.loads(snapshot.format_body('rows'))['data'][0]
+    columns = json.loads(snapshot.format_body('columns'))['columns']
+    arrow = pa.ipc.open_stream(snapshot.format_body('arrow')).read_all().column_names
+    paged = json.loads(snapshot.query_body(query))['data'][0]
+    return {'rows': list(rows), 'columns': columns, 'arrow': arrow, 'paged': list(paged)}
+
+
+def test_every_format_serves_the_published_columns(tmp_path):
+    metrics, params = approximate_metrics()
+    publish_snapshot(metrics, tmp_path, '20240101_000000')
+    snapshot = MetricsCache(tmp_path).get()
+
+    published = approximate_schema(params.quantile_columns).names
+    assert {'unique_users_error', 'price_p90', 'price_p90_error'} <= set(published)
+    served = served_columns(snapshot, parse_query({'limit': '1'}))
+    assert served == {fmt: published for fmt in served}
+
+
+def test_sqlite_source_serves_the_same_columns_in_every_format(tmp_path):
+    db_path = tmp_path / 'booth_data.db'
+    conn = booth_db.connect(db_path)
+    add_requests(conn, '1', '10', [1000, 2000])
+    cache = DatabaseMetricsCache(db_path)
+    try:
+        served = served_columns(cache.get(), parse_query({'limit': '1'}))
+        assert served == {fmt: DASHBOARD_COLUMNS for fmt in served}
+    finally:
+        cache.database.close()
+        conn.close()
+
+
+def test_servers_read_config_on_first_use(monkeypatch):
+    reads = []
+
+    def read_config():
+        reads.append(True)
+        return {'metrics_source': 'parquet'}
+
+    monkeypatch.setattr(metrics_db, 'read_config', read_config)
+    monkeypatch.setattr(metrics_db, '_shared_cache', None)
+    for name in ('server_nginx', 'server_fastapi'):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+        importlib.import_module(name)
+    assert not reads
+
+    cache = metrics_db.shared_metrics_cache()
+    assert metrics_db.shared_metrics_cache() is cache
+    assert len(reads) == 1
+
+
+@pytest.mark.parametrize('module', ['server', 'server_nginx'])
+def test_http_server_backends_share_metrics_responses(tmp_path, monkeypatch, module):
+    publish_snapshot(metrics_frame(), tmp_path, '20240101_000000')
+    monkeypatch.setattr(metrics_db, '_shared_cache', MetricsCache(tmp_path))
+    handler = importlib.import_module(module).DashboardHandler
+    server = create_server(('127.0.0.1', 0), handler, mode='pool', workers=2, idle_timeout=1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def get(path, headers=None):
+        conn = http.client.HTTPConnection(*server.server_address, timeout=5)
+        conn.request('GET', path, headers=headers or {})
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        return response, body
+
+    try:
+        response, body = get('/api/demand-metrics?limit=2')
+        assert response.status == 200
+        assert len(json.loads(body)['data']) == 2
+        etag = response.getheader('ETag')
+        assert get('/api/demand-metrics?limit=2', {'If-None-Match': etag})[0].status == 304
+        assert get('/api/demand-metrics', {'If-None-Match': etag})[0].status == 200
+
+        response, body = get('/api/demand-metrics', {'Accept-Encoding': 'gzip'})
+        assert response.getheader('Content-Encoding') == 'gzip'
+        assert get('/api/demand-metrics?limit=0')[0].status == 400
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,105 @@
+import http.client
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from pooled_server import PooledHTTPServer, create_server
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.path.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def start_server():
+    servers = []
+
+    def start(**options):
+        server = create_server(('127.0.0.1', 0), EchoHandler, mode='pool', **options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def get(server, path, conn=None, timeout=5):
+    conn = conn or http.client.HTTPConnection(*server.server_address, timeout=timeout)
+    conn.request('GET', path)
+    response = conn.getresponse()
+    return conn, response.status, response.read()
+
+
+def test_keep_alive_reuses_connection(start_server):
+    server = start_server(workers=2, idle_timeout=5)
+    conn, status, body = get(server, '/a')
+    sock = conn.sock
+    conn, status, body = get(server, '/b', conn)
+    assert (status, body) == (200, b'/b')
+    assert conn.sock is sock
+    conn.close()
+
+
+def test_idle_connections_yield_to_new_clients(start_server):
+    server = start_server(workers=2, idle_timeout=30)
+    idle = [get(server, f'/idle{i}')[0] for i in range(2)]
+
+    started = time.monotonic()
+    conn, status, body = get(server, '/new')
+    assert (status, body) == (200, b'/new')
+    # アイドル接続のタイムアウト (30秒) を待たずに処理される
+    assert time.monotonic() - started < 2
+    conn.close()
+
+    # 閉じられた側の接続は、再接続すれば続けて使える
+    for conn in idle:
+        conn.close()
+        assert get(server, '/again', conn)[1] == 200
+        conn.close()
+
+
+def test_idle_connection_closed_after_timeout(start_server):
+    server = start_server(workers=2, idle_timeout=0.2)
+    conn, status, body = get(server, '/a')
+    time.sleep(0.5)
+    assert conn.sock.recv(1) == b''
+    conn.close()
+
+
+def test_rejects_when_queue_is_full(start_server):
+    server = start_server(workers=1, max_queued=1, idle_timeout=5)
+    # 1つ目がワーカーを占有し (リクエストを送らない)、2つ目がワーカーを待つ
+    busy = socket.create_connection(server.server_address)
+    waiting = socket.create_connection(server.server_address)
+    deadline = time.monotonic() + 2
+    while server.waiting < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    conn, status, body = get(server, '/rejected')
+    assert status == 503
+    assert server.rejected == 1
+    conn.close()
+    busy.close()
+    waiting.close()
+
+
+def test_single_mode_uses_plain_server():
+    server = create_server(('127.0.0.1', 0), EchoHandler)
+    try:
+        assert not isinstance(server, PooledHTTPServer)
+    finally:
+        server.server_close()
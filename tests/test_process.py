@@ -0,0 +1,108 @@
+import json
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+import booth_db
+from column_schema import typed_frame
+from demand_aggregates import DemandState, demand_metrics_table
+from demand_sketches import SketchParams
+from process import ENGINES, DataProcessor, run_incremental
+
+
+def raw_rows(avatar_urls, item_urls):
+    n = len(item_urls)
+    return pd.DataFrame({
+        'timestamp': ['45600.5'] * n,
+        'avatar_url': avatar_urls,
+        'item_url': item_urls,
+        'twitter_id': [f'@user{i}' for i in range(n)],
+        'desired_price': ['1000'] * n,
+        'hitaiou_worker_name': [''] * n,
+    })
+
+
+@pytest.fixture
+def processor(tmp_path, request):
+    return DataProcessor(tmp_path / "data", db_path=tmp_path / "booth.db", engine=request.param)
+
+
+@pytest.mark.parametrize('processor', ENGINES, indirect=True)
+def test_incremental_delta_without_item_ids(processor):
+    """行はあるが、アバターと衣装のどちらのIDも取れない差分でも watermark が保存される"""
+    rows = raw_rows(['アバター名だけ', None], ['not a url', ''])
+    if processor.engine == 'arrow':
+        rows = pa.Table.from_pandas(rows, preserve_index=False)
+    watermark = {'last_row': 3, 'last_timestamp': 45600.5, 'reset_store': False}
+    processor.download_new_rows = lambda spreadsheet_id, api_key: (rows, dict(watermark))
+
+    run_incremental(processor, 'sheet', 'key')
+
+    assert not list(processor.processed_store_dir.glob("part_*.parquet"))
+    assert json.loads(processor.watermark_path.read_text(encoding='utf-8'))['last_row'] == 3
+
+
+def test_fingerprints_cover_engine_and_sketch_params(tmp_path):
+    """エンジンや近似モードの設定を変えると、同じシートでもステージを飛ばさない"""
+    def processor(**options):
+        return DataProcessor(tmp_path / "data", db_path=tmp_path / "booth.db", **options)
+
+    published = processor()
+    published.fingerprints.record('raw', 'sheet-digest')
+    published.fingerprints.commit()
+
+    assert processor().fingerprints.matches('raw', 'sheet-digest')
+    assert not processor(engine='arrow').fingerprints.matches('raw', 'sheet-digest')
+    assert not processor(sketch_params=SketchParams()).fingerprints.matches('raw', 'sheet-digest')
+    assert not processor(sketch_params=SketchParams(quantiles=(0.9,))).fingerprints.matches(
+        'raw', 'sheet-digest'
+    )
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_unknown_prices_count_as_zero(engine, capsys):
+    """範囲外・未指定の価格は従来どおり 0 として集計され、置き換えた件数が表示される"""
+    rows = raw_rows(['https://booth.pm/ja/items/1'] * 4,
+                    [f'https://booth.pm/ja/items/{100 + i // 2}' for i in range(4)])
+    rows['desired_price'] = ['1000', '3000000000', '', '2000']
+    if engine == 'arrow':
+        rows = pa.Table.from_pandas(rows, preserve_index=False)
+
+    processed = DataProcessor.process_rows(rows, verbose=False)
+    if engine == 'arrow':
+        prices = processed['desired_price'].to_pylist()
+        metrics = typed_frame(demand_metrics_table(processed))
+    else:
+        prices = processed['desired_price'].tolist()
+        metrics = DemandState.from_frame(processed).to_metrics()
+    assert prices == [1000, 0, 0, 2000]
+    assert "1 desired_price values do not fit int32; set to 0" in capsys.readouterr().out
+
+    by_item = metrics.set_index('item_id')
+    assert by_item.loc['100', 'min_price'] == 0
+    assert by_item.loc['100', 'median_price'] == 500
+    assert by_item.loc['100', 'potential_sales'] == 1000
+    assert by_item.loc['101', 'request_count'] == 2
+    assert by_item.loc['101', 'median_price'] == 1000
+
+
+@pytest.mark.parametrize('processor', ENGINES, indirect=True)
+def test_full_run_removes_rows_deleted_from_sheet(processor):
+    """全件の実行では、シートから消えた回答を master_matching と demand_metrics から削除する"""
+    def full_run(item_urls):
+        rows = raw_rows(['https://booth.pm/ja/items/1'] * len(item_urls), item_urls)
+        if processor.engine == 'arrow':
+            rows = pa.Table.from_pandas(rows, preserve_index=False)
+        processor.process_raw_data(rows)
+
+    full_run(['https://booth.pm/ja/items/100', 'https://booth.pm/ja/items/101'])
+    full_run(['https://booth.pm/ja/items/100'])
+
+    conn = booth_db.connect(processor.matching_store.db_path)
+    try:
+        assert conn.execute('SELECT item, userid FROM master_matching').fetchall() == [('100', '@user0')]
+        assert conn.execute('SELECT item_id FROM demand_metrics').fetchall() == [('100',)]
+        assert not conn.execute('SELECT * FROM matching_run_keys').fetchall()
+    finally:
+        conn.close()
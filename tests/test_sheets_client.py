@@ -0,0 +1,64 @@
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+import pytest
+
+from sheets_client import SheetsClient
+
+
+class ValuesHandler(BaseHTTPRequestHandler):
+    """values.get の代わり: 範囲をグリッドで切り詰め、末尾の空行は返さない"""
+
+    def do_GET(self):
+        server = self.server
+        a1_range = unquote(urlparse(self.path).path.rsplit('/', 1)[-1])
+        first, last = (int(row) for row in re.findall(r'\d+', a1_range))
+        last = min(last, server.grid_rows)
+        server.requested.append(a1_range)
+        values = server.rows[first - 1:last]
+        while values and not values[-1]:
+            values.pop()
+        body = json.dumps({'range': f"Sheet1!A{first}:Z{last}", 'values': values}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def sheets_server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), ValuesHandler)
+    httpd.requested = []
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def read_sheet(server, rows, grid_rows):
+    server.rows = rows
+    server.grid_rows = grid_rows
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/{{spreadsheet_id}}/{{a1_range}}"
+    with SheetsClient('key', retries=0, base_url=base_url) as client:
+        return [row for _, values in client.iter_pages('sheet', 1, page_rows=4) for row in values]
+
+
+def test_rows_after_blank_rows_at_page_end_are_read(sheets_server):
+    # Rows 3-4 are blank, so the first page comes back with only two rows
+    rows = [['header'], ['a'], [], [], ['b'], ['c']]
+    assert read_sheet(sheets_server, rows, grid_rows=100) == [['header'], ['a'], ['b'], ['c']]
+    # The sheet ends at the first page without rows
+    assert sheets_server.requested == ['A1:Z4', 'A5:Z8', 'A9:Z12']
+
+
+def test_stops_at_the_grid_end(sheets_server):
+    rows = [['header']] + [[str(i)] for i in range(5)]
+    assert len(read_sheet(sheets_server, rows, grid_rows=6)) == 6
+    assert sheets_server.requested == ['A1:Z4', 'A5:Z8']
@@ -1,135 +1,231 @@
-import requests
-from bs4 import BeautifulSoup
-import pandas as pd
-from pathlib import Path
-import time
-from urllib.parse import urljoin
-import json
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import math
+
+from config_handler import load_config
+from crawl_state import DB_PATH, DEFAULT_CHECKPOINT_PATH, CrawlCheckpoint, load_known_items
+from crawler import CrawlEngine
+from http_cache import DEFAULT_CACHE_PATH, DEFAULT_MAX_BYTES, DEFAULT_TTL, ResponseCache
+from item_parser import DEFAULT_BACKEND, PARSER_BACKENDS, parse_items
+from item_store import DEFAULT_BATCH_SIZE, DEFAULT_DATASET_DIR, ItemWriter, item_key
+
+# 既定で取得するページ数 (config.json の "crawl": {"max_pages": null} で最後のページまで)
+DEFAULT_MAX_PAGES = 5
+
+# 連続してこの数のページが取得できなければクロールを中断する
+MAX_CONSECUTIVE_FAILURES = 5
+
+# 差分クロールでは、既知の商品がこの割合以上のページで停止する
+DEFAULT_KNOWN_RATIO = 0.8
 
 class BoothScraper:
-    def __init__(self):
-        """スクレイパーの初期化"""
-        self.base_url = "https://booth.pm/ja/browse/3Dモデル"
+    def __init__(self, base_url="https://booth.pm/ja/browse/3Dモデル",
+                 cache_path=DEFAULT_CACHE_PATH, cache_ttl=DEFAULT_TTL,
+                 cache_max_bytes=DEFAULT_MAX_BYTES, db_path=DB_PATH,
+                 checkpoint_path=DEFAULT_CHECKPOINT_PATH,
+                 known_ratio=DEFAULT_KNOWN_RATIO, parser=DEFAULT_BACKEND,
+                 parse_workers=None, dataset_dir=DEFAULT_DATASET_DIR,
+                 batch_size=DEFAULT_BATCH_SIZE, **crawl_options):
+        """
+        スクレイパーの初期化
+        cache_path が None の場合はレスポンスをキャッシュしない
+        checkpoint_path が None の場合は中断したクロールを再開しない
+        db_path の master_item に商品を書き込み、差分クロールの既知の商品としても使う
+        dataset_dir が None の場合は parquet データセットに書き込まない
+        parser は解析のバックエンド (lxml / html.parser)
+        parse_workers は解析用のプロセス数 (None は CPU 数、0 はスレッドで解析)
+        crawl_options は CrawlEngine に渡す
+        (rate, burst, concurrency, timeout, retries, backoff, offline)
+        """
+        self.base_url = base_url
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         }
-        self.results_dir = Path('results')
-        self.results_dir.mkdir(exist_ok=True)
-
-    def get_page_content(self, page=1):
-        """指定されたページの内容を取得"""
-        params = {
+        self.crawl_options = crawl_options
+        self.cache_options = {'path': cache_path, 'ttl': cache_ttl, 'max_bytes': cache_max_bytes}
+        self.db_path = db_path
+        self.checkpoint_path = checkpoint_path
+        self.known_ratio = known_ratio
+        if parser not in PARSER_BACKENDS:
+            raise ValueError(f"parser must be one of {', '.join(PARSER_BACKENDS)}")
+        self.parser = parser
+        self.parse_workers = parse_workers
+        self.dataset_dir = dataset_dir
+        self.batch_size = batch_size
+
+    def page_params(self, page=1):
+        """一覧ページのクエリパラメータ"""
+        return {
             'min_price': '1000',
             'type': 'digital',
             'page': str(page)
         }
-        
-        try:
-            response = requests.get(
-                self.base_url,
-                params=params,
-                headers=self.headers
-            )
-            response.raise_for_status()
-            return response.text
-        except requests.RequestException as e:
-            print(f"ページ {page} の取得中にエラーが発生しました: {e}")
-            return None
 
     def parse_items(self, html_content):
         """ページから商品情報を抽出"""
-        if not html_content:
-            return []
-
-        soup = BeautifulSoup(html_content, 'html.parser')
-        items = []
-
-        # 商品カードを検索
-        for item in soup.select('.item-card'):
-            try:
-                # 商品リンクを取得
-                link_elem = item.select_one('.item-card-url')
-                if not link_elem:
+        return parse_items(html_content, self.parser)
+
+    @staticmethod
+    def item_id(url):
+        """商品URLから商品IDを取得"""
+        return item_key(url)[1]
+
+    def known_fraction(self, items, known_items):
+        """ページ内の商品のうち既知のものの割合"""
+        known = sum(1 for item in items if self.item_id(item['url']) in known_items)
+        return known / len(items)
+
+    async def crawl_pages(self, engine, writer, max_pages=None, known_items=None,
+                          checkpoint=None, parse_executor=None):
+        """
+        一覧ページを並行して取得し、商品情報を取得したページから順に writer に書き込む
+        max_pages が None の場合は商品のないページまで取得
+        known_items を渡すと差分クロールになり、既知の商品が known_ratio 以上の
+        ページまでで停止する (一覧は新着順)
+        checkpoint があれば記録済みのページを飛ばし、書き込みが完了したページを記録する
+        parse_executor があれば解析はそこで行う (取得とは並行に進む)
+        取得した商品数と、最後まで取得したか (連続した失敗で中断していないか) を返す
+        """
+        loop = asyncio.get_running_loop()
+        done = set(checkpoint.pages) if checkpoint else set()
+        last_page = max_pages or math.inf
+        if checkpoint and checkpoint.last_page is not None:
+            last_page = min(last_page, checkpoint.last_page)
+        next_page = 1
+        failures = 0
+        item_count = 0
+        aborted = False
+
+        def stop_at(page):
+            nonlocal last_page
+            if page < last_page:
+                last_page = page
+                if checkpoint:
+                    checkpoint.set_last_page(page)
+
+        def record(pages):
+            if checkpoint:
+                for page in pages:
+                    checkpoint.add_page(page)
+
+        async def worker():
+            nonlocal next_page, last_page, failures, item_count, aborted
+            while True:
+                # 再開時は記録済みのページを飛ばす
+                while next_page in done:
+                    next_page += 1
+                if next_page > last_page:
+                    return
+                page = next_page
+                next_page += 1
+
+                content = await engine.fetch(self.base_url, self.page_params(page))
+                if not content:
+                    failures += 1
+                    if failures >= MAX_CONSECUTIVE_FAILURES and next_page <= last_page:
+                        print(f"{failures} ページ連続で取得に失敗したため中断します。")
+                        last_page = next_page - 1
+                        aborted = True
+                    else:
+                        print(f"ページ {page} の取得に失敗しました。次のページに進みます。")
+                    continue
+                failures = 0
+
+                items = await loop.run_in_executor(
+                    parse_executor, parse_items, content, self.parser
+                )
+                if not items:
+                    # 最後のページ以降は取得しない
+                    if page <= last_page:
+                        print(f"ページ {page} に商品が見つかりませんでした。")
+                        stop_at(page - 1)
                     continue
 
-                # 価格を取得
-                price_elem = item.select_one('.price')
-                price_text = price_elem.text.strip() if price_elem else '0'
-                price = int(''.join(filter(str.isdigit, price_text)) or 0)
-
-                # タイトルを取得
-                title_elem = item.select_one('.item-card-title')
-                title = title_elem.text.strip() if title_elem else 'No Title'
-
-                # 商品情報を格納
-                item_info = {
-                    'url': urljoin('https://booth.pm', link_elem['href']),
-                    'title': title,
-                    'price': price
-                }
-                
-                items.append(item_info)
-                
-            except Exception as e:
-                print(f"商品情報の抽出中にエラーが発生しました: {e}")
-                continue
-
-        return items
-
-    def save_results(self, items, filename):
-        """結果をJSONとCSVで保存"""
-        timestamp = time.strftime('%Y%m%d_%H%M%S')
-        base_path = self.results_dir / f"{filename}_{timestamp}"
-
-        # JSONとして保存
-        with open(f"{base_path}.json", 'w', encoding='utf-8') as f:
-            json.dump(items, f, ensure_ascii=False, indent=2)
-
-        # CSVとして保存
-        df = pd.DataFrame(items)
-        df.to_csv(f"{base_path}.csv", index=False, encoding='utf-8')
-
-        print(f"データを保存しました:")
-        print(f"- JSON: {base_path}.json")
-        print(f"- CSV: {base_path}.csv")
-        print(f"取得した商品数: {len(items)}")
-
-    def scrape(self, max_pages=5):
-        """指定されたページ数まで商品情報を取得"""
-        all_items = []
-        
+                # 新着で一覧がずれて同じ商品が2回現れても、書き込みは upsert なので重複しない
+                record(await asyncio.to_thread(writer.add_page, page, items))
+                item_count += len(items)
+                print(f"ページ {page} から {len(items)} 件の商品情報を取得しました。")
+
+                if known_items is not None and page <= last_page:
+                    fraction = self.known_fraction(items, known_items)
+                    if fraction >= self.known_ratio:
+                        print(f"ページ {page} は {fraction:.0%} が既知の商品のため、ここで停止します。")
+                        stop_at(page)
+
+        await asyncio.gather(*(worker() for _ in range(engine.concurrency)))
+        record(await asyncio.to_thread(writer.flush))
+        return item_count, not aborted
+
+    def scrape(self, max_pages=DEFAULT_MAX_PAGES, incremental=False):
+        """
+        指定されたページ数 (None の場合は最後のページ) まで商品情報を取得し、
+        取得したページから順に master_item (と parquet データセット) に書き込む
+        incremental の場合は既知の商品が大半を占めるページまでで停止
+        """
         print("スクレイピングを開始します...")
-        
-        for page in range(1, max_pages + 1):
-            print(f"\nページ {page} を処理中...")
-            
-            # ページ内容を取得
-            content = self.get_page_content(page)
-            if not content:
-                print(f"ページ {page} の取得に失敗しました。次のページに進みます。")
-                continue
-
-            # 商品情報を抽出
-            items = self.parse_items(content)
-            if not items:
-                print(f"ページ {page} に商品が見つかりませんでした。")
-                break
-
-            all_items.extend(items)
-            print(f"ページ {page} から {len(items)} 件の商品情報を取得しました。")
-            
-            # サーバーに負荷をかけないよう待機
-            time.sleep(2)
-
-        # 結果を保存
-        if all_items:
-            self.save_results(all_items, 'booth_items')
+
+        known_items = None
+        if incremental:
+            known_items = load_known_items(self.db_path)
+            print(f"差分クロール: 既知の商品 {len(known_items)} 件")
+
+        checkpoint = None
+        if self.checkpoint_path:
+            checkpoint = CrawlCheckpoint(self.checkpoint_path)
+            if checkpoint.open({'base_url': self.base_url, 'incremental': incremental}):
+                print(f"前回中断したクロールを再開します (書き込み済み {len(checkpoint.pages)} ページ)")
+
+        writer = ItemWriter(self.db_path, self.dataset_dir, self.batch_size)
+        cache = ResponseCache(**self.cache_options) if self.cache_options['path'] else None
+        parse_pool = None
+        if self.parse_workers != 0:
+            parse_pool = ProcessPoolExecutor(max_workers=self.parse_workers)
+        item_count = 0
+        completed = False
+        try:
+            with CrawlEngine(headers=self.headers, cache=cache, **self.crawl_options) as engine:
+                item_count, completed = asyncio.run(
+                    self.crawl_pages(engine, writer, max_pages, known_items, checkpoint, parse_pool)
+                )
+        finally:
+            if parse_pool is not None:
+                parse_pool.shutdown()
+            if cache is not None:
+                stats = cache.stats
+                print(f"\nキャッシュ: ヒット {stats['hits']} 件 / 304 {stats['revalidated']} 件 / "
+                      f"新規取得 {stats['stored']} 件 / 削除 {stats['evicted']} 件")
+                cache.close()
+            # 中断された場合もバッファに残った商品を書き込んでから記録する
+            pages = writer.close()
+            if checkpoint is not None:
+                for page in pages:
+                    checkpoint.add_page(page)
+                checkpoint.close()
+
+        if item_count:
+            print("データを保存しました:")
+            print(f"- master_item: {self.db_path}")
+            if self.dataset_dir:
+                print(f"- parquet: {self.dataset_dir}")
+            print(f"取得した商品数: {item_count}")
         else:
             print("商品情報が取得できませんでした。")
 
+        # 完了したのでチェックポイントは不要 (中断した場合は次回そこから再開する)
+        if checkpoint is not None and completed:
+            checkpoint.clear()
+        elif checkpoint is not None:
+            print(f"クロールを中断しました。次回は書き込み済みの {len(checkpoint.pages)} ページを飛ばして再開します")
+
 def main():
-    scraper = BoothScraper()
-    scraper.scrape(max_pages=5)  # 最大5ページまで取得
+    # config.json の "crawl" で max_pages やレート制限、キャッシュを指定できる
+    # ("offline": true でキャッシュ済みのページだけを解析し直す、
+    #  "incremental": true で既知の商品に達したところで停止する)
+    crawl_config = dict(load_config().get('crawl', {}))
+    max_pages = crawl_config.pop('max_pages', DEFAULT_MAX_PAGES)
+    incremental = crawl_config.pop('incremental', False)
+    scraper = BoothScraper(**crawl_config)
+    scraper.scrape(max_pages=max_pages, incremental=incremental)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file